@@ -0,0 +1,2 @@
+"""End-to-end benchmarks of the server with a scripted client and a fake model (see
+`__main__.py`)."""
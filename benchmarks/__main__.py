@@ -0,0 +1,248 @@
+"""Runs the benchmarks: `python -m benchmarks --help`.
+
+A `GrimoireServer` (in this process, or over stdio in a subprocess) serves the config in
+`benchmarks/config` against a fake model (or the replay of a recorded session, see
+`grimoire_ls.replay`), in a synthetic workspace, while a scripted client types and runs code
+actions. The results can be saved as a baseline, and compared with one
+to catch regressions."""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any
+
+from . import sessions
+from . import workspace as wrk
+from .client import LspClient
+from .fake_model import FakeModel, ModelOptions
+
+_here = Path(__file__).parent
+_baselines = _here / "baselines"
+_config = _here / "config"
+
+
+async def _pipe_streams(
+    read_fd: int, write_fd: int
+) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=1 << 24)
+    _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(read_fd, "rb")
+    )
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, os.fdopen(write_fd, "wb")
+    )
+    return reader, asyncio.StreamWriter(transport, protocol, None, loop)
+
+
+async def _start_in_process() -> tuple[
+    asyncio.StreamReader, asyncio.StreamWriter, threading.Thread
+]:
+    from grimoire_ls.server import GrimoireServer
+
+    to_server, from_client = os.pipe()
+    to_client, from_server = os.pipe()
+
+    def serve():
+        # The server runs its own event loop on this thread
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        server = GrimoireServer.load_config(_config / "init.py")
+        try:
+            server.start_io(os.fdopen(to_server, "rb"), os.fdopen(from_server, "wb"))
+        except SystemExit:
+            pass
+        finally:
+            # Its worker threads would keep the benchmark from exiting
+            server.blocking_executor.shutdown()
+
+    thread = threading.Thread(target=serve, name="grimoire-server", daemon=True)
+    thread.start()
+    return *await _pipe_streams(to_client, from_client), thread
+
+
+async def _start_stdio(
+    env: dict[str, str],
+) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, asyncio.subprocess.Process]:
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-m",
+        "grimoire_ls.run",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        env={**os.environ, **env},
+        limit=1 << 24,
+    )
+    assert process.stdin is not None and process.stdout is not None
+    return process.stdout, process.stdin, process
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    workspace_options = wrk.WorkspaceOptions(
+        files=args.files, lines=args.lines, seed=args.seed
+    )
+    session_options = sessions.SessionOptions(
+        bursts=args.bursts,
+        typing_interval=args.typing_interval,
+        code_actions=args.code_actions,
+        seed=args.seed,
+    )
+    with tempfile.TemporaryDirectory(prefix="grimoire-bench-") as tmp:
+        env = {
+            "GRIMOIRE_LS_HOME": str(_config),
+            "GRIMOIRE_LS_LOG": str(Path(tmp) / "grimoire-ls.log"),
+            "XDG_CACHE_HOME": str(Path(tmp) / "cache"),
+            "GRIMOIRE_BENCH_WORKSPACE_TOKENS": str(args.workspace_tokens),
+        }
+        if args.mode == "in-process":
+            # Before importing `grimoire_ls`, which reads its log path on import
+            os.environ.update(env)
+        from grimoire_ls.replay import Replayer, load_trace
+
+        if args.trace is not None:
+            model = Replayer(load_trace(args.trace), args.time_scale)
+            model_parameters = {"trace": str(args.trace), "time_scale": args.time_scale}
+        else:
+            model = FakeModel(
+                ModelOptions(
+                    latency=args.latency, tokens_per_second=args.tokens_per_second
+                )
+            )
+            model_parameters = asdict(model.options)
+        await model.start()
+        env["GRIMOIRE_BENCH_MODEL_URL"] = model.base_url
+
+        root = Path(tmp) / "workspace"
+        paths = wrk.create(root, workspace_options)
+        if args.mode == "stdio":
+            reader, writer, process = await _start_stdio(env)
+            stopped = process.wait()
+        else:
+            os.environ.update(env)
+            reader, writer, thread = await _start_in_process()
+            stopped = asyncio.to_thread(thread.join)
+
+        client = LspClient(reader, writer)
+        _ = await client.initialize(root)
+        documents = [client.open(path) for path in paths[: args.open_files]]
+        results = {
+            "typing": await sessions.typing(client, documents, session_options),
+            "code_actions": await sessions.code_actions(
+                client, documents, session_options
+            ),
+        }
+        stages = await client.request(
+            "workspace/executeCommand", {"command": "grimoire.metrics"}
+        )
+        await client.shutdown()
+        _ = await asyncio.wait_for(stopped, 5)
+        await model.close()
+    return {
+        "parameters": {
+            "mode": args.mode,
+            "model": model_parameters,
+            "workspace": asdict(workspace_options),
+            "sessions": asdict(session_options),
+            "open_files": args.open_files,
+            "workspace_tokens": args.workspace_tokens,
+        },
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+        # The server's own breakdown of where the time went (see `grimoire_ls.metrics`)
+        "stages": (stages or {}).get("histograms", {}),
+    }
+
+
+def _latencies(results: dict[str, Any], prefix: str = "") -> dict[str, float]:
+    """The percentiles of every latency distribution in `results`, by a flat name."""
+    flat: dict[str, float] = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_latencies(value, f"{prefix}{key}."))
+        elif key in ("p50", "p95", "p99"):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(
+    baseline: dict[str, Any], current: dict[str, Any], threshold: float
+) -> bool:
+    """Prints how the latencies changed from the baseline, and returns whether any of
+    them got slower by more than `threshold` (a fraction)."""
+    old, new = _latencies(baseline["results"]), _latencies(current["results"])
+    if baseline["parameters"] != current["parameters"]:
+        print("Warning: the baseline was recorded with different parameters")
+    regressed = False
+    for name in sorted(old.keys() & new.keys()):
+        change = (new[name] - old[name]) / old[name] if old[name] else 0.0
+        slower = change > threshold
+        regressed |= slower
+        mark = "  <-- slower" if slower else ""
+        print(
+            f"{name:40} {old[name] * 1000:9.1f}ms {new[name] * 1000:9.1f}ms"
+            + f" {change:+7.1%}{mark}"
+        )
+    return regressed
+
+
+def _print(results: dict[str, Any]):
+    for session, values in results["results"].items():
+        print(f"{session}:")
+        for name, value in values.items():
+            if isinstance(value, dict):
+                value = ", ".join(
+                    f"{k}={v * 1000:.1f}ms" if k != "count" else f"n={v}"
+                    for k, v in value.items()
+                )
+            elif isinstance(value, float):
+                value = f"{value:.2f}"
+            print(f"  {name}: {value}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    add = parser.add_argument
+    _ = add("--mode", choices=["in-process", "stdio"], default="in-process")
+    _ = add("--files", type=int, default=100, help="files in the workspace")
+    _ = add("--lines", type=int, default=200, help="lines per file")
+    _ = add("--open-files", type=int, default=5, help="files the client opens")
+    _ = add(
+        "--workspace-tokens", type=int, default=2000, help="0 for no workspace context"
+    )
+    _ = add("--bursts", type=int, default=20, help="bursts of typing")
+    _ = add("--typing-interval", type=float, default=0.08, help="seconds per keystroke")
+    _ = add("--code-actions", type=int, default=10)
+    _ = add("--latency", type=float, default=0.05, help="model time to first token")
+    _ = add("--tokens-per-second", type=float, default=200.0)
+    _ = add(
+        "--trace", type=Path, help="replay a recorded model instead of the fake one"
+    )
+    _ = add("--time-scale", type=float, default=1.0, help="scales the --trace timing")
+    _ = add("--seed", type=int, default=0)
+    _ = add("--save", metavar="NAME", help="save the results as a baseline")
+    _ = add("--compare", metavar="NAME", help="compare the results with a baseline")
+    _ = add(
+        "--threshold", type=float, default=0.1, help="slowdown that fails --compare"
+    )
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    _print(results)
+    if args.save:
+        _baselines.mkdir(exist_ok=True)
+        _ = (_baselines / f"{args.save}.json").write_text(json.dumps(results, indent=2))
+    if args.compare:
+        baseline = json.loads((_baselines / f"{args.compare}.json").read_text())
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
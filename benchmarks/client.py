@@ -0,0 +1,203 @@
+"""A minimal scripted LSP client, which talks to a server over a pair of streams and keeps
+its own copy of the open documents (including the edits that the server applies)."""
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import time
+from pathlib import Path
+from typing import Any
+
+
+class Document:
+    def __init__(self, uri: str, text: str):
+        self.uri = uri
+        self.text = text
+        self.version = 0
+
+    def offset(self, line: int, character: int) -> int:
+        offset = 0
+        for _ in range(line):
+            newline = self.text.find("\n", offset)
+            if newline < 0:
+                return len(self.text)
+            offset = newline + 1
+        return offset + character
+
+    def position(self, offset: int) -> dict[str, int]:
+        line = self.text.count("\n", 0, offset)
+        return {
+            "line": line,
+            "character": offset - (self.text.rfind("\n", 0, offset) + 1),
+        }
+
+    def apply(self, edits: list[dict[str, Any]]):
+        # Edits are applied from the end, so that the positions of the others stay valid
+        spans = [
+            (
+                self.offset(**edit["range"]["start"]),
+                self.offset(**edit["range"]["end"]),
+                edit["newText"],
+            )
+            for edit in edits
+        ]
+        for start, end, new_text in sorted(
+            spans, key=lambda span: span[:2], reverse=True
+        ):
+            self.text = self.text[:start] + new_text + self.text[end:]
+
+
+class LspClient:
+    """Sends requests and notifications, and answers the requests of the server the way
+    an editor would."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.documents: dict[str, Document] = {}
+        # When each `workspace/applyEdit` arrived, by document
+        self.applied_edits: dict[str, list[float]] = {}
+        self._ids = itertools.count(1)
+        self._pending: dict[int, asyncio.Future[Any]] = {}
+        self._edit_waiters: dict[str, list[asyncio.Future[float]]] = {}
+        self._reader_task = asyncio.ensure_future(self._read())
+
+    def _send(self, message: dict[str, Any]):
+        data = json.dumps({"jsonrpc": "2.0", **message}).encode()
+        self.writer.write(f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+
+    async def request(self, method: str, params: Any = None) -> Any:
+        id_ = next(self._ids)
+        future = self._pending[id_] = asyncio.get_running_loop().create_future()
+        self._send({"id": id_, "method": method, "params": params})
+        await self.writer.drain()
+        return await future
+
+    def notify(self, method: str, params: Any = None):
+        self._send({"method": method, "params": params})
+
+    def next_edit(self, uri: str) -> asyncio.Future[float]:
+        """Resolves to the time of the next edit that the server applies to `uri`."""
+        future = asyncio.get_running_loop().create_future()
+        self._edit_waiters.setdefault(uri, []).append(future)
+        return future
+
+    async def _read(self):
+        while True:
+            headers: dict[str, str] = {}
+            while (line := await self.reader.readline()).strip():
+                key, _, value = line.decode("ascii").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            if not line:
+                break
+            message = json.loads(
+                await self.reader.readexactly(int(headers["content-length"]))
+            )
+            if "method" not in message:
+                future = self._pending.pop(message["id"], None)
+                if future is not None and not future.done():
+                    if "error" in message:
+                        future.set_exception(RuntimeError(message["error"]))
+                    else:
+                        future.set_result(message.get("result"))
+            elif "id" in message:
+                self._send({"id": message["id"], "result": self._answer(message)})
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(
+                    ConnectionError("The server closed the connection")
+                )
+
+    def _answer(self, request: dict[str, Any]) -> Any:
+        if request["method"] == "workspace/applyEdit":
+            now = time.perf_counter()
+            for uri, edits in (request["params"]["edit"].get("changes") or {}).items():
+                document = self.documents.get(uri)
+                if document is not None:
+                    document.apply(edits)
+                    self.change(document)
+                self.applied_edits.setdefault(uri, []).append(now)
+                for future in self._edit_waiters.pop(uri, []):
+                    if not future.done():
+                        future.set_result(now)
+            return {"applied": True}
+        if request["method"] == "workspace/configuration":
+            return [None for _ in request["params"]["items"]]
+        # `window/workDoneProgress/create`, `client/registerCapability`, ...
+        return None
+
+    async def initialize(self, root: Path) -> dict[str, Any]:
+        result = await self.request(
+            "initialize",
+            {
+                "processId": None,
+                "rootUri": root.as_uri(),
+                "capabilities": {
+                    "window": {"workDoneProgress": True},
+                    "workspace": {"applyEdit": True},
+                    "textDocument": {
+                        "codeAction": {
+                            "codeActionLiteralSupport": {
+                                "codeActionKind": {"valueSet": ["refactor.rewrite"]}
+                            },
+                            "resolveSupport": {"properties": ["command"]},
+                        },
+                    },
+                },
+            },
+        )
+        self.notify("initialized", {})
+        return result
+
+    def open(self, path: Path) -> Document:
+        document = Document(path.as_uri(), path.read_text())
+        self.documents[document.uri] = document
+        self.notify(
+            "textDocument/didOpen",
+            {
+                "textDocument": {
+                    "uri": document.uri,
+                    "languageId": "python",
+                    "version": document.version,
+                    "text": document.text,
+                }
+            },
+        )
+        return document
+
+    def change(self, document: Document):
+        document.version += 1
+        self.notify(
+            "textDocument/didChange",
+            {
+                "textDocument": {"uri": document.uri, "version": document.version},
+                "contentChanges": [{"text": document.text}],
+            },
+        )
+
+    def type(self, document: Document, offset: int, text: str):
+        """Inserts `text` at `offset`, as a keystroke would."""
+        position = document.position(offset)
+        document.text = document.text[:offset] + text + document.text[offset:]
+        document.version += 1
+        self.notify(
+            "textDocument/didChange",
+            {
+                "textDocument": {"uri": document.uri, "version": document.version},
+                "contentChanges": [
+                    {"range": {"start": position, "end": position}, "text": text}
+                ],
+            },
+        )
+
+    async def shutdown(self):
+        try:
+            _ = await asyncio.wait_for(self.request("shutdown"), 5)
+            self.notify("exit")
+            await self.writer.drain()
+        except (ConnectionError, TimeoutError):
+            pass
+        self.writer.close()
+        _ = self._reader_task.cancel()
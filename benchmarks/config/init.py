@@ -0,0 +1,55 @@
+"""The grimoire that the benchmarks run: inline completions, completions and a code action,
+all backed by the fake model at `GRIMOIRE_BENCH_MODEL_URL`."""
+
+import os
+
+from lsprotocol.types import (
+    CompletionOptions,
+    CompletionParams,
+    InlineCompletionOptions,
+    InlineCompletionParams,
+)
+
+from grimoire_ls import completion as cmp
+from grimoire_ls.backend import BackendOptions, OpenAIBackend
+from grimoire_ls.code_actions import ActionOptions, ActionParams
+from grimoire_ls.server import GrimoireServer
+
+server = GrimoireServer()
+backend = OpenAIBackend(
+    BackendOptions(base_url=os.environ["GRIMOIRE_BENCH_MODEL_URL"]), model="bench"
+)
+workspace_tokens = int(os.environ.get("GRIMOIRE_BENCH_WORKSPACE_TOKENS", "2000"))
+
+
+def fill_in_the_middle(params: CompletionParams | InlineCompletionParams) -> str:
+    before, after, context = cmp.get_context(
+        server,
+        params,
+        include_workspace_context=workspace_tokens > 0,
+        max_workspace_tokens=workspace_tokens,
+    )
+    return f"{context}<|fim_prefix|>{before}<|fim_suffix|>{after}<|fim_middle|>"
+
+
+def inline_prompt(params: InlineCompletionParams) -> str:
+    return fill_in_the_middle(params)
+
+
+def completion_prompt(params: CompletionParams) -> str:
+    return fill_in_the_middle(params)
+
+
+def rewrite(text: str, _: ActionParams | None) -> str:
+    return f"Rewrite this code:\n```\n{text}\n```\n"
+
+
+_ = server.inline_completion(InlineCompletionOptions())(
+    backend.streaming_inline_completion(inline_prompt, max_tokens=32)
+)
+_ = server.completion(CompletionOptions())(
+    backend.completion(completion_prompt, max_tokens=16)
+)
+_ = server.code_action(ActionOptions(id="bench.rewrite", title="Rewrite"))(
+    backend.transform(rewrite, max_tokens=128)
+)
@@ -0,0 +1,130 @@
+"""A local stand-in for an OpenAI-compatible model server, with a configurable latency and
+token rate, so that benchmarks measure the server instead of the model.
+
+It answers `/completions` and `/chat/completions`, streamed or not, with deterministic
+code-like text."""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from dataclasses import dataclass
+
+_tokens = ["value", " =", " compute", "(", "items", ",", " key", ")", "\n"]
+
+
+@dataclass(frozen=True)
+class ModelOptions:
+    # Seconds before the first token
+    latency: float = 0.05
+    tokens_per_second: float = 200.0
+    # Tokens generated when the request does not set `max_tokens`
+    max_tokens: int = 64
+
+
+def generate(n_tokens: int) -> list[str]:
+    return [_tokens[i % len(_tokens)] for i in range(n_tokens)]
+
+
+class FakeModel:
+    """Serves the fake model over HTTP/1.1 with keep-alive on `127.0.0.1`."""
+
+    options: ModelOptions
+    requests: int
+
+    def __init__(self, options: ModelOptions | None = None):
+        self.options = options or ModelOptions()
+        self.requests = 0
+        self._server: asyncio.Server | None = None
+        self._connections: set[asyncio.StreamWriter] = set()
+
+    @property
+    def base_url(self) -> str:
+        assert self._server is not None, "The model is not running"
+        port = self._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/v1"
+
+    async def start(self, port: int = 0):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", port)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            # Idle keep-alive connections would keep the server open
+            for writer in self._connections:
+                writer.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(writer)
+        try:
+            while request_line := await reader.readline():
+                headers: dict[str, str] = {}
+                while (line := await reader.readline()).strip():
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = request_line.split()[1].decode()
+                await self._respond(path, json.loads(body or b"{}"), writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _respond(
+        self, path: str, body: dict[str, object], writer: asyncio.StreamWriter
+    ):
+        self.requests += 1
+        chat = path.endswith("/chat/completions")
+        if not chat and not path.endswith("/completions"):
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+            return
+        max_tokens = body.get("max_tokens")
+        tokens = generate(
+            max_tokens if isinstance(max_tokens, int) else self.options.max_tokens
+        )
+        start = time.perf_counter()
+        await asyncio.sleep(self.options.latency)
+
+        def choice(text: str) -> dict[str, object]:
+            if chat:
+                return {
+                    "index": 0,
+                    "delta": {"content": text},
+                    "message": {"content": text},
+                }
+            return {"index": 0, "text": text}
+
+        if not body.get("stream"):
+            await asyncio.sleep(len(tokens) / self.options.tokens_per_second)
+            data = json.dumps({"choices": [choice("".join(tokens))]}).encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                + f"Content-Length: {len(data)}\r\n\r\n".encode()
+                + data
+            )
+            await writer.drain()
+            return
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            + b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+        for i, token in enumerate(tokens):
+            # Tokens are sent on schedule, however long writing the previous ones took
+            delay = start + self.options.latency + i / self.options.tokens_per_second
+            await asyncio.sleep(max(0.0, delay - time.perf_counter()))
+            _write_chunk(
+                writer, f"data: {json.dumps({'choices': [choice(token)]})}\n\n"
+            )
+            await writer.drain()
+        _write_chunk(writer, "data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+def _write_chunk(writer: asyncio.StreamWriter, text: str):
+    data = text.encode()
+    writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
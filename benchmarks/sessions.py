@@ -0,0 +1,201 @@
+"""Scripted editing sessions, which measure how long the user waits for each result."""
+
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+from collections.abc import Awaitable
+from dataclasses import dataclass
+from typing import Any
+
+from .client import Document, LspClient
+
+# What the user types in each burst
+_snippets = [
+    "result = parser.parse(request)",
+    "for item in items:",
+    "if cache.get(key) is None:",
+    "return session.close()",
+    "buffer.append(token)",
+]
+
+
+@dataclass(frozen=True)
+class SessionOptions:
+    # Bursts of typing, each followed by a pause in which the results arrive
+    bursts: int = 20
+    # Seconds between keystrokes
+    typing_interval: float = 0.08
+    code_actions: int = 10
+    # Give up on a result after this many seconds
+    timeout: float = 30.0
+    seed: int = 0
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    """The distribution of latencies (in seconds)."""
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+
+    def percentile(q: float) -> float:
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples),
+        "p50": percentile(0.5),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "max": samples[-1],
+    }
+
+
+async def _timed(request: Awaitable[Any], sent: float) -> tuple[float, Any]:
+    result = await request
+    return time.perf_counter() - sent, result
+
+
+def _cursor_params(document: Document, offset: int) -> dict[str, Any]:
+    return {
+        "textDocument": {"uri": document.uri},
+        "position": document.position(offset),
+    }
+
+
+async def typing(
+    client: LspClient, documents: list[Document], options: SessionOptions
+) -> dict[str, Any]:
+    """Types into the documents, requesting an inline completion on every keystroke (as
+    editors do) and a completion at the end of each burst."""
+    rng = random.Random(options.seed)
+    inline: list[float] = []
+    results: list[float] = []
+    completions: list[float] = []
+    superseded = 0
+    requests = 0
+    start = time.perf_counter()
+    for _ in range(options.bursts):
+        document = rng.choice(documents)
+        line = rng.randrange(max(document.text.count("\n"), 1))
+        # Start a new line after a random one
+        offset = document.offset(line + 1, 0)
+        client.type(document, offset, "    \n")
+        offset += 4
+        pending: list[asyncio.Future[tuple[float, Any]]] = []
+        for char in rng.choice(_snippets):
+            client.type(document, offset, char)
+            offset += 1
+            request = client.request(
+                "textDocument/inlineCompletion",
+                {**_cursor_params(document, offset), "context": {"triggerKind": 2}},
+            )
+            pending.append(asyncio.ensure_future(_timed(request, time.perf_counter())))
+            await asyncio.sleep(options.typing_interval)
+        for latency, result in await asyncio.wait_for(
+            asyncio.gather(*pending), options.timeout
+        ):
+            requests += 1
+            inline.append(latency)
+            if result and result.get("items"):
+                results.append(latency)
+            else:
+                superseded += 1
+
+        request = client.request(
+            "textDocument/completion",
+            {**_cursor_params(document, offset), "context": {"triggerKind": 1}},
+        )
+        latency, _ = await asyncio.wait_for(
+            _timed(request, time.perf_counter()), options.timeout
+        )
+        requests += 1
+        completions.append(latency)
+    elapsed = time.perf_counter() - start
+    return {
+        # Every inline completion request, including the ones cut short by the next keystroke
+        "inline_requests": summarize(inline),
+        # Keystroke to completion shown
+        "inline_results": summarize(results),
+        "inline_superseded": superseded,
+        "completions": summarize(completions),
+        "requests_per_second": requests / elapsed,
+    }
+
+
+def _function_ranges(document: Document) -> list[tuple[int, int]]:
+    lines = document.text.split("\n")
+    starts = [i for i, line in enumerate(lines) if line.startswith("def ")]
+    ranges: list[tuple[int, int]] = []
+    for start in starts:
+        end = start + 1
+        while end < len(lines) and lines[end].strip():
+            end += 1
+        ranges.append((start, end))
+    return ranges
+
+
+async def code_actions(
+    client: LspClient, documents: list[Document], options: SessionOptions
+) -> dict[str, Any]:
+    """Selects functions and runs the rewrite action on them, measuring the time from
+    asking for the code actions to the edit being applied."""
+    rng = random.Random(options.seed)
+    latencies: list[float] = []
+    failures = 0
+    requests = 0
+    start = time.perf_counter()
+    for _ in range(options.code_actions):
+        document = rng.choice(documents)
+        ranges = _function_ranges(document)
+        if not ranges:
+            continue
+        first, last = rng.choice(ranges)
+        selection = {
+            "start": {"line": first, "character": 0},
+            "end": {"line": last, "character": 0},
+        }
+        sent = time.perf_counter()
+        actions = await client.request(
+            "textDocument/codeAction",
+            {
+                "textDocument": {"uri": document.uri},
+                "range": selection,
+                "context": {"diagnostics": []},
+            },
+        )
+        requests += 1
+        action = next((a for a in actions or [] if a.get("title") == "Rewrite"), None)
+        if action is None:
+            failures += 1
+            continue
+        if "command" not in action:
+            action = await client.request("codeAction/resolve", action)
+            requests += 1
+        edit = client.next_edit(document.uri)
+        try:
+            _ = await asyncio.wait_for(
+                client.request(
+                    "workspace/executeCommand",
+                    {
+                        "command": action["command"]["command"],
+                        "arguments": action["command"]["arguments"],
+                    },
+                ),
+                options.timeout,
+            )
+            applied = await asyncio.wait_for(edit, options.timeout)
+            latencies.append(applied - sent)
+        except (TimeoutError, RuntimeError, ConnectionError):
+            # No answer in time, or the command failed on the server
+            _ = edit.cancel()
+            failures += 1
+        requests += 1
+    elapsed = time.perf_counter() - start
+    return {
+        # Asking for the actions to the result being applied
+        "results": summarize(latencies),
+        "failures": failures,
+        "requests_per_second": requests / elapsed,
+    }
@@ -0,0 +1,58 @@
+"""Synthetic workspaces of a configurable size, which are the same for the same seed."""
+
+from __future__ import annotations
+
+import random
+import subprocess
+from dataclasses import dataclass
+from pathlib import Path
+
+_words = [
+    "user", "item", "order", "cache", "index", "token", "buffer", "record", "event",
+    "session", "config", "request", "result", "parser", "queue", "window", "value",
+]  # fmt: skip
+
+
+@dataclass(frozen=True)
+class WorkspaceOptions:
+    files: int = 100
+    # Lines per file (roughly)
+    lines: int = 200
+    # Files per directory
+    files_per_dir: int = 20
+    seed: int = 0
+
+
+def _name(rng: random.Random) -> str:
+    return f"{rng.choice(_words)}_{rng.choice(_words)}"
+
+
+def _function(rng: random.Random) -> list[str]:
+    args = ", ".join(rng.choice(_words) for _ in range(rng.randint(1, 3)))
+    lines = [f"def {_name(rng)}({args}):\n"]
+    for _ in range(rng.randint(3, 12)):
+        lines.append(f"    {_name(rng)} = {rng.choice(_words)}.{_name(rng)}({args})\n")
+    lines.append(f"    return {rng.choice(_words)}\n\n\n")
+    return lines
+
+
+def _module(rng: random.Random, n_lines: int) -> str:
+    lines = [f"import {rng.choice(_words)}\n\n\n"]
+    while len(lines) < n_lines:
+        lines.extend(_function(rng))
+    return "".join(lines)
+
+
+def create(root: Path, options: WorkspaceOptions) -> list[Path]:
+    """Creates the files of the workspace in `root` as a git repository."""
+    rng = random.Random(options.seed)
+    paths: list[Path] = []
+    for i in range(options.files):
+        path = root / f"package_{i // options.files_per_dir}" / f"module_{i}.py"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _ = path.write_text(_module(rng, options.lines))
+        paths.append(path)
+    _ = (root / ".gitignore").write_text("__pycache__/\n")
+    for command in (["init", "-q"], ["add", "-A"]):
+        _ = subprocess.run(["git", *command], cwd=root, check=True)
+    return paths
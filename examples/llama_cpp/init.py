@@ -1,5 +1,6 @@
 """This example uses the OpenAI API client to access local models running with Llama.cpp"""
 
+import os
 import re
 from lsprotocol.types import (
     TEXT_DOCUMENT_DID_SAVE,
@@ -16,29 +17,44 @@ from lsprotocol.types import (
 from typing import Optional
 from openai import OpenAI
 from result import Err, Ok, Result
-from grimoire_ls.code_actions import ActionOptions, ActionParams
+from grimoire_ls.cache import PersistOptions
+from grimoire_ls.code_actions import ActionOptions, ActionParams, EditGranularity
+from grimoire_ls.scheduling import Priority
 from grimoire_ls.server import GrimoireServer
-from grimoire_ls.logging import log
+from grimoire_ls.logging import Level, log
 from grimoire_ls import completion as cmp
 from pydantic import BaseModel, Field
 import instructor
 
 server = GrimoireServer()
 # Note that the `api_key` is a dummy value (it is not required) for local models,
-# the `base_url` points to the local Llama.cpp server instead of the OpenAI API.
-oai_client = OpenAI(api_key="sk-blah", base_url="http://localhost:7777/v1")
+# the `base_url` points to the local Llama.cpp server instead of the OpenAI API
+# (`GRIMOIRE_LS_MODEL_URL` can point it to `python -m grimoire_ls.replay` instead).
+oai_client = OpenAI(
+    api_key="sk-blah",
+    base_url=os.environ.get("GRIMOIRE_LS_MODEL_URL", "http://localhost:7777/v1"),
+)
 instr_client = instructor.from_openai(oai_client)
 
+# The handlers below are plain (non-`async`) functions because the `OpenAI` client is
+# synchronous: the server runs them on worker threads so they do not block the editor.
+
 
 @server.completion(CompletionOptions(trigger_characters=[" ", "\n"]))
-async def completions(params: CompletionParams) -> Result[list[CompletionItem], str]:
+def completions(params: CompletionParams) -> Result[list[CompletionItem], str]:
     """Uses a fill-in-the-middle completion prompt to provide LLM-generated code completions."""
 
     # Use this helper to get the content of the current file before and after the cursor
-    # Optionally, you can include the entire workspace content if you think the model
-    # might benefit from more context (this will result in slower completions, though).
+    # Optionally, you can include the workspace content if you think the model might
+    # benefit from more context (this will result in slower completions, though).
+    # `max_workspace_tokens` keeps only the most relevant files so the prompt fits in `n_ctx`.
+    # `window` keeps only the code around the cursor (and the imports) in large files.
     before, after, workspace = cmp.get_context(
-        server, params, include_workspace_context=False
+        server,
+        params,
+        include_workspace_context=False,
+        max_workspace_tokens=4000,
+        window=cmp.WindowOptions(prefix_lines=200, suffix_lines=50),
     )
 
     # Prompts are model-specific, so make sure to adapt the prompt to the model you are using
@@ -48,8 +64,8 @@ async def completions(params: CompletionParams) -> Result[list[CompletionItem],
 
     # The log function will write to an external log file for debugging
     # You can control the location of the file with the `GRIMOIRE_LS_LOG` environment variable
-    log("Prompt")
-    log(prompt)
+    log("Prompt", Level.debug)
+    log(prompt, Level.debug)
     response = oai_client.completions.create(
         top_p=0.9,
         best_of=3,
@@ -68,8 +84,8 @@ async def completions(params: CompletionParams) -> Result[list[CompletionItem],
         # Note that we are using the `Err` and `Ok` types from the `result` library
         return Err("Could not generate completions.")
     completion = response.choices[0].text
-    log("Completion:")
-    log(completion)
+    log("Completion:", Level.debug)
+    log(completion, Level.debug)
 
     # Note that we are using the `Err` and `Ok` types from the `result` library
     return Ok(
@@ -99,7 +115,9 @@ class Improvement(BaseModel):
 # This is expensive, so it's disabled by default
 # Uncomment to enable the style suggestions on save
 # @server.feature(TEXT_DOCUMENT_DID_SAVE)
-async def style_improvements(
+# Background work only runs when no completions or code actions are waiting for the model
+@server.scheduled(Priority.background)
+def style_improvements(
     ls: GrimoireServer, params: DidOpenTextDocumentParams
 ) -> Optional[str]:
     """Provide style suggestions for the code as diagnostics.
@@ -165,8 +183,28 @@ async def style_improvements(
     ls.publish_diagnostics(params.text_document.uri, diagnostics)
 
 
-@server.code_action(ActionOptions(id="simplify", title="Simplify this code"))
-async def simplify(text: str, _) -> Result[str, str]:
+# The generation is deterministic (fixed `seed`), so results can be cached on disk and
+# reused across restarts. Any parameter that changes the output belongs in `model_params`.
+simplify_params = {
+    "model": "deepseek-coder-instruct",
+    "best_of": 3,
+    "top_p": 0.9,
+    "seed": 1234,
+    "temperature": 0.1,
+    "max_tokens": 1000,
+}
+
+
+@server.code_action(
+    ActionOptions(
+        id="simplify",
+        title="Simplify this code",
+        persist=PersistOptions(model_params=simplify_params),
+        # Only touch the lines that were simplified
+        edits=EditGranularity.lines,
+    )
+)
+def simplify(text: str, _) -> Result[str, str]:
     """A code action that uses a language model to simplify the code."""
 
     prompt = f"""<｜begin▁of▁sentence｜>You are a state of the art AI programming assistant.
@@ -179,13 +217,8 @@ async def simplify(text: str, _) -> Result[str, str]:
     ```
     """
     response = oai_client.completions.create(
-        model="deepseek-coder-instruct",
         prompt=prompt,
-        best_of=3,
-        top_p=0.9,
-        seed=1234,
-        temperature=0.1,
-        max_tokens=1000,
+        **simplify_params,
         # Notice that the prompt includes the start of a code block and
         # `stop` includes the closing triple backticks so we can ensure
         # that the model will only generate code, and not other text.
@@ -222,9 +255,7 @@ class CustomInstructionParams(ActionParams):
         log=True,
     )
 )
-async def custom_instruction(
-    text: str, params: CustomInstructionParams
-) -> Result[str, str]:
+def custom_instruction(text: str, params: CustomInstructionParams) -> Result[str, str]:
     """A code action that uses a language model to simplify the code."""
 
     # NOTE: using a """ f-string broke python indentation for this example
@@ -236,7 +267,7 @@ async def custom_instruction(
         f"```\n{text}\n```"
         "### Response:\n```\n"
     )
-    log(prompt)
+    log(prompt, Level.debug)
     response = oai_client.completions.create(
         model="deepseek-coder-instruct",
         prompt=prompt,
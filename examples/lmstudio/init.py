@@ -1,5 +1,7 @@
 """This example uses the OpenAI API client to access local models running with LMStudio"""
 
+import os
+
 from lsprotocol.types import (
     InlineCompletionItem,
     InlineCompletionOptions,
@@ -9,7 +11,7 @@ from openai import OpenAI
 from result import Err, Ok, Result
 
 from grimoire_ls import completion as cmp
-from grimoire_ls.logging import log
+from grimoire_ls.logging import Level, log
 from grimoire_ls.server import GrimoireServer
 
 
@@ -19,12 +21,18 @@ class MyGrimoire(GrimoireServer):
 
 server = MyGrimoire()
 # Note that the `api_key` is a dummy value (it is not required) for local models,
-# the `base_url` points to your local server instead of the official OpenAI API.
-oai_client = OpenAI(api_key="sk-blah", base_url="http://127.0.0.1:1234/v1")
+# the `base_url` points to your local server instead of the official OpenAI API
+# (`GRIMOIRE_LS_MODEL_URL` can point it to `python -m grimoire_ls.replay` instead).
+oai_client = OpenAI(
+    api_key="sk-blah",
+    base_url=os.environ.get("GRIMOIRE_LS_MODEL_URL", "http://127.0.0.1:1234/v1"),
+)
 
 
+# This is a plain (non-`async`) function because the `OpenAI` client is synchronous:
+# the server runs it on a worker thread so it does not block the editor.
 @server.inline_completion(InlineCompletionOptions())
-async def inline_completion(
+def inline_completion(
     params: InlineCompletionParams,
 ) -> Result[list[InlineCompletionItem], str]:
     """Uses a fill-in-the-middle completion prompt to provide LLM-generated code completions."""
@@ -35,7 +43,7 @@ async def inline_completion(
     prompt = f"<|fim_prefix|>{before_cursor}<|fim_suffix|>{after_cursor}<|fim_middle|>"
     # The log function will write to an external log file for debugging
     # You can control the location of the file with the `GRIMOIRE_LS_LOG` environment variable
-    log(f"Prompt:\n{prompt}")
+    log(f"Prompt:\n{prompt}", Level.debug)
     response = oai_client.completions.create(
         top_p=0.9,
         best_of=3,
@@ -48,7 +56,7 @@ async def inline_completion(
     if not response.choices:
         return Err("Could not generate completions.")
     completion = response.choices[0].text
-    log(f"Completion:{completion}")
+    log(f"Completion:{completion}", Level.debug)
 
     return Ok(
         [
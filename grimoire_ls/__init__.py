@@ -1 +1,15 @@
-from . import server, logging, workspace, language
+import importlib
+from typing import TYPE_CHECKING, Any
+
+# The submodules are imported on first use, so that importing one of them (e.g. to
+# start the server) does not pay for the dependencies of all the others
+if TYPE_CHECKING:
+    from . import document, language, logging, server, workspace
+
+__all__ = ["document", "language", "logging", "server", "workspace"]
+
+
+def __getattr__(name: str) -> Any:
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,515 @@
+"""An async client for OpenAI-compatible servers (llama.cpp server, LM Studio, vLLM, ...).
+
+Connections are kept alive and pooled, every request has a deadline, and responses can
+be streamed token by token. Only the standard library is used, so no extra dependency
+has to be installed into the grimoire's environment."""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import ssl
+import time
+import weakref
+from collections import deque
+from collections.abc import AsyncGenerator, AsyncIterator, Awaitable, Callable
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import Any
+from urllib.parse import urlsplit
+
+from lsprotocol.types import (
+    CompletionItem,
+    CompletionItemKind,
+    CompletionParams,
+    InlineCompletionItem,
+    InlineCompletionParams,
+)
+from result import Err, Ok, Result
+
+from . import metrics, threads
+from .code_actions import ActionParams, StreamingTransformFn, TransformFn
+from .logging import Level, log
+
+
+class BackendError(Exception):
+    """Raised when the model server cannot be reached or returns an error."""
+
+
+@dataclass(frozen=True)
+class BackendOptions:
+    """Options for connecting to an OpenAI-compatible server."""
+
+    base_url: str = "http://localhost:8080/v1"
+    api_key: str | None = None
+    # The maximum number of concurrent requests (and open connections) to the server
+    max_connections: int = 4
+    # The default deadline of a request, in seconds (including streaming the response)
+    timeout: float = 60.0
+    connect_timeout: float = 5.0
+    # Idle connections are closed after this many seconds
+    keep_alive: float = 30.0
+
+
+class _Connection:
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    last_used: float
+    reused: bool
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    def close(self):
+        self.writer.close()
+
+
+class ConnectionPool:
+    """Persistent HTTP/1.1 connections to a single host."""
+
+    def __init__(self, options: BackendOptions):
+        url = urlsplit(options.base_url)
+        self.options = options
+        self.host = url.hostname or "localhost"
+        self.ssl = ssl.create_default_context() if url.scheme == "https" else None
+        self.port = url.port or (443 if self.ssl else 80)
+        self._idle: deque[_Connection] = deque()
+        self._slots = asyncio.Semaphore(options.max_connections)
+
+    async def acquire(self) -> _Connection:
+        """Waits for a free slot and returns an idle connection (or opens a new one)."""
+        await self._slots.acquire()
+        try:
+            now = time.monotonic()
+            while self._idle:
+                conn = self._idle.pop()
+                if (
+                    now - conn.last_used < self.options.keep_alive
+                    and not conn.reader.at_eof()
+                ):
+                    conn.reused = True
+                    return conn
+                conn.close()
+            async with asyncio.timeout(self.options.connect_timeout):
+                reader, writer = await asyncio.open_connection(
+                    self.host, self.port, ssl=self.ssl
+                )
+            return _Connection(reader, writer)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn: _Connection, reusable: bool):
+        """Returns a connection to the pool, or closes it if it cannot be reused."""
+        if reusable:
+            conn.last_used = time.monotonic()
+            self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
+
+
+class _Response:
+    """A response whose body is read lazily from a pooled connection."""
+
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        conn: _Connection,
+        status: int,
+        headers: dict[str, str],
+        deadline: float,
+    ):
+        self.pool = pool
+        self.conn = conn
+        self.status = status
+        self.headers = headers
+        self.deadline = deadline
+        self._released = False
+
+    async def _read(self, read: Awaitable[bytes]) -> bytes:
+        async with asyncio.timeout_at(self.deadline):
+            return await read
+
+    async def iter_body(self) -> AsyncGenerator[bytes]:
+        """Yields the body as it arrives. The connection goes back to the pool only if the
+        whole body was read; stopping early closes it, which aborts the generation."""
+        reader = self.conn.reader
+        reusable = self.headers.get("connection", "").lower() != "close"
+        complete = False
+        try:
+            if self.headers.get("transfer-encoding", "").lower() == "chunked":
+                while True:
+                    size_line = await self._read(reader.readline())
+                    size = int(size_line.split(b";", 1)[0].strip() or b"0", 16)
+                    if size == 0:
+                        # Skip the (usually empty) trailers
+                        while (await self._read(reader.readline())).strip():
+                            pass
+                        break
+                    chunk = await self._read(reader.readexactly(size + 2))
+                    yield chunk[:-2]
+            elif "content-length" in self.headers:
+                yield await self._read(
+                    reader.readexactly(int(self.headers["content-length"]))
+                )
+            else:
+                reusable = False
+                while chunk := await self._read(reader.read(1 << 16)):
+                    yield chunk
+            complete = True
+        finally:
+            self.release(reusable and complete)
+
+    async def read(self) -> bytes:
+        return b"".join([chunk async for chunk in self.iter_body()])
+
+    def release(self, reusable: bool = False):
+        if not self._released:
+            self._released = True
+            self.pool.release(self.conn, reusable)
+
+
+# The pools of each event loop (connections belong to the loop that opened them), by
+# their options. They are shared by all the backends with the same options, so that they
+# outlive the backends of a reloaded config.
+_pools: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[BackendOptions, ConnectionPool]
+] = weakref.WeakKeyDictionary()
+
+
+def close_pools():
+    """Closes the idle connections of the running event loop. Call this before closing
+    a loop that made requests (`asyncio.run` does not know about the pools)."""
+    for pool in _pools.pop(asyncio.get_running_loop(), {}).values():
+        pool.close()
+
+
+# Connections opened on the loop of a blocking call cannot outlive it
+threads.on_loop_close(close_pools)
+
+
+class OpenAIBackend:
+    """An async client for the `/completions` and `/chat/completions` endpoints of an
+    OpenAI-compatible server. Keyword arguments are passed through to the request body,
+    so any sampling parameter supported by the server can be used."""
+
+    options: BackendOptions
+    # Parameters that are sent with every request (e.g. `model`), unless overridden
+    default_params: dict[str, Any]
+
+    def __init__(
+        self,
+        options: BackendOptions | None = None,
+        **default_params: Any,
+    ):
+        self.options = options or BackendOptions()
+        self.default_params = default_params
+        self._path = urlsplit(self.options.base_url).path.rstrip("/")
+
+    @property
+    def _pool(self) -> ConnectionPool:
+        pools = _pools.setdefault(asyncio.get_running_loop(), {})
+        pool = pools.get(self.options)
+        if pool is None:
+            pool = pools[self.options] = ConnectionPool(self.options)
+        return pool
+
+    def _request_bytes(
+        self, pool: ConnectionPool, path: str, body: bytes, stream: bool
+    ) -> bytes:
+        headers = [
+            f"POST {self._path}{path} HTTP/1.1",
+            f"Host: {pool.host}:{pool.port}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+            f"Accept: {'text/event-stream' if stream else 'application/json'}",
+            "Connection: keep-alive",
+        ]
+        if self.options.api_key:
+            headers.append(f"Authorization: Bearer {self.options.api_key}")
+        return ("\r\n".join(headers) + "\r\n\r\n").encode() + body
+
+    async def _send(
+        self, path: str, body: dict[str, Any], stream: bool, timeout: float | None
+    ) -> _Response:
+        deadline = asyncio.get_running_loop().time() + (timeout or self.options.timeout)
+        pool = self._pool
+        request = self._request_bytes(pool, path, json.dumps(body).encode(), stream)
+        while True:
+            conn = None
+            try:
+                async with asyncio.timeout_at(deadline):
+                    conn = await pool.acquire()
+                    conn.writer.write(request)
+                    await conn.writer.drain()
+                    status_line = await conn.reader.readline()
+                    if not status_line:
+                        raise ConnectionResetError("Connection closed by the server")
+                    headers: dict[str, str] = {}
+                    while (line := await conn.reader.readline()).strip():
+                        key, _, value = line.decode("latin-1").partition(":")
+                        headers[key.strip().lower()] = value.strip()
+                status = int(status_line.split()[1])
+            except TimeoutError as e:
+                if conn is not None:
+                    pool.release(conn, reusable=False)
+                raise BackendError(f"Request to {path} timed out") from e
+            except (OSError, asyncio.IncompleteReadError) as e:
+                # Including the errors of connecting (refused, unknown host, ...)
+                if conn is not None:
+                    pool.release(conn, reusable=False)
+                    # The server may have closed an idle connection, so retry on a new one
+                    if conn.reused:
+                        continue
+                raise BackendError(
+                    f"Could not reach {self.options.base_url}: {e}"
+                ) from e
+            except (ValueError, IndexError) as e:
+                assert conn is not None
+                pool.release(conn, reusable=False)
+                raise BackendError(f"Invalid response from {path}: {e}") from e
+            except BaseException:
+                if conn is not None:
+                    pool.release(conn, reusable=False)
+                raise
+            response = _Response(pool, conn, status, headers, deadline)
+            if status >= 400:
+                error = (await response.read()).decode(errors="replace")
+                raise BackendError(f"{status} from {path}: {error}")
+            return response
+
+    async def request(
+        self, path: str, timeout: float | None = None, **params: Any
+    ) -> dict[str, Any]:
+        """Sends a request to `path` (relative to the base URL) and returns the JSON response."""
+        body = {**self.default_params, **params, "stream": False}
+        try:
+            with metrics.span("backend.request"):
+                response = await self._send(path, body, stream=False, timeout=timeout)
+                return json.loads(await response.read())
+        except TimeoutError as e:
+            raise BackendError(f"Request to {path} timed out") from e
+        except (OSError, asyncio.IncompleteReadError) as e:
+            raise BackendError(f"Could not read the response from {path}: {e}") from e
+        except ValueError as e:
+            raise BackendError(f"Invalid JSON from {path}: {e}") from e
+
+    async def stream(
+        self, path: str, timeout: float | None = None, **params: Any
+    ) -> AsyncGenerator[dict[str, Any]]:
+        """Sends a streaming request to `path` and yields each server-sent event."""
+        body = {**self.default_params, **params, "stream": True}
+        start = time.perf_counter()
+        first = True
+        done = False
+        try:
+            response = await self._send(path, body, stream=True, timeout=timeout)
+            buffer = b""
+            async with aclosing(response.iter_body()) as body:
+                async for chunk in body:
+                    # After `[DONE]`, the rest of the body is read so that the connection
+                    # can be reused
+                    if done:
+                        continue
+                    *lines, buffer = (buffer + chunk).split(b"\n")
+                    for line in lines:
+                        line = line.strip()
+                        if not line.startswith(b"data:"):
+                            continue
+                        data = line[len(b"data:") :].strip()
+                        if data == b"[DONE]":
+                            done = True
+                            break
+                        if first:
+                            first = False
+                            elapsed = time.perf_counter() - start
+                            metrics.observe("backend.first_token", elapsed)
+                        yield json.loads(data)
+        except TimeoutError as e:
+            raise BackendError(f"Request to {path} timed out") from e
+        except (OSError, asyncio.IncompleteReadError) as e:
+            raise BackendError(f"Could not read the response from {path}: {e}") from e
+        except ValueError as e:
+            raise BackendError(f"Invalid JSON from {path}: {e}") from e
+        finally:
+            metrics.observe("backend.stream", time.perf_counter() - start)
+
+    async def complete(
+        self, prompt: str, timeout: float | None = None, **params: Any
+    ) -> Result[str, str]:
+        """Returns the text that the model generates after `prompt`."""
+        try:
+            response = await self.request(
+                "/completions", timeout=timeout, prompt=prompt, **params
+            )
+        except BackendError as e:
+            log(e, Level.warning)
+            return Err(str(e))
+        if not response.get("choices"):
+            return Err("The model did not return any choices.")
+        return Ok(response["choices"][0].get("text") or "")
+
+    async def stream_complete(
+        self, prompt: str, timeout: float | None = None, **params: Any
+    ) -> AsyncGenerator[str]:
+        """Yields the text that the model generates after `prompt` as it is generated."""
+        async for event in self.stream(
+            "/completions", timeout=timeout, prompt=prompt, **params
+        ):
+            for choice in event.get("choices") or []:
+                if choice.get("index", 0) == 0 and choice.get("text"):
+                    yield choice["text"]
+
+    async def chat(
+        self,
+        messages: list[dict[str, str]],
+        timeout: float | None = None,
+        **params: Any,
+    ) -> Result[str, str]:
+        """Returns the content of the model's reply to `messages`."""
+        try:
+            response = await self.request(
+                "/chat/completions", timeout=timeout, messages=messages, **params
+            )
+        except BackendError as e:
+            log(e, Level.warning)
+            return Err(str(e))
+        if not response.get("choices"):
+            return Err("The model did not return any choices.")
+        return Ok(response["choices"][0].get("message", {}).get("content") or "")
+
+    async def stream_chat(
+        self,
+        messages: list[dict[str, str]],
+        timeout: float | None = None,
+        **params: Any,
+    ) -> AsyncGenerator[str]:
+        """Yields the content of the model's reply to `messages` as it is generated."""
+        async for event in self.stream(
+            "/chat/completions", timeout=timeout, messages=messages, **params
+        ):
+            for choice in event.get("choices") or []:
+                content = (choice.get("delta") or {}).get("content")
+                if choice.get("index", 0) == 0 and content:
+                    yield content
+
+    def transform(
+        self, build_prompt: Callable[[str, ActionParams | None], str], **params: Any
+    ) -> TransformFn:
+        """Creates a function for `GrimoireServer.code_action` that completes the prompt
+        built from the selected text (and the action's parameters)."""
+        build_prompt = metrics.timed("prompt")(build_prompt)
+
+        async def transform(
+            text: str, action_params: ActionParams | None
+        ) -> Result[str, str]:
+            return await self.complete(build_prompt(text, action_params), **params)
+
+        transform.__name__ = build_prompt.__name__
+        return transform
+
+    def streaming_transform(
+        self, build_prompt: Callable[[str, ActionParams | None], str], **params: Any
+    ) -> StreamingTransformFn:
+        """Creates a streaming function for `GrimoireServer.code_action`, whose result is
+        written into the document while it is generated."""
+        build_prompt = metrics.timed("prompt")(build_prompt)
+
+        async def transform(
+            text: str, action_params: ActionParams | None
+        ) -> AsyncIterator[str]:
+            async with aclosing(
+                self.stream_complete(build_prompt(text, action_params), **params)
+            ) as tokens:
+                async for token in tokens:
+                    yield token
+
+        transform.__name__ = build_prompt.__name__
+        return transform
+
+    def completion(
+        self,
+        build_prompt: Callable[[CompletionParams], str],
+        kind: CompletionItemKind = CompletionItemKind.Text,
+        **params: Any,
+    ) -> Callable[[CompletionParams], Awaitable[Result[list[CompletionItem], str]]]:
+        """Creates a function for `GrimoireServer.completion` that completes the prompt
+        built from the request."""
+        build_prompt = metrics.timed("prompt")(build_prompt)
+
+        async def completion(
+            request: CompletionParams,
+        ) -> Result[list[CompletionItem], str]:
+            match await self.complete(build_prompt(request), **params):
+                case Ok(text) if text:
+                    return Ok(
+                        [CompletionItem(label=text, text_edit_text=text, kind=kind)]
+                    )
+                case Ok(_):
+                    return Err("Could not generate completions.")
+                case Err(e):
+                    return Err(e)
+
+        completion.__name__ = build_prompt.__name__
+        return completion
+
+    def inline_completion(
+        self,
+        build_prompt: Callable[[InlineCompletionParams], str],
+        **params: Any,
+    ) -> Callable[
+        [InlineCompletionParams], Awaitable[Result[list[InlineCompletionItem], str]]
+    ]:
+        """Creates a function for `GrimoireServer.inline_completion` that completes the
+        prompt built from the request."""
+        build_prompt = metrics.timed("prompt")(build_prompt)
+
+        async def inline_completion(
+            request: InlineCompletionParams,
+        ) -> Result[list[InlineCompletionItem], str]:
+            match await self.complete(build_prompt(request), **params):
+                case Ok(text) if text:
+                    return Ok([InlineCompletionItem(insert_text=text)])
+                case Ok(_):
+                    return Err("Could not generate completions.")
+                case Err(e):
+                    return Err(e)
+
+        inline_completion.__name__ = build_prompt.__name__
+        return inline_completion
+
+    def streaming_inline_completion(
+        self,
+        build_prompt: Callable[[InlineCompletionParams], str],
+        **params: Any,
+    ) -> Callable[[InlineCompletionParams], AsyncIterator[str]]:
+        """Creates a streaming function for `GrimoireServer.inline_completion`, which lets
+        the server stop the generation as soon as the completion is good enough."""
+        build_prompt = metrics.timed("prompt")(build_prompt)
+
+        async def inline_completion(
+            request: InlineCompletionParams,
+        ) -> AsyncIterator[str]:
+            async with aclosing(
+                self.stream_complete(build_prompt(request), **params)
+            ) as tokens:
+                async for token in tokens:
+                    yield token
+
+        inline_completion.__name__ = build_prompt.__name__
+        return inline_completion
+
+    def close(self):
+        """Closes the idle connections (of every event loop)."""
+        for pools in _pools.values():
+            pool = pools.get(self.options)
+            if pool is not None:
+                pool.close()
@@ -0,0 +1,128 @@
+"""Running a code action over many targets (whole files, or the top-level functions in
+them) at once, with the results gathered into a single edit."""
+
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from lsprotocol.types import Position, Range
+
+from . import language as lang
+from . import workspace as wrk
+from .logging import Level, log
+
+if TYPE_CHECKING:
+    from .server import GrimoireServer
+
+
+@dataclass(frozen=True)
+class BatchOptions:
+    """Options for running a code action over many targets (see `GrimoireServer.run_batch`)."""
+
+    # The files to run on, relative to the workspace root (unless a file is given explicitly).
+    # By default, the source files of the known languages (see `language`).
+    glob: str | None = None
+    # Run on each top-level function of the files instead of on whole files
+    functions: bool = False
+    # How many targets are transformed at the same time
+    max_concurrency: int = 4
+
+
+@dataclass(frozen=True)
+class Target:
+    uri: str
+    range: Range
+    lines: list[str]
+    # The version of the document that `lines` were read from (`None` if it is not open)
+    version: int | None = None
+
+
+# The start of a function definition in common languages (at the start of a line)
+_function_pattern = re.compile(
+    r"(?:(?:export|pub(?:\(\w+\))?|async|static|public|private)\s+)*"
+    + r"(?:def|function|fn|func|defp?|sub|proc)\b"
+)
+# Lines at the top level that still belong to the block above them
+_closing_pattern = re.compile(r"[)\]}]|end\b")
+
+
+def matches_glob(relative_path: str, glob: str | None) -> bool:
+    if glob is None:
+        language = lang.by_extension.get(Path(relative_path).suffix.lstrip("."))
+        return language is not None and language.code
+    # `**/` also matches files at the root
+    return fnmatch(relative_path, glob) or (
+        glob.startswith("**/") and fnmatch(relative_path, glob[3:])
+    )
+
+
+def _lines_range(lines: list[str], first: int, last: int) -> Range:
+    # Up to the end of the last line, so that its line break is kept
+    return Range(Position(first, 0), Position(last, len(lines[last].rstrip("\r\n"))))
+
+
+def function_ranges(lines: list[str]) -> list[Range]:
+    """The ranges of the top-level functions in a file, found from their indentation."""
+    ranges: list[Range] = []
+    start: int | None = None
+    last = 0
+    for i, line in enumerate(lines):
+        if not line.strip() or line[0].isspace():
+            if start is not None and line.strip():
+                last = i
+            continue
+        if start is not None and _closing_pattern.match(line):
+            last = i
+            continue
+        if start is not None:
+            ranges.append(_lines_range(lines, start, last))
+            start = None
+        if _function_pattern.match(line):
+            start = last = i
+    if start is not None:
+        ranges.append(_lines_range(lines, start, last))
+    return ranges
+
+
+def find_targets(
+    server: GrimoireServer, options: BatchOptions, uri: str | None = None
+) -> list[Target]:
+    """The targets in the file `uri`, or in every visible file that matches the glob.
+    Files that cannot be read as text are skipped."""
+    if uri is not None:
+        uris = [uri]
+    else:
+        root = server.workspace.root_path
+        if not root:
+            return []
+        import git
+
+        root = Path(root)
+        uris = [
+            path.as_uri()
+            for path in wrk.visible_files(git.Repo(root), root)
+            if matches_glob(path.relative_to(root).as_posix(), options.glob)
+        ]
+
+    targets: list[Target] = []
+    for file_uri in uris:
+        document = server.workspace.get_text_document(file_uri)
+        try:
+            lines = list(document.lines)
+        except (OSError, UnicodeDecodeError) as e:
+            log(f"Could not read {file_uri}: {e}", Level.warning)
+            continue
+        if not lines:
+            continue
+        if options.functions:
+            ranges = function_ranges(lines)
+        else:
+            ranges = [_lines_range(lines, 0, len(lines) - 1)]
+        targets.extend(
+            Target(file_uri, range_, lines, document.version) for range_ in ranges
+        )
+    return targets
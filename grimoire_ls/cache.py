@@ -0,0 +1,299 @@
+from __future__ import annotations
+
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+
+@dataclass(frozen=True)
+class CacheOptions:
+    """Options for caching the results of completion handlers."""
+
+    enabled: bool = True
+    # The maximum number of cached results (least recently used results are evicted first)
+    max_size: int = 128
+    # Seconds after which a cached result is discarded (`None` to keep results forever)
+    ttl: float | None = 300.0
+    # How many characters the user can type ahead into a cached completion for it to be reused
+    max_type_ahead: int = 200
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    type_ahead_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.type_ahead_hits + self.misses
+        return (self.hits + self.type_ahead_hits) / total if total else 0.0
+
+
+@dataclass
+class _Entry[T]:
+    created_at: float
+    before_hash: int
+    before_len: int
+    after_hash: int
+    items: list[T]
+
+
+_Key = tuple[int, int, int]
+
+
+class CompletionCache[T]:
+    """A bounded LRU cache of completion results, keyed on the text before and after the cursor.
+
+    Besides exact matches, it recognizes when the user has typed the beginning of a
+    cached completion (i.e. the text before the cursor grew by a prefix of the completion)
+    and returns the rest of that completion. Only hashes of the context are stored."""
+
+    options: CacheOptions
+    stats: CacheStats
+    _entries: OrderedDict[_Key, _Entry[T]]
+    # Keys of the entries that share the same text after the cursor, for type-ahead lookups
+    _by_after: dict[int, set[_Key]]
+
+    def __init__(
+        self,
+        text_of: Callable[[T], str | None],
+        with_text: Callable[[T, str], T],
+        options: CacheOptions | None = None,
+    ):
+        self.options = options or CacheOptions()
+        self.stats = CacheStats()
+        self._text_of = text_of
+        self._with_text = with_text
+        self._entries = OrderedDict()
+        self._by_after = {}
+
+    def _expired(self, entry: _Entry[T], now: float) -> bool:
+        return (
+            self.options.ttl is not None and now - entry.created_at > self.options.ttl
+        )
+
+    def _remove(self, key: _Key):
+        entry = self._entries.pop(key)
+        keys = self._by_after[entry.after_hash]
+        keys.discard(key)
+        if not keys:
+            del self._by_after[entry.after_hash]
+
+    def get(self, before: str, after: str) -> list[T] | None:
+        """Returns the cached completions for this context, or `None` on a miss."""
+        now = time.monotonic()
+        after_hash = hash(after)
+        key = (hash(before), len(before), after_hash)
+        entry = self._entries.get(key)
+        if entry is not None and not self._expired(entry, now):
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry.items
+
+        for candidate in list(self._by_after.get(after_hash, ())):
+            entry = self._entries[candidate]
+            if self._expired(entry, now):
+                self._remove(candidate)
+                continue
+            n_typed = len(before) - entry.before_len
+            if not 0 < n_typed <= self.options.max_type_ahead:
+                continue
+            if hash(before[: entry.before_len]) != entry.before_hash:
+                continue
+            typed = before[entry.before_len :]
+            items: list[T] = []
+            for item in entry.items:
+                text = self._text_of(item)
+                if text is not None and len(text) > n_typed and text.startswith(typed):
+                    items.append(self._with_text(item, text[n_typed:]))
+            if items:
+                self._entries.move_to_end(candidate)
+                self.stats.type_ahead_hits += 1
+                return items
+
+        self.stats.misses += 1
+        return None
+
+    def put(self, before: str, after: str, items: list[T]):
+        """Caches `items` as the completions for this context."""
+        if not items or self.options.max_size <= 0:
+            return
+        after_hash = hash(after)
+        key = (hash(before), len(before), after_hash)
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = _Entry(
+            time.monotonic(), key[0], len(before), after_hash, items
+        )
+        self._by_after.setdefault(after_hash, set()).add(key)
+        while len(self._entries) > self.options.max_size:
+            self._remove(next(iter(self._entries)))
+            self.stats.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._by_after.clear()
+
+    def reconfigure(self, options: CacheOptions):
+        """Applies new options, keeping the entries that still fit."""
+        self.options = options
+        while len(self._entries) > self.options.max_size:
+            self._remove(next(iter(self._entries)))
+            self.stats.evictions += 1
+
+
+def default_cache_path() -> Path:
+    """The cache file in `$XDG_CACHE_HOME/grimoire-ls` (or `~/.cache/grimoire-ls`)."""
+    cache_home = os.environ.get(
+        "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+    )
+    return Path(cache_home) / "grimoire-ls" / "responses.sqlite"
+
+
+@dataclass(frozen=True)
+class PersistOptions:
+    """Opts a handler into the on-disk cache (see `PersistentCache`).
+    Only use it for deterministic models (e.g. with a fixed `seed` or `temperature=0`)."""
+
+    # The model and sampling parameters that affect the result (e.g. `model`, `seed`,
+    # `max_tokens`); they are part of the cache key, so changing them invalidates the cache
+    model_params: dict[str, Any] = field(default_factory=dict)
+
+
+class PersistentCache:
+    """A size-bounded LRU store of model results in an SQLite file, which survives
+    restarts of the server."""
+
+    path: Path
+    max_entries: int
+    max_bytes: int
+    # How often (in seconds) the access times of hits are written to the file. Until then,
+    # they are kept in memory, so that hits do not write to the file.
+    flush_interval: float
+
+    def __init__(
+        self,
+        path: Path | None = None,
+        max_entries: int = 10_000,
+        max_bytes: int = 100 * 1024 * 1024,
+        flush_interval: float = 60.0,
+    ):
+        self.path = path or default_cache_path()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self._last_used: dict[str, float] = {}
+        self._last_flush = time.monotonic()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        import sqlite3
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        _ = self._db.execute("PRAGMA journal_mode=WAL")
+        _ = self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        _ = self._db.execute(
+            "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)"
+        )
+        self._entries, self._bytes = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+        ).fetchone()
+        self.stats = CacheStats()
+        _ = atexit.register(self.flush)
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        """Hashes everything that determines a result into a key."""
+        data = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.stats.misses += 1
+                return None
+            self._last_used[key] = time.time()
+            if time.monotonic() - self._last_flush > self.flush_interval:
+                self._flush()
+                self._db.commit()
+            self.stats.hits += 1
+            return row[0]
+
+    def _flush(self):
+        if self._last_used:
+            _ = self._db.executemany(
+                "UPDATE results SET last_used = ? WHERE key = ?",
+                [(used, key) for key, used in self._last_used.items()],
+            )
+            self._last_used.clear()
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        """Writes the access times of recent hits to the file."""
+        with self._lock:
+            self._flush()
+            self._db.commit()
+
+    def put(self, key: str, value: str):
+        size = len(value.encode())
+        with self._lock:
+            old = self._db.execute(
+                "SELECT size FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if old is not None:
+                self._entries -= 1
+                self._bytes -= old[0]
+            _ = self._last_used.pop(key, None)
+            _ = self._db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            if (
+                self._entries + 1 > self.max_entries
+                or self._bytes + size > self.max_bytes
+            ):
+                # Evict by the up-to-date access times
+                self._flush()
+            self._entries += 1
+            self._bytes += size
+            while self._entries > self.max_entries or self._bytes > self.max_bytes:
+                row = self._db.execute(
+                    "SELECT key, size FROM results ORDER BY last_used LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    break
+                _ = self._db.execute("DELETE FROM results WHERE key = ?", (row[0],))
+                self._entries -= 1
+                self._bytes -= row[1]
+                self.stats.evictions += 1
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            _ = self._db.execute("DELETE FROM results")
+            self._db.commit()
+            self._last_used.clear()
+            self._entries = self._bytes = 0
+
+    def close(self):
+        atexit.unregister(self.flush)
+        with self._lock:
+            self._flush()
+            self._db.commit()
+            self._db.close()
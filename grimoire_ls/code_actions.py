@@ -1,12 +1,20 @@
 from __future__ import annotations
 
+import asyncio
+import copy
 import re
-from collections.abc import Awaitable, Callable
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Awaitable, Callable, Sequence
+from contextlib import aclosing
 from enum import Enum
-from typing import TYPE_CHECKING, Any, ClassVar, override
+from functools import wraps
+from typing import TYPE_CHECKING, Any, ClassVar, cast, override
 
 from lsprotocol.types import (
+    CodeAction,
     CodeActionKind,
+    Command,
     MessageType,
     Position,
     Range,
@@ -14,11 +22,16 @@ from lsprotocol.types import (
     WorkspaceEdit,
 )
 from pydantic import BaseModel, Field, ValidationError
+from pygls.lsp.server import LanguageServer
 from result import Err, Ok, Result
 
+from . import diff, metrics
 from . import language as lang
 from . import workspace as wrk
-from .logging import log
+from .batch import BatchOptions
+from .cache import PersistOptions
+from .document import DocumentView
+from .logging import Level, log
 
 if TYPE_CHECKING:
     from .server import GrimoireServer
@@ -87,14 +100,41 @@ class GrimoireActionType(Enum):
     append = "append"
 
 
+class EditGranularity(Enum):
+    """How the result of a `replace` action is applied to the document."""
+
+    # Replace the whole range with the result
+    whole = "whole"
+    # Only replace the lines that changed
+    lines = "lines"
+    # Only replace the characters that changed within the lines that changed
+    characters = "characters"
+
+
 class ActionOptions(BaseModel):
     id: str
     title: str | None = None
     action: GrimoireActionType = GrimoireActionType.replace
+    # Smaller edits keep the cursor, marks and highlighting of unchanged text intact
+    edits: EditGranularity = EditGranularity.whole
     params: type[ActionParams] | None = None
     command_kwargs: dict[str, Any] = Field(default_factory=dict)
     code_action_kwargs: dict[str, Any] = Field(default_factory=dict)
     log: bool = False
+    # Store results on disk and reuse them for the same input (see `PersistOptions`)
+    persist: PersistOptions | None = None
+    # Only offer the action in files of these languages (by name, e.g. "Python")
+    languages: list[str] | None = None
+    # Only offer the action when some text is selected
+    requires_selection: bool = False
+    # Start the action in the background as soon as the selection is stable, so that
+    # its result is ready when the user picks it (actions with `params` never are).
+    # Runs that are superseded are cancelled, but a blocking (non-`async`) action runs to
+    # the end on its worker thread, so this is best kept for `async` actions
+    speculative: bool = False
+    # Also register the command `<id>.batch`, which runs the action on many targets
+    # at once (actions with `params` cannot run in batches)
+    batch: BatchOptions | None = None
 
     @override
     def model_post_init(self, _):
@@ -104,21 +144,406 @@ class ActionOptions(BaseModel):
         self.code_action_kwargs.setdefault("kind", CodeActionKind.RefactorRewrite)
 
 
+def _kind(kind: Any) -> str:
+    return kind.value if isinstance(kind, Enum) else kind
+
+
+class CodeActionIndex:
+    """The registered code actions, indexed by language and kind, so that answering a
+    `textDocument/codeAction` request only touches the actions that apply to it.
+
+    The parts of each `CodeAction` that do not depend on the request are built once,
+    when the action is registered."""
+
+    options: list[ActionOptions]
+    by_id: dict[str, ActionOptions]
+    _templates: list[CodeAction]
+    # Positions of the actions by language (`None` for any language) and kind
+    _index: dict[str | None, dict[str, list[int]]]
+    _matches: dict[tuple[str, tuple[str, ...] | None, bool], list[int]]
+
+    def __init__(self):
+        self.options = []
+        self.by_id = {}
+        self._templates = []
+        self._index = {}
+        self._matches = {}
+
+    def add(self, options: ActionOptions):
+        i = len(self.options)
+        self.options.append(options)
+        self.by_id[options.id] = options
+        self._templates.append(CodeAction(**options.code_action_kwargs))
+        kind = _kind(options.code_action_kwargs["kind"])
+        for language in options.languages or [None]:
+            key = language.lower() if language else None
+            self._index.setdefault(key, {}).setdefault(kind, []).append(i)
+        self._matches.clear()
+
+    @property
+    def kinds(self) -> list[str]:
+        return sorted({kind for by_kind in self._index.values() for kind in by_kind})
+
+    def _match(
+        self, language: str, only: tuple[str, ...] | None, has_selection: bool
+    ) -> list[int]:
+        key = (language, only, has_selection)
+        matches = self._matches.get(key)
+        if matches is None:
+            matches = []
+            for by_kind in (self._index.get(None, {}), self._index.get(language, {})):
+                for kind, positions in by_kind.items():
+                    if only is None or any(
+                        kind == o or kind.startswith(o + ".") for o in only
+                    ):
+                        matches.extend(positions)
+            matches.sort()
+            if not has_selection:
+                matches = [i for i in matches if not self.options[i].requires_selection]
+            self._matches[key] = matches
+        return matches
+
+    def _positions(
+        self, uri: str, range_: Range, only: Sequence[str] | None
+    ) -> list[int]:
+        language = lang.from_extension(wrk.uri_to_path(uri).suffix).name.lower()
+        only_ = tuple(_kind(o) for o in only) if only else None
+        return self._match(language, only_, range_.start != range_.end)
+
+    def matching(
+        self, uri: str, range_: Range, only: Sequence[str] | None
+    ) -> list[ActionOptions]:
+        """The options of the actions that apply to a selection in a document."""
+        return [self.options[i] for i in self._positions(uri, range_, only)]
+
+    def actions(
+        self,
+        uri: str,
+        range_: Range,
+        only: Sequence[str] | None,
+        resolve: bool,
+    ) -> list[CodeAction]:
+        """The code actions for a selection in a document. With `resolve`, their commands
+        are left out, to be filled in by `resolve` once the user picks one of them."""
+        arguments = [
+            uri,
+            range_.start.line,
+            range_.start.character,
+            range_.end.line,
+            range_.end.character,
+        ]
+        actions: list[CodeAction] = []
+        for i in self._positions(uri, range_, only):
+            action = copy.copy(self._templates[i])
+            if resolve:
+                action.data = [self.options[i].id, *arguments]
+            else:
+                action.command = self._command(self.options[i], arguments)
+            actions.append(action)
+        return actions
+
+    def _command(self, options: ActionOptions, arguments: list[Any]) -> Command:
+        return Command(
+            command=options.id, arguments=arguments, **options.command_kwargs
+        )
+
+    def resolve(self, action: CodeAction) -> CodeAction:
+        """Fills in the command of an action that was returned by `actions`."""
+        match action.data:
+            case [str(id_), *arguments] if id_ in self.by_id:
+                action.command = self._command(self.by_id[id_], arguments)
+            case _:
+                pass
+        return action
+
+
+# The document, its version, the selected range and the action of a speculative run
+SpeculationKey = tuple[str, int | None, tuple[int, int, int, int], str]
+
+
+class Speculator:
+    """Runs code actions in the background while the user looks at the list of actions,
+    so that the result is ready (or at least on its way) when they pick one.
+
+    Runs only start once the selection has been stable for `delay` seconds. A new
+    selection in the same document cancels the runs for the previous one, and picking
+    an action cancels the runs of the other actions."""
+
+    delay: float
+    # How many documents keep their runs (the least recently used are dropped first)
+    max_documents: int
+    _runs: OrderedDict[str, dict[SpeculationKey, asyncio.Task[Result[str, str]]]]
+    _pending: dict[str, asyncio.Task[None]]
+    # The keys that are pending or running for each document
+    _scheduled: dict[str, set[SpeculationKey]]
+
+    def __init__(self, delay: float = 0.5, max_documents: int = 4):
+        self.delay = delay
+        self.max_documents = max_documents
+        self._runs = OrderedDict()
+        self._pending = {}
+        self._scheduled = {}
+
+    def _cancel(self, uri: str, keep: SpeculationKey | None = None):
+        _ = self._scheduled.pop(uri, None)
+        pending = self._pending.pop(uri, None)
+        if pending is not None:
+            _ = pending.cancel()
+        for key, task in self._runs.pop(uri, {}).items():
+            if key != keep:
+                _ = task.cancel()
+
+    def schedule(
+        self,
+        keys: list[SpeculationKey],
+        run: Callable[[SpeculationKey], Awaitable[Result[str, str]]],
+    ):
+        """Starts `run` for each of `keys` (which belong to the same document) after the
+        delay, unless they are already running."""
+        if not keys:
+            return
+        uri = keys[0][0]
+        if self._scheduled.get(uri) == set(keys):
+            return
+        self._cancel(uri)
+        self._scheduled[uri] = set(keys)
+
+        async def start():
+            await asyncio.sleep(self.delay)
+            del self._pending[uri]
+            self._runs[uri] = {key: asyncio.ensure_future(run(key)) for key in keys}
+            while len(self._runs) > self.max_documents:
+                self._cancel(next(iter(self._runs)))
+
+        self._pending[uri] = asyncio.ensure_future(start())
+
+    def take(self, key: SpeculationKey) -> asyncio.Task[Result[str, str]] | None:
+        """Returns the run for `key` (if there is one), and cancels the other runs
+        for the same document."""
+        task = self._runs.get(key[0], {}).get(key)
+        self._cancel(key[0], keep=key)
+        return task
+
+
 TransformFn = Callable[[str, ActionParams | None], Awaitable[Result[str, str]]]
+# Transforms that use synchronous clients are run on a worker thread by the server
+SyncTransformFn = Callable[[str, ActionParams | None], Result[str, str]]
+# Transforms that yield their result as it is generated, so that it can be shown right away
+StreamingTransformFn = Callable[[str, ActionParams | None], AsyncIterator[str]]
+
+# How often a streamed result is updated in the document (in seconds)
+_stream_interval = 0.1
+
+
+def collect_stream(f: StreamingTransformFn) -> TransformFn:
+    """A transform that returns the whole result of `f`. The text generated so far is
+    passed to `on_text` (if given) whenever `f` yields."""
+
+    @wraps(f)
+    async def transform(
+        text: str,
+        params: ActionParams | None,
+        on_text: Callable[[str], None] | None = None,
+    ) -> Result[str, str]:
+        from .backend import BackendError
+
+        generated = ""
+        try:
+            async with aclosing(f(text, params)) as chunks:  # pyright: ignore[reportArgumentType]
+                async for chunk in chunks:
+                    generated += chunk
+                    if on_text is not None:
+                        on_text(generated)
+        except (BackendError, OSError) as e:
+            # The model could not be reached; other errors are bugs in `f`
+            log(e, Level.warning)
+            return Err(str(e))
+        return Ok(generated)
+
+    return transform
+
+
+@metrics.timed("format")
+def format_result(result: str, indent: wrk.Indentation) -> str:
+    """Aligns the result of an action to the indentation of the text it replaces."""
+    # NOTE: rstrip is important to remove trailing whitespace which can mess up the indentation
+    return "\n".join(indent.format(result.rstrip().splitlines()))
+
+
+class StreamedText:
+    """A part of a document that is rewritten while an action's result is generated.
+    While it is generated, only the new lines are inserted; the final result is diffed
+    against what is shown, so that only what changed is edited.
+
+    Positions are not adjusted for changes that the user makes elsewhere in the
+    document while the result is being streamed."""
+
+    def __init__(
+        self,
+        ls: GrimoireServer,
+        uri: str,
+        start: Position,
+        original: str,
+        indent: wrk.Indentation,
+    ):
+        self.ls = ls
+        self.uri = uri
+        self.start = start
+        self.original = original
+        self.indent = indent
+        # The text that is currently in the document
+        self.shown = original
+        # Whether `shown` is generated text (which the next update may extend)
+        self._streaming = False
+        self._last_update = 0.0
+
+    def _end(self) -> Position:
+        # The position after the shown text
+        line_break = self.shown.rfind("\n")
+        if line_break < 0:
+            return Position(self.start.line, self.start.character + len(self.shown))
+        return Position(
+            self.start.line + self.shown.count("\n"), len(self.shown) - line_break - 1
+        )
+
+    def _apply(self, edits: list[TextEdit], text: str):
+        self.shown = text
+        with metrics.span("apply_edit"):
+            _ = self.ls.apply_edit(WorkspaceEdit(changes={self.uri: edits}))
+
+    def show(self, text: str):
+        """Shows `text` by editing only what differs from the text that is shown."""
+        if text == self.shown:
+            return
+        self._apply(diff.edits_at(self.start, self.shown, text), text)
+        self._streaming = False
+
+    def update(self, generated: str):
+        """Shows the complete lines of the text generated so far (at most every
+        `_stream_interval` seconds)."""
+        now = time.monotonic()
+        if now - self._last_update < _stream_interval:
+            return
+        complete = generated[: generated.rfind("\n") + 1]
+        if not complete.strip():
+            return
+        self._last_update = now
+        text = format_result(complete, self.indent)
+        if text == self.shown:
+            return
+        end = self._end()
+        if self._streaming and text.startswith(self.shown):
+            edit = TextEdit(range=Range(end, end), new_text=text[len(self.shown) :])
+        else:
+            # The original text, or generated lines that are now indented differently
+            edit = TextEdit(range=Range(self.start, end), new_text=text)
+        self._apply([edit], text)
+        self._streaming = True
+
+    def revert(self):
+        self.show(self.original)
+
+
+def result_edits(
+    lines: Sequence[str],
+    range_: Range,
+    result: str,
+    indent: wrk.Indentation,
+    options: ActionOptions,
+) -> list[TextEdit]:
+    """The edits that apply the result of an action on `range_` to a document."""
+    result = format_result(result, indent)
+    if options.log:
+        log("Result:")
+        log(result)
+
+    match options.action:
+        case GrimoireActionType.replace:
+            if options.edits != EditGranularity.whole:
+                characters = options.edits == EditGranularity.characters
+                return diff.text_edits(lines, range_, result, characters)
+        case GrimoireActionType.append:
+            range_ = Range(range_.end, range_.end)
+        case GrimoireActionType.prepend:
+            range_ = Range(range_.start, range_.start)
+    return [TextEdit(range=range_, new_text=result)]
+
+
+def _streamed_text(
+    ls: GrimoireServer,
+    uri: str,
+    lines: Sequence[str],
+    range_: Range,
+    n_param_lines: int,
+    indent: wrk.Indentation,
+    options: ActionOptions,
+) -> StreamedText:
+    # `range_` is the text without the parameters, which are removed before streaming
+    # starts, so the text moves up by `n_param_lines`
+    match options.action:
+        case GrimoireActionType.replace:
+            start, original = range_.start, diff.text_in_range(lines, range_)
+        case GrimoireActionType.append:
+            start, original = range_.end, ""
+        case GrimoireActionType.prepend:
+            start, original = range_.start, ""
+    start = Position(start.line - n_param_lines, start.character)
+    return StreamedText(ls, uri, start, original, indent)
+
+
+async def _speculated(
+    speculation: asyncio.Task[Result[str, str]],
+) -> Result[str, str] | None:
+    """The result of a speculative run, or `None` if it has to be run again."""
+    try:
+        result = await speculation
+    except asyncio.CancelledError:
+        current = asyncio.current_task()
+        if current is not None and current.cancelling():
+            raise
+        return None
+    # The run may have failed because it was shed as background work
+    return result if isinstance(result, Ok) else None
 
 
 def wrap_transform(
     f: TransformFn,
     options: ActionOptions,
+    streaming: bool = False,
 ):
-    """Creates a code action from a function that takes in a string and returns a string."""
+    """Creates a code action from a function that takes in a string and returns a string.
+    With `streaming`, `f` is a transform made with `collect_stream`, and its result is
+    written into the document while it is generated."""
+
+    # NOTE: `ls` variable name cannot be changed. It is hard-coded in pygls.
+    # pygls resolves the annotations at runtime to convert the command arguments, so
+    # they must not refer to names that are only imported for type checking
+    async def wrapped(
+        ls: LanguageServer,
+        uri: str,
+        start_line: int,
+        start_col: int,
+        end_line: int,
+        end_col: int,
+    ):
+        with metrics.span(f"{options.id}.action"):
+            await run(
+                cast("GrimoireServer", ls),
+                (uri, start_line, start_col, end_line, end_col),
+            )
 
-    # NOTE: `ls` variable name cannot be changed. It is hard-coded in pygls
-    async def wrapped(ls: GrimoireServer, args: tuple[str, int, int, int, int]):
+    async def run(ls: GrimoireServer, args: tuple[str, int, int, int, int]):
         uri, start_line, start_col, end_line, end_col = args
-        document = ls.workspace.get_document(uri)
+        document = ls.workspace.get_text_document(uri)
+        speculation = None
+        if options.speculative:
+            range_key = (start_line, start_col, end_line, end_col)
+            speculation = ls.speculator.take(
+                (uri, document.version, range_key, options.id)
+            )
+        view = DocumentView.of(document)
         range_ = Range(Position(start_line, start_col), Position(end_line, end_col))
-        lines = wrk.lines_from_range(document.lines, range_)
+        lines = view.lines_in_range(range_)
         original_indent = wrk.Indentation.from_lines(lines)
         n_param_lines = 0
         params = None
@@ -168,38 +593,55 @@ def wrap_transform(
             )
             start_line += n_param_lines
 
-        match await f(text, params):
-            case Ok(result):
-                # NOTE: rstrip is important to remove trailing whitespace which can mess up the indentation
-                result = "\n".join(original_indent.format(result.rstrip().splitlines()))
+        result = await _speculated(speculation) if speculation else None
+        if options.speculative:
+            hit = "hit" if result is not None else "miss"
+            metrics.incr(f"{options.id}.speculation.{hit}")
+        streamed = None
+        if result is None and streaming:
+            if edits:
+                # Remove the parameters before the result starts to appear
+                _ = ls.apply_edit(WorkspaceEdit(changes={uri: edits}))
+                edits = []
+            streamed = _streamed_text(
+                ls,
+                uri,
+                view,
+                Range(Position(start_line, start_col), Position(end_line, end_col)),
+                n_param_lines,
+                original_indent,
+                options,
+            )
+            try:
+                with metrics.span(f"{options.id}.transform"):
+                    result = await f(text, params, on_text=streamed.update)  # pyright: ignore[reportCallIssue]
+            except BaseException:
+                streamed.revert()
+                raise
+        elif result is None:
+            with metrics.span(f"{options.id}.transform"):
+                result = await f(text, params)
+
+        match result:
+            case Ok(result) if streamed is not None:
+                result = format_result(result, original_indent)
                 if options.log:
                     log("Result:")
                     log(result)
-
-                match options.action:
-                    case GrimoireActionType.replace:
-                        range_ = Range(
-                            Position(start_line, start_col),
-                            Position(end_line, end_col),
-                        )
-                    case GrimoireActionType.append:
-                        range_ = Range(
-                            Position(end_line, end_col),
-                            Position(end_line, end_col),
-                        )
-                    case GrimoireActionType.prepend:
-                        range_ = Range(
-                            Position(start_line, start_col),
-                            Position(start_line, start_col),
-                        )
-                edits.append(
-                    TextEdit(
-                        range=range_,
-                        new_text=result,
-                    )
+                streamed.show(result)
+            case Ok(result):
+                range_ = Range(
+                    Position(start_line, start_col), Position(end_line, end_col)
                 )
-                _ = ls.apply_edit(WorkspaceEdit(changes={uri: edits}))
+                edits.extend(
+                    result_edits(view, range_, result, original_indent, options)
+                )
+                with metrics.span("apply_edit"):
+                    _ = ls.apply_edit(WorkspaceEdit(changes={uri: edits}))
             case Err(e):
+                metrics.incr(f"{options.id}.errors")
+                if streamed is not None:
+                    streamed.revert()
                 if options.log:
                     log("!!!FAILED!!!\nResponse:")
                     log(e)
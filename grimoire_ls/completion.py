@@ -1,39 +1,411 @@
+from __future__ import annotations
+
+import math
+import time
+from collections.abc import Callable, Iterator, Sequence
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
 from lsprotocol.types import CompletionParams, InlineCompletionParams
-from grimoire_ls.server import GrimoireServer
+from . import metrics
 from . import workspace as wrk
 from . import language as lang
+from .document import DocumentView
+
+if TYPE_CHECKING:
+    from .server import GrimoireServer
+
+# How many lines around the cursor are used to judge the relevance of other files
+neighbourhood_lines_before = 30
+neighbourhood_lines_after = 10
+# How many lines around the cursor key the completion caches (see `local_context`)
+local_context_lines = 64
+# How much each signal contributes to the relevance of a file
+identifier_weight = 1.0
+path_weight = 0.5
+recency_weight = 0.5
+# Seconds after which the boost from a recent edit has decayed to ~37%
+recency_decay = 600.0
+
+
+def estimate_tokens(text: str) -> int:
+    """A rough token count that assumes ~4 characters per token."""
+    return (len(text) + 3) // 4
+
+
+@dataclass(frozen=True)
+class WindowOptions:
+    """Limits the text before and after the cursor that `get_context` returns, so that the
+    size of the prompt does not depend on the size of the file. A side of the window ends
+    at the first of its limits that it reaches (`None` is no limit)."""
+
+    prefix_lines: int | None = 200
+    suffix_lines: int | None = 50
+    prefix_chars: int | None = None
+    suffix_chars: int | None = None
+    prefix_tokens: int | None = None
+    suffix_tokens: int | None = None
+    # The edges of the window move towards the cursor (by at most this fraction of each
+    # side) to the start of a top-level definition, or else of a blank-line separated
+    # block. This also keeps the prompt the same between keystrokes, so that the model
+    # server can reuse its cache for it.
+    snap: float = 0.25
+    # The header of the file (imports, ...) is kept when the window starts below it,
+    # if it is no longer than this
+    header_lines: int = 40
+
+
+def _lines_from(view: DocumentView, line: int, step: int) -> Iterator[str]:
+    """The lines from `line` towards the start (`step` -1) or the end (1) of `view`,
+    which are sliced a few at a time."""
+    chunk = 64
+    if step < 0:
+        while line >= 0:
+            start = max(0, line - chunk + 1)
+            yield from reversed(view[start : line + 1])
+            line = start - 1
+    else:
+        while line < len(view):
+            yield from view[line : line + chunk]
+            line += chunk
+
+
+def _window_lines(
+    lines: Iterator[str],
+    used: str,
+    max_lines: int | None,
+    max_chars: int | None,
+    max_tokens: int | None,
+    count_tokens: Callable[[str], int],
+) -> list[str]:
+    """The lines that fit within the limits, in addition to the text in `used`."""
+    chars, tokens = len(used), count_tokens(used) if max_tokens is not None else 0
+    taken: list[str] = []
+    for line in lines:
+        if max_lines is not None and len(taken) >= max_lines:
+            break
+        chars += len(line)
+        if max_chars is not None and chars > max_chars:
+            break
+        if max_tokens is not None:
+            tokens += count_tokens(line)
+            if tokens > max_tokens:
+                break
+        taken.append(line)
+    return taken
+
+
+def _snap(edge: list[str], language: lang.Language, slack: int, start: bool) -> int:
+    """How many lines to drop at an edge of the window, so that it does not cut a
+    top-level definition (or else a block) in two. `edge` is the line just outside the
+    window, followed by the lines inside it from that edge towards the cursor. At the
+    `start` of the window the definition is kept, and at the end it is left out."""
+    for i, line in enumerate(edge[: slack + 1 + start]):
+        if (i > 0 or not start) and language.is_definition(line):
+            return i - start
+    for i, line in enumerate(edge[: slack + 1]):
+        if not line.strip():
+            return i
+    return 0
+
+
+def _header_end(view: DocumentView, language: lang.Language, max_lines: int) -> int:
+    """The line after the header of the file, which ends at its first definition (0 if it
+    has none that fits)."""
+    for i, line in enumerate(_lines_from(view, 0, 1)):
+        if i > max_lines:
+            return 0
+        if language.is_definition(line):
+            return i
+    return 0
+
+
+def _prefix_fits(
+    text: str, options: WindowOptions, count_tokens: Callable[[str], int]
+) -> bool:
+    """Whether `text` is within the character and token limits of the prefix."""
+    if options.prefix_chars is not None and len(text) > options.prefix_chars:
+        return False
+    return options.prefix_tokens is None or count_tokens(text) <= options.prefix_tokens
+
+
+def _window(
+    view: DocumentView,
+    cursor: int,
+    language: lang.Language,
+    options: WindowOptions,
+    count_tokens: Callable[[str], int],
+) -> tuple[str, str]:
+    """The text before and after `cursor`, limited by `options`."""
+    position = view.position_at(cursor)
+    line_start = view.line_start(position.line)
+    cursor_line_end = view.line_end(position.line)
+
+    def window_start(used: str) -> int:
+        before = _window_lines(
+            _lines_from(view, position.line - 1, -1),
+            used,
+            options.prefix_lines,
+            options.prefix_chars,
+            options.prefix_tokens,
+            count_tokens,
+        )
+        start = position.line - len(before)
+        if start > 0:
+            edge = [view[start - 1], *reversed(before)]
+            start += _snap(edge, language, int(len(before) * options.snap), start=True)
+        return start
+
+    cursor_line = view.text(line_start, cursor)
+    start = window_start(cursor_line)
+    header = ""
+    if start > 0:
+        header_end = _header_end(view, language, options.header_lines)
+        if header_end >= start:
+            # The window reaches the header: it starts at the top, if the rest fits
+            if _prefix_fits(view.text(0, cursor), options, count_tokens):
+                start = 0
+        elif header_end > 0:
+            header = view.text(0, view.line_start(header_end)).rstrip() + "\n\n"
+            header += f"{language.comment('...')}\n\n"
+            if not _prefix_fits(header + cursor_line, options, count_tokens):
+                header = ""
+            elif options.prefix_chars is not None or options.prefix_tokens is not None:
+                # The header takes its share of the limits from the window
+                start_below = window_start(header + cursor_line)
+                if start_below <= header_end:
+                    header, start = "", 0
+                elif not view.text(view.line_start(start_below), cursor).strip():
+                    # It would leave no room for the text before the cursor
+                    header = ""
+                else:
+                    start = start_below
+
+    after = _window_lines(
+        _lines_from(view, position.line + 1, 1),
+        view.text(cursor, cursor_line_end),
+        options.suffix_lines,
+        options.suffix_chars,
+        options.suffix_tokens,
+        count_tokens,
+    )
+    end = position.line + 1 + len(after)
+    if end < len(view):
+        edge = [view[end], *reversed(after)]
+        end -= _snap(edge, language, int(len(after) * options.snap), start=False)
+
+    return (
+        header + view.text(view.line_start(start), cursor),
+        view.text(cursor, view.line_start(end)),
+    )
+
+
+def path_proximity(a: Path, b: Path) -> float:
+    """1 for files in the same directory, decreasing as the directories grow apart."""
+    a_parts, b_parts = a.parent.parts, b.parent.parts
+    common = 0
+    for x, y in zip(a_parts, b_parts):
+        if x != y:
+            break
+        common += 1
+    return 1 / (1 + len(a_parts) + len(b_parts) - 2 * common)
+
+
+def rank_files(
+    snapshot: wrk.WorkspaceSnapshot,
+    path: Path,
+    query: set[str],
+) -> list[Path]:
+    """Ranks the files of the workspace (other than `path`) by their relevance to a
+    cursor neighbourhood containing the identifiers in `query`. Only files that share
+    an informative identifier, are in the same directory, or were edited recently are
+    considered."""
+    index = snapshot.index
+    n_files = len(index.by_path)
+    overlap: dict[Path, float] = {}
+    total_weight = 0.0
+    for ident in query:
+        paths = index.postings.get(ident)
+        # Identifiers that appear in most files say nothing about relevance
+        if not paths or len(paths) > max(1, n_files // 2):
+            continue
+        weight = index.idf(ident)
+        total_weight += weight
+        for p in paths:
+            overlap[p] = overlap.get(p, 0.0) + weight
+
+    now = time.monotonic()
+    candidates = overlap.keys() | index.by_dir.get(path.parent, set())
+    candidates |= snapshot.edited_at.keys()
+    scores: dict[Path, float] = {}
+    for p in candidates:
+        if p == path or p not in snapshot.files:
+            continue
+        score = path_weight * path_proximity(p, path)
+        if total_weight:
+            score += identifier_weight * overlap.get(p, 0.0) / total_weight
+        if p in snapshot.edited_at:
+            age = now - snapshot.edited_at[p]
+            score += recency_weight * math.exp(-age / recency_decay)
+        scores[p] = score
+    return sorted(scores, key=scores.__getitem__, reverse=True)
+
+
+def _relevant_excerpt(
+    lines: Sequence[str],
+    query: set[str],
+    index: wrk.IdentifierIndex,
+    language: lang.Language,
+    max_tokens: int,
+    count_tokens: Callable[[str], int],
+) -> str:
+    """Selects the blank-line-separated blocks of `lines` that are most relevant to
+    `query` and fit in `max_tokens`, keeping them in their original order."""
+    blocks: list[list[str]] = [[]]
+    for line in lines:
+        if not line.strip() and blocks[-1]:
+            blocks.append([])
+        blocks[-1].append(line)
+
+    scored: list[tuple[float, int, str]] = []
+    for i, block in enumerate(blocks):
+        text = "".join(block)
+        score = sum(index.idf(ident) for ident in wrk.identifiers(text) & query)
+        if score > 0:
+            scored.append((score, i, text))
+    scored.sort(reverse=True)
+
+    chosen: dict[int, str] = {}
+    remaining = max_tokens
+    for _, i, text in scored:
+        cost = count_tokens(text)
+        if cost <= remaining:
+            chosen[i] = text
+            remaining -= cost
+
+    excerpt: list[str] = []
+    previous = -1
+    for i in sorted(chosen):
+        if i != previous + 1:
+            excerpt.append(f"{language.comment('...')}\n")
+        excerpt.append(chosen[i])
+        previous = i
+    return "".join(excerpt)
+
+
+def assemble_workspace_context(
+    snapshot: wrk.WorkspaceSnapshot,
+    path: Path,
+    neighbourhood: str,
+    max_tokens: int,
+    count_tokens: Callable[[str], int] = estimate_tokens,
+) -> list[str]:
+    """Fills a budget of `max_tokens` with the files (or parts of files) that are most
+    relevant to the text around the cursor. Each file is preceded by a comment with its
+    path, and the most relevant file comes last so that it is closest to the cursor."""
+    query = wrk.identifiers(neighbourhood)
+    sections: list[str] = []
+    remaining = max_tokens
+    for p in rank_files(snapshot, path, query):
+        language = lang.from_extension(p.suffix)
+        header = f"\n{language.comment(p.relative_to(snapshot.root))}\n"
+        header_cost = count_tokens(header)
+        if header_cost >= remaining:
+            break
+        content = snapshot.files[p]
+        text = "".join(content)
+        cost = header_cost + count_tokens(text)
+        if cost > remaining:
+            text = _relevant_excerpt(
+                content,
+                query,
+                snapshot.index,
+                language,
+                remaining - header_cost,
+                count_tokens,
+            )
+            if not text:
+                continue
+            cost = header_cost + count_tokens(text)
+        sections.append(header + text)
+        remaining -= cost
+    sections.reverse()
+    return sections
+
+
+@metrics.timed("get_context")
+def local_context(
+    server: GrimoireServer, params: CompletionParams | InlineCompletionParams
+) -> tuple[str, str]:
+    """The text before and after the cursor, within about `local_context_lines` lines of
+    it, so that its cost does not depend on the size of the file. The completion caches
+    are keyed on it. Its start only moves every `local_context_lines / 2` lines, and its
+    end follows the cursor, so that while the user types into a cached completion the
+    text before the cursor grows and the text after it stays the same."""
+    view = DocumentView.of(server.workspace.text_documents[params.text_document.uri])
+    cursor = view.offset_at(params.position)
+    step = local_context_lines // 2
+    line = params.position.line
+    start = view.line_start(max(0, (line // step - 1) * step))
+    end = view.line_start(line + 1 + step)
+    return view.text(start, cursor), view.text(cursor, end)
 
 
 def get_context(
     server: GrimoireServer,
     params: CompletionParams | InlineCompletionParams,
     include_workspace_context: bool = False,
+    max_workspace_tokens: int | None = None,
+    count_tokens: Callable[[str], int] = estimate_tokens,
+    window: WindowOptions | None = None,
 ) -> tuple[str, str, str]:
     """Returns the content of current file before and after the cursor position.
     If `include_workspace_context` is `True`, the third return value will be the
     content of all other files in the workspace, delimited by comments with their
-    file name (if `False`, it will be an empty string)"""
+    file name (if `False`, it will be an empty string).
+    If `max_workspace_tokens` is set, the workspace context is limited to that many tokens
+    (as measured by `count_tokens`) and only the files that are most relevant to the code
+    around the cursor are included.
+    If `window` is set, only that window of the current file around the cursor is
+    returned (see `WindowOptions`)."""
     uri = params.text_document.uri
+    path = wrk.uri_to_path(uri)
 
-    # Split the current line at the cursor position
-    document = server.workspace.text_documents[uri]
-    lines = list(document.lines)
+    # Split the document at the cursor position
+    view = DocumentView.of(server.workspace.text_documents[uri])
     line_no = params.position.line
-    col = params.position.character
-    cur_line = lines[line_no]
-    before_middle = "".join(lines[:line_no] + [cur_line[:col]])
-    after_middle = "".join([cur_line[col:]] + lines[line_no + 1 :])
+    cursor = view.offset_at(params.position)
+    if window is not None:
+        language = lang.from_extension(path.suffix)
+        before_middle, after_middle = _window(
+            view, cursor, language, window, count_tokens
+        )
+    else:
+        before_middle = view.text(0, cursor)
+        after_middle = view.text(cursor)
 
-    path = wrk.uri_to_path(uri)
     workspace_context: list[str] = []
-    if include_workspace_context:
-        for p, content in wrk.workspace_file_contents(server).items():
-            if p != path:
-                language = lang.from_extension(p.suffix)
-                workspace_context.append(
-                    f"\n{language.comment(p.relative_to(server.workspace.root_path or p.parent))}\n"
+    snapshot = server.workspace_snapshot() if include_workspace_context else None
+    if snapshot is not None:
+        # Other threads may be syncing the snapshot
+        with snapshot.lock:
+            if max_workspace_tokens is not None:
+                neighbourhood = view.text(
+                    view.line_start(line_no - neighbourhood_lines_before),
+                    view.line_start(line_no + neighbourhood_lines_after),
+                )
+                workspace_context = assemble_workspace_context(
+                    snapshot, path, neighbourhood, max_workspace_tokens, count_tokens
                 )
-                workspace_context.extend(content)
+            else:
+                for p, content in snapshot.files.items():
+                    if p != path:
+                        language = lang.from_extension(p.suffix)
+                        workspace_context.append(
+                            f"\n{language.comment(p.relative_to(server.workspace.root_path or p.parent))}\n"
+                        )
+                        workspace_context.extend(content)
 
     if workspace_context:
         #  Add a comment to delimit the current file
@@ -0,0 +1,215 @@
+"""Serves many editor sessions from one long-running process, over TCP or a Unix socket.
+
+Each connection gets its own server loaded from the config, but the sessions share the
+workspace snapshots, caches, request scheduler and backend connections, so another
+editor window does not repeat the startup or the scan of the workspace.
+`python -m grimoire_ls.run --daemon` relays the editor's stdio to the daemon (and starts
+the daemon if it is not running yet), so editors are configured as usual."""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import io
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import TYPE_CHECKING, cast
+
+from . import metrics
+from .logging import Level, log
+
+if TYPE_CHECKING:
+    from .server import GrimoireServer
+
+logger = logging.getLogger(__name__)
+
+
+def default_address() -> str:
+    """A Unix socket in `$XDG_RUNTIME_DIR` (or the temporary directory), or a local TCP
+    port on Windows."""
+    if os.name == "nt":
+        return "127.0.0.1:7437"
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(runtime_dir, f"grimoire-ls-{os.getuid()}.sock")
+
+
+def _parse_address(address: str) -> tuple[str, int] | str:
+    """`host:port` for TCP, anything else is the path of a Unix socket."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return host, int(port)
+    return address
+
+
+def _connect(address: str) -> socket.socket:
+    parsed = _parse_address(address)
+    if isinstance(parsed, tuple):
+        return socket.create_connection(parsed)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(parsed)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class Daemon:
+    """Accepts LSP clients on a socket and serves each one with its own server."""
+
+    # Seconds without any session after which the daemon exits (`None` to run forever)
+    idle_timeout: float | None
+    sessions: int
+
+    def __init__(self, idle_timeout: float | None = 600.0):
+        self.idle_timeout = idle_timeout
+        self.sessions = 0
+        # The server of the first session, which holds the state shared by all sessions
+        self._shared: GrimoireServer | None = None
+        self._server: asyncio.Server | None = None
+        self._idle_timer: asyncio.TimerHandle | None = None
+
+    def _start_idle_timer(self):
+        if self.idle_timeout is not None and self._server is not None:
+            self._idle_timer = asyncio.get_running_loop().call_later(
+                self.idle_timeout, self._server.close
+            )
+
+    async def _session(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        from pygls.io_ import run_async
+
+        from .server import ConfigError, GrimoireServer
+
+        self.sessions += 1
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        server = None
+        try:
+            server = await GrimoireServer._load_config_in_thread(  # pyright: ignore[reportPrivateUsage]
+                GrimoireServer.config_path()
+            )
+            if self._shared is None:
+                self._shared = server
+            else:
+                server._share_state(self._shared)  # pyright: ignore[reportPrivateUsage]
+            server.protocol.set_writer(writer)
+            await run_async(
+                stop_event=threading.Event(),
+                reader=reader,
+                protocol=server.protocol,
+                logger=logger,
+                error_handler=server.report_server_error,
+            )
+        except SystemExit:
+            # pygls exits the process on `exit`, which should only end this session
+            pass
+        except (ConfigError, OSError) as e:
+            # The config could not be loaded, or the client went away
+            log(f"Session failed: {e}", Level.error)
+        except Exception:
+            log(f"Session failed:\n{traceback.format_exc()}", Level.error)
+            raise
+        finally:
+            writer.close()
+            if server is not None:
+                # The server that handles the session may have changed after a reload
+                current = cast("GrimoireServer", server.protocol._server)  # pyright: ignore[reportPrivateUsage]
+                current.blocking_executor.shutdown()
+            self.sessions -= 1
+            if not self.sessions:
+                self._start_idle_timer()
+
+    async def serve(self, address: str):
+        """Serves clients on `address` until the daemon has been idle for too long."""
+        parsed = _parse_address(address)
+        if isinstance(parsed, tuple):
+            self._server = await asyncio.start_server(self._session, *parsed)
+        else:
+            if Path(parsed).exists():
+                try:
+                    _connect(parsed).close()
+                    raise RuntimeError(f"A daemon is already serving on {parsed}")
+                except ConnectionRefusedError:
+                    # Left behind by a daemon that did not shut down cleanly
+                    os.unlink(parsed)
+            self._server = await asyncio.start_unix_server(self._session, parsed)
+        log(f"Serving on {address}")
+        self._start_idle_timer()
+        try:
+            await self._server.wait_closed()
+        finally:
+            if isinstance(parsed, str) and Path(parsed).exists():
+                os.unlink(parsed)
+
+
+def _start_daemon(address: str):
+    _ = subprocess.Popen(
+        [sys.executable, "-m", "grimoire_ls.daemon", "--listen", address],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def connect_stdio(address: str, start_timeout: float = 10.0):
+    """Relays stdin and stdout to the daemon at `address`, starting it if needed."""
+    try:
+        sock = _connect(address)
+    except OSError:
+        _start_daemon(address)
+        deadline = time.monotonic() + start_timeout
+        while True:
+            time.sleep(0.05)
+            try:
+                sock = _connect(address)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+
+    def upstream():
+        # `read1` returns whatever is available, instead of waiting for a full buffer
+        stdin = cast(io.BufferedReader, sys.stdin.buffer)
+        while chunk := stdin.read1(65536):
+            sock.sendall(chunk)
+        sock.shutdown(socket.SHUT_WR)
+
+    threading.Thread(target=upstream, daemon=True).start()
+    while chunk := sock.recv(65536):
+        _ = sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+    sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="grimoire-ls-daemon")
+    _ = parser.add_argument(
+        "--listen",
+        default=default_address(),
+        help="`host:port` to serve over TCP, or the path of a Unix socket",
+    )
+    _ = parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=600.0,
+        help="exit after this many seconds without sessions (0 to run forever)",
+    )
+    args = parser.parse_args()
+    metrics.export_from_env()
+    try:
+        asyncio.run(Daemon(args.idle_timeout or None).serve(args.listen))
+    except Exception as e:
+        log(e, Level.error)
+        raise
@@ -0,0 +1,219 @@
+"""Minimal edits between two texts, so that a changed range can be updated in place
+instead of being replaced as a whole."""
+
+from __future__ import annotations
+
+import re
+from bisect import bisect_right
+from collections.abc import Sequence
+
+from lsprotocol.types import Position, Range, TextEdit
+
+# (start, end) in the old sequence and (start, end) in the new sequence
+Hunk = tuple[int, int, int, int]
+
+# Only the line breaks that LSP counts
+_line_pattern = re.compile(r"[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+")
+# Changed lines are only diffed character by character if they are this short in total
+_max_char_diff = 4000
+# Ranges with more differences (inserted and deleted items) than this are replaced as a
+# whole by `diff`, as the search takes O(D ** 2) steps even when little else matches
+max_differences = 500
+# Character-level hunks separated by fewer equal characters than this are merged,
+# as edits in the middle of words are harder to follow than one larger edit
+_min_char_gap = 3
+
+
+def split_lines(text: str) -> list[str]:
+    """Splits `text` into lines, keeping the line breaks."""
+    return _line_pattern.findall(text)
+
+
+def _middle_snake[T](
+    a: Sequence[T],
+    a0: int,
+    a1: int,
+    b: Sequence[T],
+    b0: int,
+    b1: int,
+    max_d: int | None = None,
+) -> tuple[int, int, int, int] | None:
+    # Runs the forward and backward searches of Myers' algorithm until they overlap,
+    # and returns the snake where they meet (in coordinates relative to `a0` and `b0`),
+    # or `None` if they did not meet within `max_d` differences each
+    n, m = a1 - a0, b1 - b0
+    delta = n - m
+    odd = delta % 2 != 0
+    offset = n + m + 1
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    for d in range((n + m + 1) // 2 + 1):
+        if max_d is not None and d > max_d:
+            return None
+        for k in range(-d, d + 1, 2):
+            if k == -d or (
+                k != d and forward[offset + k - 1] < forward[offset + k + 1]
+            ):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[a0 + x] == b[b0 + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if (
+                odd
+                and delta - (d - 1) <= k <= delta + (d - 1)
+                and x + backward[offset + delta - k] >= n
+            ):
+                return x0, y0, x, y
+        for k in range(-d, d + 1, 2):
+            if k == -d or (
+                k != d and backward[offset + k - 1] < backward[offset + k + 1]
+            ):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[a1 - 1 - x] == b[b1 - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if (
+                not odd
+                and -d <= delta - k <= d
+                and x + forward[offset + delta - k] >= n
+            ):
+                return n - x, m - y, n - x0, m - y0
+    raise AssertionError("The searches must meet")
+
+
+def diff[T](
+    a: Sequence[T], b: Sequence[T], max_d: int | None = max_differences
+) -> list[Hunk]:
+    """The hunks that turn `a` into `b`, with the fewest inserted and deleted items.
+
+    Uses the linear-space variant of Myers' algorithm, which takes O((N + M) * D) time
+    for a total length of N + M with D differences, and O(N + M) memory. Ranges with more
+    than `max_d` differences (`None` for no limit) are returned as one hunk, after their
+    common start and end."""
+    hunks: list[Hunk] = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        a0, a1, b0, b1 = stack.pop()
+        while a0 < a1 and b0 < b1 and a[a0] == b[b0]:
+            a0 += 1
+            b0 += 1
+        while a0 < a1 and b0 < b1 and a[a1 - 1] == b[b1 - 1]:
+            a1 -= 1
+            b1 -= 1
+        if a0 == a1 or b0 == b1:
+            if a0 < a1 or b0 < b1:
+                hunks.append((a0, a1, b0, b1))
+            continue
+        # Each search covers half of the differences
+        snake = _middle_snake(
+            a, a0, a1, b, b0, b1, None if max_d is None else (max_d + 1) // 2
+        )
+        if snake is None:
+            hunks.append((a0, a1, b0, b1))
+            continue
+        x0, y0, x1, y1 = snake
+        stack.append((a0, a0 + x0, b0, b0 + y0))
+        stack.append((a0 + x1, a1, b0 + y1, b1))
+
+    hunks.sort()
+    merged: list[Hunk] = []
+    for hunk in hunks:
+        if merged and merged[-1][1] == hunk[0] and merged[-1][3] == hunk[2]:
+            merged[-1] = (merged[-1][0], hunk[1], merged[-1][2], hunk[3])
+        else:
+            merged.append(hunk)
+    return merged
+
+
+def _char_hunks(old: str, new: str, a0: int, b0: int) -> list[Hunk]:
+    hunks: list[Hunk] = []
+    for h in diff(old, new):
+        h = (a0 + h[0], a0 + h[1], b0 + h[2], b0 + h[3])
+        if hunks and h[0] - hunks[-1][1] < _min_char_gap:
+            hunks[-1] = (hunks[-1][0], h[1], hunks[-1][2], h[3])
+        else:
+            hunks.append(h)
+    return hunks
+
+
+def text_hunks(old: str, new: str, characters: bool = True) -> list[Hunk]:
+    """The hunks (as character offsets) that turn `old` into `new`. Lines are diffed
+    first, and then (with `characters`) the characters within changed lines."""
+    old_lines, new_lines = split_lines(old), split_lines(new)
+    old_offsets, new_offsets = [0], [0]
+    for line in old_lines:
+        old_offsets.append(old_offsets[-1] + len(line))
+    for line in new_lines:
+        new_offsets.append(new_offsets[-1] + len(line))
+
+    hunks: list[Hunk] = []
+    for a0, a1, b0, b1 in diff(old_lines, new_lines):
+        h = (old_offsets[a0], old_offsets[a1], new_offsets[b0], new_offsets[b1])
+        if (
+            characters
+            and a0 < a1
+            and b0 < b1
+            and (h[1] - h[0]) + (h[3] - h[2]) <= _max_char_diff
+        ):
+            hunks.extend(_char_hunks(old[h[0] : h[1]], new[h[2] : h[3]], h[0], h[2]))
+        else:
+            hunks.append(h)
+    return hunks
+
+
+def text_in_range(lines: Sequence[str], range_: Range) -> str:
+    """The text of a document between the start and the end of `range_`."""
+    start, end = range_.start, range_.end
+
+    def line(i: int) -> str:
+        return lines[i] if i < len(lines) else ""
+
+    if start.line == end.line:
+        return line(start.line)[start.character : end.character]
+    return (
+        line(start.line)[start.character :]
+        + "".join(lines[start.line + 1 : end.line])
+        + line(end.line)[: end.character]
+    )
+
+
+def edits_at(
+    start: Position, old_text: str, new_text: str, characters: bool = True
+) -> list[TextEdit]:
+    """Minimal edits that replace `old_text`, which starts at `start` in a document,
+    with `new_text`."""
+    line_starts = [0]
+    offset = 0
+    for line in split_lines(old_text):
+        offset += len(line)
+        if line.endswith(("\n", "\r")):
+            line_starts.append(offset)
+
+    def position(offset: int) -> Position:
+        i = bisect_right(line_starts, offset) - 1
+        character = offset - line_starts[i]
+        if i == 0:
+            character += start.character
+        return Position(start.line + i, character)
+
+    return [
+        TextEdit(range=Range(position(a0), position(a1)), new_text=new_text[b0:b1])
+        for a0, a1, b0, b1 in text_hunks(old_text, new_text, characters)
+    ]
+
+
+def text_edits(
+    lines: Sequence[str], range_: Range, new_text: str, characters: bool = True
+) -> list[TextEdit]:
+    """Minimal edits that replace the text in `range_` of a document with `new_text`."""
+    return edits_at(range_.start, text_in_range(lines, range_), new_text, characters)
@@ -0,0 +1,141 @@
+"""A read-only view of an open document that finds lines and positions without splitting
+the whole text, so that the cost of taking a window of a large file depends on the size of
+the window rather than the size of the file.
+
+`document.lines` (from `pygls`) splits the whole source on every access, and handlers used
+to copy and re-join it to get the text around the cursor. `DocumentView` keeps the source
+as it is, along with the number of lines before each block of `block_size` characters, so
+that a line can be found by a binary search over the blocks and a scan within one block.
+Lines end with `\\n` (or `\\r\\n`)."""
+
+from __future__ import annotations
+
+import weakref
+from bisect import bisect_left
+from collections.abc import Iterator, Sequence
+from typing import TYPE_CHECKING, overload, override
+
+from lsprotocol.types import Position, Range
+
+if TYPE_CHECKING:
+    from pygls.workspace import TextDocument
+
+# Characters per block of the line index
+block_size = 4096
+
+_views: weakref.WeakKeyDictionary[TextDocument, DocumentView] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _split(text: str) -> list[str]:
+    lines = [line + "\n" for line in text.split("\n")]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        _ = lines.pop()
+    return lines
+
+
+class DocumentView(Sequence[str]):
+    """The lines of a document (including their line breaks), which can also be sliced by
+    offsets and positions."""
+
+    source: str
+
+    def __init__(self, source: str):
+        self.source = source
+        # The number of line breaks before the start of each block (and at the end)
+        self._breaks_before = [0]
+        for start in range(0, len(source), block_size):
+            self._breaks_before.append(
+                self._breaks_before[-1] + source.count("\n", start, start + block_size)
+            )
+        self._n_lines = self._breaks_before[-1] + (
+            1 if source and not source.endswith("\n") else 0
+        )
+
+    @classmethod
+    def of(cls, document: TextDocument) -> DocumentView:
+        """The view of the current version of `document`, which is only built once."""
+        source = document.source
+        view = _views.get(document)
+        if view is None or view.source is not source:
+            view = _views[document] = cls(source)
+        return view
+
+    def line_start(self, line: int) -> int:
+        """The offset of the start of `line` (the end of the document after the last)."""
+        if line <= 0:
+            return 0
+        if line > self._breaks_before[-1]:
+            return len(self.source)
+        # The block that contains the line break before `line`
+        block = bisect_left(self._breaks_before, line) - 1
+        offset = block * block_size
+        for _ in range(line - self._breaks_before[block]):
+            offset = self.source.index("\n", offset) + 1
+        return offset
+
+    def line_end(self, line: int) -> int:
+        """The offset of the end of `line`, after its line break."""
+        start = self.line_start(line)
+        end = self.source.find("\n", start)
+        return len(self.source) if end < 0 else end + 1
+
+    def offset_at(self, position: Position) -> int:
+        """The offset of `position`, which is clamped to its line."""
+        start = self.line_start(position.line)
+        end = self.line_end(position.line)
+        content_end = len(self.source[start:end].rstrip("\r\n")) + start
+        return min(start + max(position.character, 0), content_end)
+
+    def position_at(self, offset: int) -> Position:
+        offset = max(0, min(offset, len(self.source)))
+        block = offset // block_size
+        line = self._breaks_before[block] + self.source.count(
+            "\n", block * block_size, offset
+        )
+        return Position(line, offset - (self.source.rfind("\n", 0, offset) + 1))
+
+    def text(self, start: int = 0, end: int | None = None) -> str:
+        """The text between two offsets (only this part of the source is copied)."""
+        return self.source[start:end]
+
+    def text_in_range(self, range_: Range) -> str:
+        return self.source[self.offset_at(range_.start) : self.offset_at(range_.end)]
+
+    def lines_in_range(self, range_: Range) -> list[str]:
+        """The lines of `range_`, cut at its start and (inclusive) end character, as
+        `workspace.lines_from_range` does."""
+        lines = self[range_.start.line : range_.end.line + 1]
+        if lines:
+            lines[0] = lines[0][range_.start.character :]
+            lines[-1] = lines[-1][: range_.end.character + 1]
+        return lines
+
+    @override
+    def __len__(self) -> int:
+        return self._n_lines
+
+    @overload
+    def __getitem__(self, index: int) -> str: ...
+    @overload
+    def __getitem__(self, index: slice) -> list[str]: ...
+    @override
+    def __getitem__(self, index: int | slice) -> str | list[str]:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._n_lines)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            if start >= stop:
+                return []
+            return _split(self.source[self.line_start(start) : self.line_start(stop)])
+        if index < 0:
+            index += self._n_lines
+        if not 0 <= index < self._n_lines:
+            raise IndexError("line index out of range")
+        return self.source[self.line_start(index) : self.line_end(index)]
+
+    @override
+    def __iter__(self) -> Iterator[str]:
+        return iter(_split(self.source))
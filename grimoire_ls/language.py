@@ -1,3 +1,4 @@
+import re
 from functools import lru_cache
 from pathlib import Path
 from typing import Dict, List, Optional
@@ -10,6 +11,28 @@ class Language:
     extensions: tuple[str, ...]
     comment_prefix: str
     comment_suffix: str = ""
+    # Matches the lines that start a top-level definition (by default, any unindented line
+    # that does not close a bracket)
+    definition_pattern: str = r"[^\s)\]}]"
+    # Matches the lines that can appear in the header of a file before its definitions
+    # (imports, includes, ...), besides comments and blank lines
+    header_pattern: str = ""
+    # Whether the files are source code (and not prose or data)
+    code: bool = True
+
+    def is_definition(self, line: str) -> bool:
+        return re.match(
+            self.definition_pattern, line
+        ) is not None and not self.is_header(line)
+
+    def is_header(self, line: str) -> bool:
+        stripped = line.strip()
+        comment = self.comment_prefix.strip()
+        return (
+            not stripped
+            or bool(comment and stripped.startswith(comment))
+            or bool(self.header_pattern and re.match(self.header_pattern, line))
+        )
 
     @lru_cache
     def uncomment(
@@ -39,8 +62,18 @@ class Language:
 
 
 all_languages: List[Language] = [
-    Language(name="C", extensions=("c",), comment_prefix="// "),
-    Language(name="C++", extensions=("cpp",), comment_prefix="// "),
+    Language(
+        name="C",
+        extensions=("c",),
+        comment_prefix="// ",
+        header_pattern=r"#|/\*|\s*\*",
+    ),
+    Language(
+        name="C++",
+        extensions=("cpp",),
+        comment_prefix="// ",
+        header_pattern=r"#|/\*|\s*\*|using\s",
+    ),
     Language(
         name="CSS",
         extensions=("css",),
@@ -49,31 +82,72 @@ all_languages: List[Language] = [
     ),
     Language(name="Elixir", extensions=("ex",), comment_prefix="# "),
     Language(name="Erlang", extensions=("erl",), comment_prefix="% "),
-    Language(name="Go", extensions=("go",), comment_prefix="// "),
+    Language(
+        name="Go",
+        extensions=("go",),
+        comment_prefix="// ",
+        definition_pattern=r"(func|type|var|const)\b",
+    ),
     Language(
         name="HTML",
         extensions=("html",),
         comment_prefix="<!-- ",
         comment_suffix=" -->",
     ),
-    Language(name="Java", extensions=("java",), comment_prefix="// "),
-    Language(name="JavaScript", extensions=("js",), comment_prefix="// "),
-    Language(name="JSON", extensions=("json",), comment_prefix=""),
+    Language(
+        name="Java",
+        extensions=("java",),
+        comment_prefix="// ",
+        header_pattern=r"(package|import)\s|/\*|\s*\*",
+    ),
+    Language(
+        name="JavaScript",
+        extensions=("js",),
+        comment_prefix="// ",
+        header_pattern=r"import\b|/\*|\s*\*|['\"]use ",
+    ),
+    Language(name="JSON", extensions=("json",), comment_prefix="", code=False),
     Language(name="Julia", extensions=("jl",), comment_prefix="# "),
-    Language(name="Lua", extensions=("lua",), comment_prefix="-- "),
+    Language(
+        name="Lua",
+        extensions=("lua",),
+        comment_prefix="-- ",
+        definition_pattern=r"(local\s+)?function\b",
+    ),
     Language(
         name="Markdown",
         extensions=("md",),
         comment_prefix="<!-- ",
         comment_suffix=" -->",
+        code=False,
+    ),
+    Language(name="Plaintext", extensions=("txt",), comment_prefix="", code=False),
+    Language(
+        name="Python",
+        extensions=("py",),
+        comment_prefix="# ",
+        definition_pattern=r"(async\s+def|def|class)\s|@",
+    ),
+    Language(
+        name="Ruby",
+        extensions=("rb",),
+        comment_prefix="# ",
+        definition_pattern=r"(def|class|module)\s",
+    ),
+    Language(
+        name="Rust",
+        extensions=("rs",),
+        comment_prefix="// ",
+        header_pattern=r"(pub\s+)?(use|mod\s+\w+;)|extern\s|#!\[",
     ),
-    Language(name="Plaintext", extensions=("txt",), comment_prefix=""),
-    Language(name="Python", extensions=("py",), comment_prefix="# "),
-    Language(name="Ruby", extensions=("rb",), comment_prefix="# "),
-    Language(name="Rust", extensions=("rs",), comment_prefix="// "),
     Language(name="SQL", extensions=("sql",), comment_prefix="-- "),
     Language(name="Shell", extensions=("sh",), comment_prefix="# "),
-    Language(name="TypeScript", extensions=("ts",), comment_prefix="// "),
+    Language(
+        name="TypeScript",
+        extensions=("ts",),
+        comment_prefix="// ",
+        header_pattern=r"import\b|/\*|\s*\*|['\"]use ",
+    ),
 ]
 
 by_extension: Dict[str, Language] = {
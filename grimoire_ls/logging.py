@@ -1,6 +1,12 @@
+import atexit
 import os
+import queue
+import reprlib
+import threading
+from dataclasses import dataclass, field
+from enum import IntEnum
 from pathlib import Path
-from typing import Any
+from typing import Any, TextIO
 
 path = Path(
     os.environ.get(
@@ -9,10 +15,161 @@ path = Path(
 )
 
 
-def log(x: Any):
+class Level(IntEnum):
+    debug = 10
+    info = 20
+    warning = 30
+    error = 40
+
+
+def _level_from_env() -> Level:
+    name = os.environ.get("GRIMOIRE_LS_LOG_LEVEL", "info").lower()
+    return Level[name] if name in Level.__members__ else Level.info
+
+
+@dataclass(frozen=True)
+class LogOptions:
+    """Options for the log file."""
+
+    # Messages below this level are dropped before they are formatted
+    level: Level = field(default_factory=_level_from_env)
+    # Longer messages are truncated
+    max_chars: int = 20_000
+    # The log file is rotated when it grows larger than this (`None` to never rotate)
+    max_bytes: int | None = 10_000_000
+    # How many rotated files are kept (`grimoire-ls.log.1`, `grimoire-ls.log.2`, ...)
+    backups: int = 2
+    # Messages that are waiting to be written; more are dropped (and counted)
+    max_queued: int = 10_000
+
+
+_options = LogOptions()
+# Bounds the cost of `repr` for large objects (e.g. the lines of a document)
+_repr = reprlib.Repr()
+_repr.maxstring = _repr.maxother = 1000
+_repr.maxlist = _repr.maxtuple = _repr.maxdict = _repr.maxset = 100
+
+
+class _Writer:
+    """Writes messages to the log file on a background thread, so that logging never
+    waits for the disk."""
+
+    def __init__(self):
+        self.queue: queue.Queue[str | threading.Event] = queue.Queue(
+            _options.max_queued
+        )
+        self.dropped = 0
+        self._file: TextIO | None = None
+        self._size = 0
+        self._thread = threading.Thread(
+            target=self._run, name="grimoire-log", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, message: str):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout: float = 1.0):
+        """Waits until the messages logged so far have been written."""
+        done = threading.Event()
+        try:
+            self.queue.put(done, timeout=timeout)
+        except queue.Full:
+            return
+        _ = done.wait(timeout)
+
+    def _open(self) -> TextIO:
+        if self._file is None:
+            self._file = path.open("a")
+            self._size = self._file.tell()
+        return self._file
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        for i in range(_options.backups, 0, -1):
+            source = path.with_name(f"{path.name}.{i - 1}") if i > 1 else path
+            if source.exists():
+                _ = source.replace(path.with_name(f"{path.name}.{i}"))
+        if not _options.backups:
+            path.unlink(missing_ok=True)
+
+    def _write(self, message: str):
+        f = self._open()
+        _ = f.write(message)
+        self._size += len(message)
+        if _options.max_bytes is not None and self._size > _options.max_bytes:
+            self._rotate()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                # Write everything that is waiting before flushing
+                while True:
+                    if isinstance(item, threading.Event):
+                        if self._file is not None:
+                            self._file.flush()
+                        item.set()
+                    else:
+                        if self.dropped:
+                            dropped, self.dropped = self.dropped, 0
+                            self._write(f"({dropped} messages were dropped)\n")
+                        self._write(item)
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            except OSError:
+                # The log is not worth crashing the server over
+                self._file = None
+            if self._file is not None:
+                self._file.flush()
+
+
+_writer: _Writer | None = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer() -> _Writer:
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = _Writer()
+                _ = atexit.register(_writer.flush)
+    return _writer
+
+
+def configure(options: LogOptions):
+    """Replaces the options of the log (e.g. `configure(LogOptions(level=Level.debug))`)."""
+    global _options
+    _options = options
+
+
+def enabled(level: Level) -> bool:
+    """Whether messages of `level` are logged (to skip building expensive messages)."""
+    return level >= _options.level
+
+
+def log(x: Any, level: Level = Level.info):
     """Log an object to the log file specified by the `GRIMOIRE_LS_LOG` environment variable.
-    If the variable is not set, the log file will be created in the current working directory."""
+    If the variable is not set, the log file will be created in the current working directory.
+    The message is written on a background thread, and dropped if it is below the level
+    set by `GRIMOIRE_LS_LOG_LEVEL` (or `configure`)."""
+    if level < _options.level:
+        return
     if not isinstance(x, str):
-        x = repr(x)
-    with path.open("a") as f:
-        _ = f.write(f"{x}\n")
+        x = _repr.repr(x)
+    if len(x) > _options.max_chars:
+        x = f"{x[: _options.max_chars]}... ({len(x) - _options.max_chars} more characters)"
+    _get_writer().put(f"{x}\n")
+
+
+def flush(timeout: float = 1.0):
+    """Waits until the messages logged so far have been written to the file."""
+    if _writer is not None:
+        _writer.flush(timeout)
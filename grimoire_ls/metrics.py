@@ -0,0 +1,178 @@
+"""Latency histograms and counters for every stage of Grimoire's handlers.
+
+Spans only take two clock reads and an append, so metrics are always collected. They can
+be read with the `grimoire.metrics` command, or written to a file every minute by setting
+`GRIMOIRE_LS_METRICS_FILE` (Prometheus text if it ends in `.prom`, JSON lines otherwise)."""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Any, TypeVar
+
+from .logging import Level, log
+
+T = TypeVar("T")
+
+# How many recent samples each histogram keeps to compute its percentiles
+_max_samples = 2048
+_quantiles = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """The count and sum of all samples, and the percentiles of the most recent ones."""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.samples: deque[float] = deque(maxlen=_max_samples)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+
+    def summary(self) -> dict[str, float]:
+        samples = sorted(self.samples)
+        summary = {"count": self.count, "sum": self.sum}
+        for q in _quantiles:
+            summary[f"p{round(q * 100)}"] = (
+                samples[min(int(q * len(samples)), len(samples) - 1)]
+                if samples
+                else 0.0
+            )
+        return summary
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms: dict[str, Histogram] = {}
+        self.counters: dict[str, int] = {}
+        self.started = time.time()
+
+    def observe(self, name: str, value: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def incr(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Records how long the code in this block takes (in seconds) as `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name: str) -> Callable[[Callable[..., T]], Callable[..., T]]:
+        """Records how long each call of the decorated (non-`async`) function takes."""
+
+        def decorator(f: Callable[..., T]) -> Callable[..., T]:
+            @wraps(f)
+            def wrapped(*args: Any, **kwargs: Any) -> T:
+                with self.span(name):
+                    return f(*args, **kwargs)
+
+            return wrapped
+
+        return decorator
+
+    def snapshot(self) -> dict[str, Any]:
+        """The summaries of all histograms, the counters, and the hit rate of each pair of
+        `<name>.hit` and `<name>.miss` counters."""
+        # Copied first, as handlers may add entries while this runs on another thread
+        histograms = list(self.histograms.items())
+        counters = dict(self.counters)
+        hit_rates: dict[str, float] = {}
+        for name, hits in counters.items():
+            if name.endswith(".hit"):
+                base = name.removesuffix(".hit")
+                total = hits + counters.get(f"{base}.miss", 0)
+                hit_rates[base] = hits / total if total else 0.0
+        return {
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "histograms": {name: h.summary() for name, h in sorted(histograms)},
+            "counters": dict(sorted(counters.items())),
+            "hit_rates": dict(sorted(hit_rates.items())),
+        }
+
+    def prometheus(self) -> str:
+        """The snapshot in the Prometheus text format."""
+        snapshot = self.snapshot()
+        lines: list[str] = []
+        for name, summary in snapshot["histograms"].items():
+            metric = _metric_name(name) + "_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for q in _quantiles:
+                value = summary[f"p{round(q * 100)}"]
+                lines.append(f'{metric}{{quantile="{q}"}} {value}')
+            lines.append(f"{metric}_sum {summary['sum']}")
+            lines.append(f"{metric}_count {summary['count']}")
+        for name, value in snapshot["counters"].items():
+            metric = _metric_name(name) + "_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        for name, value in snapshot["hit_rates"].items():
+            metric = _metric_name(name) + "_hit_rate"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Path):
+        """Writes the metrics to `path` (replacing it if it ends in `.prom`, and appending
+        a JSON line otherwise)."""
+        if path.suffix == ".prom":
+            tmp = path.with_name(f"{path.name}.tmp")
+            _ = tmp.write_text(self.prometheus())
+            _ = tmp.replace(path)
+        else:
+            with path.open("a") as f:
+                _ = f.write(json.dumps(self.snapshot()) + "\n")
+
+
+def _metric_name(name: str) -> str:
+    return "grimoire_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+# Shared by all servers in the process
+registry = Metrics()
+observe = registry.observe
+incr = registry.incr
+span = registry.span
+timed = registry.timed
+
+_export_thread: threading.Thread | None = None
+
+
+def export_from_env(interval: float = 60.0):
+    """Writes the metrics every `interval` seconds to `GRIMOIRE_LS_METRICS_FILE` (if set)."""
+    global _export_thread
+    path = os.environ.get("GRIMOIRE_LS_METRICS_FILE")
+    if not path or _export_thread is not None:
+        return
+
+    def export():
+        while True:
+            time.sleep(interval)
+            try:
+                registry.write(Path(path))
+            except OSError as e:
+                log(f"Could not write metrics to {path}: {e}", Level.warning)
+
+    _export_thread = threading.Thread(
+        target=export, name="grimoire-metrics", daemon=True
+    )
+    _export_thread.start()
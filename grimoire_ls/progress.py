@@ -1,4 +1,16 @@
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Iterator
+from contextlib import contextmanager
 from dataclasses import dataclass, replace
+from typing import TYPE_CHECKING
+from uuid import uuid4
+
+from lsprotocol.types import WorkDoneProgressBegin, WorkDoneProgressEnd
+
+if TYPE_CHECKING:
+    from pygls.lsp.server import LanguageServer
 
 
 @dataclass(frozen=True)
@@ -10,7 +22,80 @@ class ProgressOptions:
     success_message: str = "Success"
     # If `None`, the error message will be used as the failure message.
     failure_message: str | None = None
+    # Only show the progress of tasks that are still running after this many seconds
+    delay: float = 0.3
 
-    def with_attrs(self, **kwargs: str | bool) -> "ProgressOptions":
+    def with_attrs(self, **kwargs: str | bool | float) -> ProgressOptions:
         """Return a new instance with the given attributes replaced."""
         return replace(self, **kwargs)
+
+
+@dataclass
+class TrackedTask:
+    # The message shown when the progress ends
+    message: str | None = None
+
+
+class _Group:
+    def __init__(self):
+        self.running = 0
+        self.timer: asyncio.TimerHandle | None = None
+        # Resolves to the token once the progress has been created in the client
+        self.shown: asyncio.Future[str] | None = None
+
+
+class ProgressReporter:
+    """Reports the progress of tasks to the client without delaying them.
+
+    The progress is only created (which takes a round-trip to the client) for tasks that
+    are still running after `ProgressOptions.delay` seconds, so quick tasks send nothing.
+    Tasks of the same name that run at the same time share one progress."""
+
+    def __init__(self, server: LanguageServer):
+        self._server = server
+        self._groups: dict[str, _Group] = {}
+
+    async def _show(self, title: str) -> str:
+        token = str(uuid4())
+        progress = self._server.work_done_progress
+        _ = await progress.create_async(token)  # pyright: ignore[reportUnknownVariableType]
+        progress.begin(token, WorkDoneProgressBegin(title=title, cancellable=False))
+        return token
+
+    def _end(self, shown: asyncio.Future[str], message: str | None):
+        def end(_: asyncio.Future[str]):
+            if shown.cancelled() or shown.exception() is not None:
+                return
+            self._server.work_done_progress.end(
+                shown.result(), WorkDoneProgressEnd(message=message)
+            )
+
+        shown.add_done_callback(end)
+
+    @contextmanager
+    def track(self, options: ProgressOptions) -> Iterator[TrackedTask]:
+        """Tracks the code in this block as a task. Set `message` on the task that is
+        yielded to choose the message that the progress ends with."""
+        title = options.task_name or "Grimoire Task"
+        group = self._groups.get(title)
+        if group is None:
+            group = self._groups[title] = _Group()
+        group.running += 1
+        if group.timer is None and group.shown is None:
+
+            def show():
+                group.shown = asyncio.ensure_future(self._show(title))
+
+            group.timer = asyncio.get_running_loop().call_later(options.delay, show)
+
+        task = TrackedTask()
+        try:
+            yield task
+        finally:
+            group.running -= 1
+            if not group.running:
+                del self._groups[title]
+                if group.timer is not None:
+                    group.timer.cancel()
+                if group.shown is not None:
+                    self._end(group.shown, task.message)
@@ -0,0 +1,332 @@
+"""Records the traffic between a grimoire and its model server, and replays it later.
+
+`record` runs a proxy in front of an OpenAI-compatible server, which writes every request
+and response (including when each streamed event arrived) to a trace. `replay` serves the
+responses of a trace with their original timing (or scaled), so that a session can be rerun
+offline with the same model behaviour, e.g. against a newer version of `grimoire_ls`:
+
+    python -m grimoire_ls.replay record --upstream http://localhost:7777/v1 --trace s.jsonl.gz
+    python -m grimoire_ls.replay replay --trace s.jsonl.gz --time-scale 0.5
+
+Point the grimoire's client (e.g. `OpenAI(base_url=...)` or `BackendOptions.base_url`) at
+the printed URL instead of the model server."""
+
+from __future__ import annotations
+
+import abc
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import time
+from collections import deque
+from collections.abc import AsyncIterator
+from pathlib import Path
+from typing import IO, Any, cast
+
+from .backend import BackendError, BackendOptions, OpenAIBackend
+from .logging import Level, log
+
+# [seconds since the request, event]
+TimedEvent = tuple[float, dict[str, Any]]
+
+
+def request_key(path: str, body: dict[str, Any]) -> str:
+    """Identifies a request, regardless of whether it was streamed."""
+    body = {k: v for k, v in body.items() if k != "stream"}
+    data = json.dumps([path, body], sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def _open_trace(path: Path, mode: str) -> IO[str]:
+    if path.suffix == ".gz":
+        # `gzip.open` is only typed as returning text for literal modes
+        return cast(IO[str], gzip.open(path, mode + "t", encoding="utf-8"))
+    return path.open(mode, encoding="utf-8")
+
+
+def load_trace(path: Path) -> list[dict[str, Any]]:
+    with _open_trace(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _is_chat(path: str) -> bool:
+    return path.endswith("/chat/completions")
+
+
+def _event_text(event: dict[str, Any]) -> str:
+    choice = (event.get("choices") or [{}])[0]
+    return choice.get("text") or (choice.get("delta") or {}).get("content") or ""
+
+
+def _response_from_events(path: str, events: list[TimedEvent]) -> dict[str, Any]:
+    text = "".join(_event_text(event) for _, event in events)
+    if _is_chat(path):
+        return {
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}}]
+        }
+    return {"choices": [{"index": 0, "text": text}]}
+
+
+def _events_from_response(
+    path: str, response: dict[str, Any], duration: float
+) -> list[TimedEvent]:
+    choice = (response.get("choices") or [{}])[0]
+    if _is_chat(path):
+        content = (choice.get("message") or {}).get("content") or ""
+        event = {"choices": [{"index": 0, "delta": {"content": content}}]}
+    else:
+        event = {"choices": [{"index": 0, "text": choice.get("text") or ""}]}
+    return [(duration, event)]
+
+
+class _HttpWriter:
+    """Writes JSON responses and server-sent events over HTTP/1.1."""
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.started = False
+
+    async def json(self, status: int, data: dict[str, Any]):
+        body = json.dumps(data).encode()
+        self.started = True
+        self.writer.write(
+            f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\n".encode()
+            + b"Content-Type: application/json\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+        await self.writer.drain()
+
+    def _chunk(self, text: str):
+        data = text.encode()
+        self.writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    async def event(self, event: dict[str, Any]):
+        if not self.started:
+            self.started = True
+            self.writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                + b"Transfer-Encoding: chunked\r\n\r\n"
+            )
+        self._chunk(f"data: {json.dumps(event)}\n\n")
+        await self.writer.drain()
+
+    async def end_events(self):
+        if not self.started:
+            await self.event({"choices": []})
+        self._chunk("data: [DONE]\n\n")
+        self.writer.write(b"0\r\n\r\n")
+        await self.writer.drain()
+
+
+class ModelProxy(abc.ABC):
+    """An OpenAI-compatible HTTP server on `127.0.0.1` that answers with `handle`."""
+
+    def __init__(self):
+        self._server: asyncio.Server | None = None
+        self._connections: set[asyncio.StreamWriter] = set()
+
+    @property
+    def base_url(self) -> str:
+        assert self._server is not None, "The server is not running"
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}/v1"
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self._server = await asyncio.start_server(self._serve, host, port)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            for writer in self._connections:
+                writer.close()
+            await self._server.wait_closed()
+
+    @abc.abstractmethod
+    async def handle(
+        self, path: str, body: dict[str, Any], response: _HttpWriter
+    ) -> None: ...
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(writer)
+        try:
+            while request_line := await reader.readline():
+                headers: dict[str, str] = {}
+                while (line := await reader.readline()).strip():
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                # Paths are relative to the base URL, which ends in `/v1`
+                path = request_line.split()[1].decode().removeprefix("/v1")
+                response = _HttpWriter(writer)
+                await self.handle(path, json.loads(body or b"{}"), response)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+
+class Recorder(ModelProxy):
+    """Forwards requests to the model server, and appends each exchange to a trace."""
+
+    def __init__(self, upstream: BackendOptions, trace: Path):
+        super().__init__()
+        self.backend = OpenAIBackend(upstream)
+        self.trace = trace
+        self.recorded = 0
+        self._file = _open_trace(trace, "a")
+        self._start = time.monotonic()
+
+    async def close(self):
+        await super().close()
+        self._file.close()
+
+    async def _events(
+        self, path: str, params: dict[str, Any], start: float
+    ) -> AsyncIterator[TimedEvent]:
+        async for event in self.backend.stream(path, **params):
+            yield round(time.perf_counter() - start, 4), event
+
+    async def handle(self, path: str, body: dict[str, Any], response: _HttpWriter):
+        params = {k: v for k, v in body.items() if k != "stream"}
+        record: dict[str, Any] = {
+            "time": round(time.monotonic() - self._start, 4),
+            "path": path,
+            "key": request_key(path, body),
+            "request": body,
+        }
+        start = time.perf_counter()
+        try:
+            if body.get("stream"):
+                events: list[TimedEvent] = []
+                async for timed_event in self._events(path, params, start):
+                    events.append(timed_event)
+                    await response.event(timed_event[1])
+                await response.end_events()
+                record["events"] = events
+            else:
+                record["response"] = await self.backend.request(path, **params)
+                await response.json(200, record["response"])
+        except BackendError as e:
+            record["error"] = str(e)
+            if not response.started:
+                await response.json(502, {"error": {"message": str(e)}})
+        finally:
+            record["duration"] = round(time.perf_counter() - start, 4)
+            _ = self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self._file.flush()
+            self.recorded += 1
+
+
+class Replayer(ModelProxy):
+    """Answers requests with the responses of a trace.
+
+    A request gets the response that was recorded for the same request. Requests that were
+    not recorded (e.g. because a newer version builds different prompts) get the responses
+    recorded for the same endpoint, in the order they were recorded."""
+
+    def __init__(self, records: list[dict[str, Any]], time_scale: float = 1.0):
+        super().__init__()
+        # Delays are multiplied by this (0 answers right away)
+        self.time_scale = time_scale
+        self.matched = 0
+        self.unmatched = 0
+        self._by_key: dict[str, deque[dict[str, Any]]] = {}
+        self._by_path: dict[str, list[dict[str, Any]]] = {}
+        self._next: dict[str, int] = {}
+        for record in records:
+            self._by_key.setdefault(record["key"], deque()).append(record)
+            self._by_path.setdefault(record["path"], []).append(record)
+
+    def find(self, path: str, body: dict[str, Any]) -> dict[str, Any] | None:
+        same = self._by_key.get(request_key(path, body))
+        if same:
+            self.matched += 1
+            # Repeated requests get the recorded responses in turn, and then the last one
+            return same.popleft() if len(same) > 1 else same[0]
+        recorded = self._by_path.get(path)
+        if not recorded:
+            return None
+        self.unmatched += 1
+        i = self._next.get(path, 0)
+        self._next[path] = (i + 1) % len(recorded)
+        return recorded[i]
+
+    async def _wait_until(self, start: float, delay: float):
+        await asyncio.sleep(
+            max(0.0, start + delay * self.time_scale - time.perf_counter())
+        )
+
+    async def handle(self, path: str, body: dict[str, Any], response: _HttpWriter):
+        start = time.perf_counter()
+        record = self.find(path, body)
+        if record is None:
+            await response.json(404, {"error": {"message": f"No recordings of {path}"}})
+            return
+        if "error" in record:
+            await self._wait_until(start, record["duration"])
+            await response.json(502, {"error": {"message": record["error"]}})
+            return
+
+        if "events" in record:
+            events: list[TimedEvent] = record["events"]
+        else:
+            events = _events_from_response(path, record["response"], record["duration"])
+        if body.get("stream"):
+            for delay, event in events:
+                await self._wait_until(start, delay)
+                await response.event(event)
+            await response.end_events()
+        else:
+            await self._wait_until(start, record["duration"])
+            await response.json(
+                200, record.get("response") or _response_from_events(path, events)
+            )
+
+
+async def _serve(proxy: ModelProxy, listen: str):
+    host, _, port = listen.rpartition(":")
+    await proxy.start(host or "127.0.0.1", int(port))
+    log(f"Serving the model on {proxy.base_url}")
+    print(f"Serving the model on {proxy.base_url}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await proxy.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="grimoire-ls-replay")
+    commands = parser.add_subparsers(dest="command", required=True)
+    record = commands.add_parser("record", help="record the traffic to a model server")
+    _ = record.add_argument("--upstream", required=True, help="base URL of the model")
+    replay = commands.add_parser("replay", help="serve the responses of a trace")
+    _ = replay.add_argument(
+        "--time-scale",
+        type=float,
+        default=1.0,
+        help="multiplies the recorded delays (0 to answer right away)",
+    )
+    for command in (record, replay):
+        _ = command.add_argument(
+            "--trace", type=Path, required=True, help="JSON lines, gzipped if `.gz`"
+        )
+        _ = command.add_argument("--listen", default="127.0.0.1:8079", help="host:port")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        proxy = Recorder(BackendOptions(base_url=args.upstream), args.trace)
+    else:
+        proxy = Replayer(load_trace(args.trace), args.time_scale)
+    try:
+        asyncio.run(_serve(proxy, args.listen))
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        log(e, Level.error)
+        raise
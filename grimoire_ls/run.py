@@ -1,10 +1,61 @@
-from .logging import log
-from .server import GrimoireServer
+import argparse
+import os
+from contextlib import nullcontext
+
+from . import metrics
+from .logging import Level, log
+from .startup import StartupReport
 
 if __name__ == "__main__":
-    try:
-        server = GrimoireServer.from_config()
-        server.start_io()
-    except Exception as e:
-        log(e)
-        raise e
+    parser = argparse.ArgumentParser(prog="grimoire-ls")
+    _ = parser.add_argument(
+        "--defer-config",
+        action="store_true",
+        default=bool(os.environ.get("GRIMOIRE_LS_DEFER_CONFIG")),
+        help="answer `initialize` before the config is loaded, "
+        "using the capabilities it registered last time",
+    )
+    _ = parser.add_argument(
+        "--watch-config",
+        action="store_true",
+        default=bool(os.environ.get("GRIMOIRE_LS_WATCH_CONFIG")),
+        help="reload the config whenever it changes",
+    )
+    _ = parser.add_argument(
+        "--startup-report",
+        action="store_true",
+        help="log how long each phase of the startup took, and the slowest imports",
+    )
+    _ = parser.add_argument(
+        "--daemon",
+        action="store_true",
+        default=bool(os.environ.get("GRIMOIRE_LS_DAEMON")),
+        help="connect to a shared daemon (started if needed) instead of serving here",
+    )
+    _ = parser.add_argument(
+        "--daemon-address",
+        default=os.environ.get("GRIMOIRE_LS_DAEMON_ADDRESS"),
+        help="`host:port` or Unix socket path of the daemon",
+    )
+    args = parser.parse_args()
+    if args.daemon:
+        from .daemon import connect_stdio, default_address
+
+        connect_stdio(args.daemon_address or default_address())
+    else:
+        report = StartupReport() if args.startup_report else StartupReport.from_env()
+        phase = report.phase if report else lambda _: nullcontext()
+        try:
+            metrics.export_from_env()
+            with phase("import grimoire_ls.server"):
+                from .server import GrimoireServer
+            with phase("load config"):
+                server = GrimoireServer.from_config(
+                    defer=args.defer_config, watch=args.watch_config
+                )
+            if report:
+                report.log()
+            server.start_io()
+        except Exception as e:
+            log(e, Level.error)
+            raise e
@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import TypeVar
+
+from .threads import StillRunning
+
+T = TypeVar("T")
+
+
+class Debouncer:
+    """Runs at most one request per key (e.g. per document) at a time.
+
+    A new request for a key cancels the one that is still pending or running for it,
+    and each request waits for `delay` seconds before it starts so that bursts of
+    requests (e.g. while the user is typing) only reach the model once."""
+
+    delay: float
+    _tasks: dict[str, asyncio.Task[object]]
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self._tasks = {}
+
+    async def _delayed(self, f: Callable[[], Awaitable[T]]) -> T:
+        if self.delay > 0:
+            await asyncio.sleep(self.delay)
+        return await f()
+
+    def cancel(self, key: str):
+        """Cancels the request for `key`, if there is one."""
+        task = self._tasks.pop(key, None)
+        if task is not None:
+            _ = task.cancel()
+
+    async def run(self, key: str, f: Callable[[], Awaitable[T]]) -> T | None:
+        """Runs `f` once the delay has passed, unless a newer request for `key` arrives first.
+        Returns `None` if the request was superseded. If the calling task is cancelled
+        (e.g. by `$/cancelRequest`), the cancellation is propagated into `f`."""
+        self.cancel(key)
+        task = asyncio.ensure_future(self._delayed(f))
+        self._tasks[key] = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            current = asyncio.current_task()
+            if current is not None and current.cancelling():
+                raise
+            # Only the inner task was cancelled, so a newer request took its place
+            return None
+        finally:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+
+
+def _call_soon(
+    loop: asyncio.AbstractEventLoop, f: Callable[..., object], *args: object
+):
+    """Calls `f` on `loop` from another thread, unless the loop is already closed."""
+    try:
+        _ = loop.call_soon_threadsafe(f, *args)
+    except RuntimeError:
+        pass
+
+
+class Priority(IntEnum):
+    """The priority of a request to a model (lower values are served first)."""
+
+    completion = 0
+    code_action = 1
+    background = 2
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed because too many requests are already waiting."""
+
+
+@dataclass
+class WaitStats:
+    """How long requests of one priority waited for a free slot (in seconds)."""
+
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    shed: int = 0
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def record(self, wait: float):
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: Priority
+    seq: int
+    future: asyncio.Future[None] = field(compare=False)
+
+
+class _Backend:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.running = 0
+        self.waiters: list[_Waiter] = []
+
+
+class RequestScheduler:
+    """Limits how many requests run concurrently against each backend (model server),
+    and serves waiting requests in order of priority (completions before code actions
+    before background work).
+
+    Requests of a priority with a `max_waiting` limit are shed (i.e. `Overloaded` is
+    raised) instead of queued once that many requests of the same priority are waiting."""
+
+    default_limit: int
+    limits: dict[str, int]
+    max_waiting: dict[Priority, int]
+    wait_stats: dict[Priority, WaitStats]
+
+    def __init__(
+        self,
+        limits: dict[str, int] | None = None,
+        default_limit: int = 2,
+        max_waiting: dict[Priority, int] | None = None,
+    ):
+        self.default_limit = default_limit
+        self.limits = limits or {}
+        self.max_waiting = (
+            {Priority.background: 4} if max_waiting is None else max_waiting
+        )
+        self.wait_stats = {priority: WaitStats() for priority in Priority}
+        self._backends: dict[str, _Backend] = {}
+        self._seq = itertools.count()
+
+    def reconfigure(self, other: RequestScheduler):
+        """Applies the limits of `other` to this scheduler, keeping the requests that are
+        running or waiting."""
+        self.default_limit = other.default_limit
+        self.limits = other.limits
+        self.max_waiting = other.max_waiting
+        for name, backend in self._backends.items():
+            backend.limit = self.limits.get(name, self.default_limit)
+            # A higher limit frees slots for the requests that are waiting
+            while backend.running < backend.limit and backend.waiters:
+                waiter = heapq.heappop(backend.waiters)
+                if not waiter.future.done():
+                    backend.running += 1
+                    waiter.future.set_result(None)
+
+    def _backend(self, name: str) -> _Backend:
+        backend = self._backends.get(name)
+        if backend is None:
+            backend = self._backends[name] = _Backend(
+                self.limits.get(name, self.default_limit)
+            )
+        return backend
+
+    def waiting(self, priority: Priority | None = None) -> int:
+        """How many requests (of `priority`, if given) are waiting for a slot."""
+        return sum(
+            not waiter.future.done()
+            and (priority is None or waiter.priority == priority)
+            for backend in self._backends.values()
+            for waiter in backend.waiters
+        )
+
+    async def _acquire(self, name: str, priority: Priority):
+        backend = self._backend(name)
+        # Drop the requests that were cancelled while they were waiting
+        while backend.waiters and backend.waiters[0].future.done():
+            _ = heapq.heappop(backend.waiters)
+        if backend.running < backend.limit and not backend.waiters:
+            backend.running += 1
+            self.wait_stats[priority].record(0.0)
+            return
+
+        max_waiting = self.max_waiting.get(priority)
+        if max_waiting is not None and self.waiting(priority) >= max_waiting:
+            self.wait_stats[priority].shed += 1
+            raise Overloaded(
+                f"Too many {priority.name} requests are waiting for {name}"
+            )
+
+        start = time.monotonic()
+        waiter = _Waiter(
+            priority, next(self._seq), asyncio.get_running_loop().create_future()
+        )
+        heapq.heappush(backend.waiters, waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # The slot was handed over just before the cancellation
+                self._release(name)
+            raise
+        self.wait_stats[priority].record(time.monotonic() - start)
+
+    def _release(self, name: str):
+        backend = self._backends[name]
+        while backend.waiters:
+            waiter = heapq.heappop(backend.waiters)
+            if not waiter.future.done():
+                # Hand the slot over directly, so that it cannot be taken by a newcomer
+                waiter.future.set_result(None)
+                return
+        backend.running -= 1
+
+    async def run(
+        self,
+        f: Callable[[], Awaitable[T]],
+        priority: Priority = Priority.completion,
+        backend: str = "default",
+    ) -> T:
+        """Runs `f` once a slot for `backend` is free and no request with a higher
+        priority is waiting for it."""
+        await self._acquire(backend, priority)
+        try:
+            result = await f()
+        except StillRunning as e:
+            # The call goes on after its cancellation, so it keeps the slot until it is done
+            loop = asyncio.get_running_loop()
+            e.future.add_done_callback(
+                lambda _: _call_soon(loop, self._release, backend)
+            )
+            raise
+        except BaseException:
+            self._release(backend)
+            raise
+        self._release(backend)
+        return result
@@ -1,59 +1,220 @@
 from __future__ import annotations
 
+import asyncio
+import copy
 import importlib.util
+import inspect
+import json
 import os
-from collections.abc import Awaitable
-from functools import wraps
+import threading
+import time
+from collections.abc import AsyncIterator, Awaitable, Sequence
+from concurrent.futures import Future
+from dataclasses import replace
+from functools import cache, wraps
 from pathlib import Path
-from typing import Any, Callable
+from typing import TYPE_CHECKING, Any, Callable, cast
 from uuid import uuid4
 
+from lsprotocol import converters
 from lsprotocol.types import (
+    CODE_ACTION_RESOLVE,
+    INITIALIZE,
+    INITIALIZED,
     TEXT_DOCUMENT_CODE_ACTION,
     TEXT_DOCUMENT_COMPLETION,
     TEXT_DOCUMENT_INLINE_COMPLETION,
+    WORKSPACE_DID_CHANGE_WATCHED_FILES,
+    ApplyWorkspaceEditParams,
+    ApplyWorkspaceEditResult,
     CodeAction,
+    CodeActionOptions,
     CodeActionParams,
-    Command,
     CompletionItem,
     CompletionList,
     CompletionOptions,
     CompletionParams,
     CompletionItemDefaults,
+    DidChangeWatchedFilesParams,
+    DidChangeWatchedFilesRegistrationOptions,
     EditRangeWithInsertReplace,
+    FileChangeType,
+    FileSystemWatcher,
+    InitializeParams,
+    InitializedParams,
     InlineCompletionItem,
     InlineCompletionList,
     InlineCompletionOptions,
     InlineCompletionParams,
+    MessageType,
+    OptionalVersionedTextDocumentIdentifier,
     Range,
+    Registration,
+    RegistrationParams,
+    ShowMessageParams,
+    TextDocumentEdit,
+    TextEdit,
     WorkDoneProgressBegin,
     WorkDoneProgressEnd,
+    WorkDoneProgressReport,
+    WorkspaceEdit,
 )
 from pygls.lsp.server import LanguageServer
 from result import Err, Ok, Result
 
-from . import code_actions, logging
-from .code_actions import ActionOptions, TransformFn
-from .progress import ProgressOptions
+from . import logging, metrics, scheduling, startup, threads
+from .cache import CacheOptions, CompletionCache, PersistentCache, PersistOptions
+from .document import DocumentView
+from . import workspace as wrk
+from .progress import ProgressOptions, ProgressReporter
+from .scheduling import Overloaded, Priority
+
+# The modules of the features (e.g. `code_actions`, which builds pydantic models) are
+# imported where they are used, so that a deferred config (see `from_config`) can answer
+# `initialize` without them
+if TYPE_CHECKING:
+    from . import batch, code_actions
+    from .code_actions import (
+        ActionOptions,
+        CodeActionIndex,
+        StreamingTransformFn,
+        SyncTransformFn,
+        TransformFn,
+    )
+    from .streaming import StopOptions
+
+# Runs the user's config again (see `GrimoireServer.reload_config`)
+reload_config_command = "grimoire.reloadConfig"
+# Returns the latency histograms, counters and cache hit rates (see `metrics`)
+metrics_command = "grimoire.metrics"
+
+
+class ConfigError(Exception):
+    """The user's config could not be loaded."""
+
+
+@cache
+def _converter():
+    return converters.get_converter()
+
+
+def _completion_item_text(item: CompletionItem) -> str | None:
+    # Items with their own edit range cannot be shortened safely
+    if item.text_edit is not None:
+        return None
+    return item.text_edit_text or item.insert_text or item.label
+
+
+def _with_completion_item_text(item: CompletionItem, text: str) -> CompletionItem:
+    old_text = _completion_item_text(item)
+    new_item = copy.copy(item)
+    for attr in ("label", "insert_text", "text_edit_text"):
+        if getattr(item, attr) == old_text:
+            setattr(new_item, attr, text)
+    return new_item
+
+
+def _inline_completion_item_text(item: InlineCompletionItem) -> str | None:
+    if item.range is not None or not isinstance(item.insert_text, str):
+        return None
+    return item.insert_text
+
+
+def _with_inline_completion_item_text(
+    item: InlineCompletionItem, text: str
+) -> InlineCompletionItem:
+    new_item = copy.copy(item)
+    new_item.insert_text = text
+    return new_item
 
 
 class GrimoireServer(LanguageServer):
     default_progress_options: ProgressOptions
-    code_actions: list[ActionOptions]
+    progress_reporter: ProgressReporter
+    # Seconds that completion requests wait for newer requests before reaching the model
+    default_debounce: float
+    # Runs synchronous (blocking) handlers without stalling the event loop
+    blocking_executor: threads.BlockingExecutor
+    # Shares the model slots of each backend between completions, code actions and background work
+    scheduler: scheduling.RequestScheduler
+    _code_action_index: CodeActionIndex | None
+    # Starts speculative code actions before the user picks them
+    _speculator: code_actions.Speculator | None
+    # How many speculative code actions to start for one selection
+    max_speculative_actions: int
+    _speculative_transforms: dict[str, TransformFn]
+    _batch_transforms: dict[str, TransformFn]
+    # The result caches of the completion handlers, by the name of the handler
+    completion_caches: dict[str, CompletionCache[Any]]
+    # The snapshots of the workspaces, by their root (shared with other servers in a daemon)
+    _workspace_snapshots: dict[Path, wrk.WorkspaceSnapshot]
+    _workspace_snapshots_lock: threading.Lock
+    _persistent_cache: PersistentCache | None
+    _persistent_cache_path: Path | None
+    _config_watcher: asyncio.Future[None] | None
 
     def __init__(
         self,
         name: str = "grimoire-ls",
         version: str = "v0.1",
         default_progress_options: ProgressOptions | None = None,
+        default_debounce: float = 0.0,
+        max_blocking_workers: int = 4,
+        concurrency_limits: dict[str, int] | None = None,
+        default_concurrency_limit: int = 2,
+        persistent_cache_path: Path | None = None,
+        max_speculative_actions: int = 2,
         **kwargs: Any,
     ):
-        self.code_actions = []
+        self._code_action_index = None
+        self._speculator = None
+        self.max_speculative_actions = max_speculative_actions
+        self._speculative_transforms = {}
+        self._batch_transforms = {}
+        self.completion_caches = {}
+        self.default_debounce = default_debounce
+        self.blocking_executor = threads.BlockingExecutor(max_blocking_workers)
+        self.scheduler = scheduling.RequestScheduler(
+            concurrency_limits, default_concurrency_limit
+        )
+        self._workspace_snapshots = {}
+        self._workspace_snapshots_lock = threading.Lock()
+        self._persistent_cache = None
+        self._persistent_cache_path = persistent_cache_path
+        self._config_watcher = None
         self.default_progress_options = default_progress_options or ProgressOptions()
+        self.progress_reporter = ProgressReporter(self)
         super().__init__(name, version, **kwargs)
 
+    @property
+    def code_action_index(self) -> CodeActionIndex:
+        """The code actions of this server, by the documents they apply to."""
+        if self._code_action_index is None:
+            from .code_actions import CodeActionIndex
+
+            self._code_action_index = CodeActionIndex()
+        return self._code_action_index
+
+    @property
+    def speculator(self) -> code_actions.Speculator:
+        """Starts speculative code actions before the user picks them."""
+        if self._speculator is None:
+            from .code_actions import Speculator
+
+            self._speculator = Speculator()
+        return self._speculator
+
+    def apply_edit(self, edit: WorkspaceEdit) -> Future[ApplyWorkspaceEditResult]:
+        """Asks the client to apply `edit` to its documents."""
+        return self.workspace_apply_edit(ApplyWorkspaceEditParams(edit=edit))
+
+    def show_message(self, message: str, type: MessageType = MessageType.Info):
+        """Shows `message` to the user."""
+        self.window_show_message(ShowMessageParams(type=type, message=message))
+
     def with_progress(self, options: ProgressOptions | None = None):
-        """This decorator will report the status of the request (pending, completed, failed) to the client"""
+        """This decorator will report the status of the request (pending, completed, failed) to the client.
+        Requests that finish within `options.delay` seconds are not reported."""
 
         def decorator(
             f: Callable[..., Awaitable[Result[..., str]]],
@@ -64,26 +225,17 @@ class GrimoireServer(LanguageServer):
 
             @wraps(f)
             async def wrapped(*args: tuple[Any, ...], **kwargs: dict[str, Any]):
-                token = str(uuid4())
-                _ = await self.work_done_progress.create_async(token)  # pyright: ignore[reportUnknownVariableType]
-                self.work_done_progress.begin(
-                    token,
-                    WorkDoneProgressBegin(
-                        title=options_.task_name or "Grimoire Task",
-                        cancellable=False,
-                    ),
-                )
-                result = await f(*args, **kwargs)
-                match result:
-                    case Ok(_):
-                        self.work_done_progress.end(
-                            token, WorkDoneProgressEnd(message=options_.success_message)
-                        )
-                    case Err(e):
-                        self.work_done_progress.end(
-                            token,
-                            WorkDoneProgressEnd(message=options_.failure_message or e),
-                        )
+                with self.progress_reporter.track(options_) as task:
+                    try:
+                        result = await f(*args, **kwargs)
+                    except asyncio.CancelledError:
+                        task.message = "Cancelled"
+                        raise
+                    match result:
+                        case Ok(_):
+                            task.message = options_.success_message
+                        case Err(e):
+                            task.message = options_.failure_message or e
 
                 return result
 
@@ -91,81 +243,513 @@ class GrimoireServer(LanguageServer):
 
         return decorator
 
+    @property
+    def persistent_cache(self) -> PersistentCache:
+        """The on-disk cache used by handlers with `PersistOptions` (opened on first use)."""
+        if self._persistent_cache is None:
+            self._persistent_cache = PersistentCache(self._persistent_cache_path)
+        return self._persistent_cache
+
+    def _persisted_transform(
+        self, f: TransformFn, options: ActionOptions, persist: PersistOptions
+    ) -> TransformFn:
+        @wraps(f)
+        async def wrapped(
+            text: str, params: code_actions.ActionParams | None, **kwargs: Any
+        ):
+            cache = self.persistent_cache
+            key = cache.key(
+                options.id,
+                text,
+                params.model_dump(mode="json") if params else None,
+                persist.model_params,
+            )
+            cached = cache.get(key)
+            metrics.incr(f"{options.id}.persist.{'miss' if cached is None else 'hit'}")
+            if cached is not None:
+                return Ok(cached)
+            result = await f(text, params, **kwargs)
+            match result:
+                case Ok(value):
+                    cache.put(key, value)
+                case Err(_):
+                    pass
+            return result
+
+        return wrapped
+
+    def _load_persisted_items(self, key: str, item_type: type[Any]) -> list[Any] | None:
+        cached = self.persistent_cache.get(key)
+        if cached is None:
+            return None
+        return _converter().structure(json.loads(cached), list[item_type])
+
+    def _persist_items(self, key: str, items: list[Any]):
+        if items:
+            data = json.dumps(_converter().unstructure(items))
+            self.persistent_cache.put(key, data)
+
+    def scheduled(
+        self,
+        priority: Priority = Priority.background,
+        backend: str = "default",
+    ):
+        """This decorator makes the function wait for a free slot of `backend` (see
+        `concurrency_limits`) before it runs. Use it for handlers that call a model outside
+        of `code_action` and `completion` (e.g. diagnostics on save), so that they do not
+        compete with interactive requests. If too many requests are waiting, the function
+        is skipped and an `Err` is returned.
+        The time spent waiting and running is recorded as `<name>.queue` and `<name>.run`
+        (see `metrics`)."""
+
+        def decorator(f: Callable[..., Any]) -> Callable[..., Awaitable[Any]]:
+            f_async = self.blocking_executor.make_async(f)
+            name = f.__name__
+
+            @wraps(f)
+            async def wrapped(*args: Any, **kwargs: Any):
+                queued = time.perf_counter()
+
+                async def run():
+                    metrics.observe(f"{name}.queue", time.perf_counter() - queued)
+                    with metrics.span(f"{name}.run"):
+                        return await f_async(*args, **kwargs)
+
+                try:
+                    return await self.scheduler.run(run, priority, backend)
+                except Overloaded as e:
+                    metrics.incr(f"{name}.shed")
+                    logging.log(e, logging.Level.warning)
+                    return Err(str(e))
+
+            return wrapped
+
+        return decorator
+
     def code_action(
         self,
         options: ActionOptions,
         progress: ProgressOptions | None = None,
+        backend: str = "default",
     ):
-        """Creates a code action from a user-defined function."""
+        """Creates a code action from a user-defined function.
+        Plain functions (and functions marked with `threads.blocking`) run on a worker thread.
+        `backend` names the model server that `f` uses (see `scheduled`).
+        With `options.persist`, results are also stored on disk and survive restarts.
+        With `options.speculative`, the action starts at background priority as soon as
+        the user selects some text, before it is picked (see `code_actions.Speculator`).
+        With `options.batch`, the command `<id>.batch` runs the action on many files at
+        once (see `run_batch`).
+        If `f` is an async generator, it should yield the result as it is generated,
+        which is written into the document as it arrives."""
+        from . import code_actions
 
-        def decorator(f: TransformFn):
+        def decorator(f: TransformFn | SyncTransformFn | StreamingTransformFn):
             progress_ = progress or self.default_progress_options
             if progress_.task_name is None:
                 progress_ = progress_.with_attrs(task_name=f.__name__)
-            f = self.with_progress(progress_)(f)
+            streaming = inspect.isasyncgenfunction(f)
+            if streaming:
+                f = code_actions.collect_stream(f)
+            if options.speculative and options.params is None:
+                speculative = self.scheduled(Priority.background, backend)(f)
+                if options.persist is not None:
+                    speculative = self._persisted_transform(
+                        speculative, options, options.persist
+                    )
+                self._speculative_transforms[options.id] = speculative
+            if options.batch is not None and options.params is None:
+                batch_transform = self.scheduled(Priority.code_action, backend)(f)
+                if options.persist is not None:
+                    batch_transform = self._persisted_transform(
+                        batch_transform, options, options.persist
+                    )
+                self._batch_transforms[options.id] = batch_transform
+                self._register_batch_command(options)
+            f = self.with_progress(progress_)(
+                self.scheduled(Priority.code_action, backend)(f)
+            )
+            if options.persist is not None:
+                f = self._persisted_transform(f, options, options.persist)
 
             # Register the function as an LSP command
-            wrapped_f = code_actions.wrap_transform(f, options)
+            wrapped_f = code_actions.wrap_transform(f, options, streaming)
             _ = self.command(options.id)(wrapped_f)
-            self.code_actions.append(options)
+            self.code_action_index.add(options)
             return wrapped_f
 
         return decorator
 
-    def _register_code_actions(self):
-        @self.feature(TEXT_DOCUMENT_CODE_ACTION)
-        async def _(params: CodeActionParams):
-            uri = params.text_document.uri
-            start = params.range.start
-            end = params.range.end
-            return [
-                CodeAction(
-                    command=Command(
-                        command=action_opts.id,
-                        arguments=[
-                            uri,
-                            start.line,
-                            start.character,
-                            end.line,
-                            end.character,
-                        ],
-                        **action_opts.command_kwargs,
+    def _register_batch_command(self, options: ActionOptions):
+        from . import batch
+
+        batch_options = options.batch or batch.BatchOptions()
+
+        @self.command(f"{options.id}.batch")
+        async def _(*args: Any):
+            # The only argument is the URI of a file or a glob (defaults to `batch_options.glob`)
+            arg = args[0] if args else None
+            if isinstance(arg, str) and arg.startswith("file:"):
+                targets = batch.find_targets(self, batch_options, uri=arg)
+            else:
+                glob = arg if isinstance(arg, str) else batch_options.glob
+                targets = batch.find_targets(self, replace(batch_options, glob=glob))
+            _ = await self.run_batch(options, targets)
+
+    async def run_batch(
+        self, options: ActionOptions, targets: list[batch.Target]
+    ) -> list[tuple[batch.Target, str]]:
+        """Runs the code action `options.id` on each of `targets` in parallel, and applies
+        all of the results as one edit. Targets that fail are reported (and returned with
+        their errors) without stopping the others."""
+        from . import batch, code_actions, diff
+        from .backend import BackendError
+
+        transform = self._batch_transforms[options.id]
+        batch_options = options.batch or batch.BatchOptions()
+        semaphore = asyncio.Semaphore(batch_options.max_concurrency)
+        total = len(targets)
+        done = 0
+        failures: list[tuple[batch.Target, str]] = []
+
+        token = str(uuid4())
+        progress = self.work_done_progress
+        _ = await progress.create_async(token)  # pyright: ignore[reportUnknownVariableType]
+        progress.begin(
+            token,
+            WorkDoneProgressBegin(
+                title=options.title or options.id,
+                message=f"0/{total}",
+                percentage=0,
+                cancellable=False,
+            ),
+        )
+
+        async def run(target: batch.Target) -> list[TextEdit]:
+            nonlocal done
+            start, end = target.range.start.line, target.range.end.line
+            text = diff.text_in_range(target.lines, target.range).strip()
+            try:
+                async with semaphore:
+                    result = await transform(text, None)
+            except (BackendError, OSError) as e:
+                # The model could not be reached; other errors are bugs in the transform
+                result = Err(str(e))
+            done += 1
+            progress.report(
+                token,
+                WorkDoneProgressReport(
+                    message=f"{done}/{total}", percentage=done * 100 // total
+                ),
+            )
+            match result:
+                case Ok(value):
+                    indent = wrk.Indentation.from_lines(target.lines[start : end + 1])
+                    return code_actions.result_edits(
+                        target.lines, target.range, value, indent, options
+                    )
+                case Err(e):
+                    failures.append((target, e))
+                    logging.log(
+                        f"{options.id} failed on {target.uri}:{start + 1}: {e}",
+                        logging.Level.warning,
+                    )
+                    return []
+
+        try:
+            results = await asyncio.gather(*(run(target) for target in targets))
+        except BaseException:
+            progress.end(token, WorkDoneProgressEnd(message="Failed"))
+            raise
+        changes: dict[tuple[str, int | None], list[TextEdit]] = {}
+        for target, edits in zip(targets, results):
+            if edits:
+                changes.setdefault((target.uri, target.version), []).extend(edits)
+        if changes:
+            # The client rejects the edits of a document that changed meanwhile
+            document_changes = [
+                TextDocumentEdit(
+                    text_document=OptionalVersionedTextDocumentIdentifier(
+                        uri=uri, version=version
                     ),
-                    **action_opts.code_action_kwargs,
+                    edits=edits,
                 )
-                for action_opts in self.code_actions
+                for (uri, version), edits in changes.items()
             ]
+            _ = self.apply_edit(WorkspaceEdit(document_changes=document_changes))
+
+        progress.end(
+            token,
+            WorkDoneProgressEnd(message=f"{total - len(failures)}/{total} succeeded"),
+        )
+        if failures:
+            self.show_message(
+                f"{options.title} failed on {len(failures)} of {total} targets "
+                + "(see the log for details)",
+                MessageType.Warning,
+            )
+        return failures
+
+    @property
+    def code_actions(self) -> list[ActionOptions]:
+        return self.code_action_index.options
+
+    def _register_code_actions(self):
+        index = self.code_action_index
+
+        def resolve_supported() -> bool:
+            # Clients that cannot resolve the command of an action get it up front
+            text_document = self.client_capabilities.text_document
+            code_action = text_document.code_action if text_document else None
+            resolve_support = code_action.resolve_support if code_action else None
+            if resolve_support is None:
+                return False
+            return "command" in resolve_support.properties
+
+        @self.feature(
+            TEXT_DOCUMENT_CODE_ACTION,
+            CodeActionOptions(code_action_kinds=index.kinds, resolve_provider=True),
+        )
+        def _(params: CodeActionParams):
+            uri = params.text_document.uri
+            if self._speculative_transforms and params.range.start != params.range.end:
+                self._speculate(uri, params.range, params.context.only)
+            return index.actions(
+                uri, params.range, params.context.only, resolve_supported()
+            )
+
+        @self.feature(CODE_ACTION_RESOLVE)
+        def _(action: CodeAction):
+            return index.resolve(action)
+
+    def _speculate(self, uri: str, range_: Range, only: Sequence[str] | None):
+        ids = [
+            options.id
+            for options in self.code_action_index.matching(uri, range_, only)
+            if options.id in self._speculative_transforms
+        ][: self.max_speculative_actions]
+        document = self.workspace.get_text_document(uri)
+        version = document.version
+        range_key = (
+            range_.start.line,
+            range_.start.character,
+            range_.end.line,
+            range_.end.character,
+        )
+        text = "".join(DocumentView.of(document).lines_in_range(range_)).strip()
+
+        def run(key: code_actions.SpeculationKey):
+            return self._speculative_transforms[key[3]](text, None)
+
+        self.speculator.schedule([(uri, version, range_key, id_) for id_ in ids], run)
+
+    def workspace_snapshot(self) -> wrk.WorkspaceSnapshot | None:
+        """Returns an up-to-date snapshot of the files in the workspace.
+        The snapshot is built on first use, and is `None` if the workspace has no root."""
+        root = self.workspace.root_path
+        if not root:
+            return None
+        # Handlers on worker threads would otherwise each build their own snapshot
+        with self._workspace_snapshots_lock:
+            snapshot = self._workspace_snapshots.get(Path(root))
+            if snapshot is None:
+                snapshot = wrk.WorkspaceSnapshot.build(self)
+                if snapshot is None:
+                    return None
+                self._workspace_snapshots[snapshot.root] = snapshot
+        snapshot.sync(self)
+        return snapshot
+
+    def _register_workspace_watcher(self):
+        # Changes to open documents are picked up from their versions, but changes
+        # made outside of the editor are only visible through file system events.
+        # The user's config takes precedence if it handles these notifications itself.
+        features = self.protocol.fm.features
+        if WORKSPACE_DID_CHANGE_WATCHED_FILES in features:
+            return
+
+        if INITIALIZED not in features:
+
+            @self.feature(INITIALIZED)
+            async def _(_params: InitializedParams):
+                options = DidChangeWatchedFilesRegistrationOptions(
+                    watchers=[FileSystemWatcher(glob_pattern="**/*")]
+                )
+                _ = await self.client_register_capability_async(
+                    RegistrationParams(
+                        registrations=[
+                            Registration(
+                                id=str(uuid4()),
+                                method=WORKSPACE_DID_CHANGE_WATCHED_FILES,
+                                register_options=options,
+                            )
+                        ]
+                    )
+                )
+
+        # Git and the disk are slow, so the changes are applied on a worker thread (in
+        # the order in which they arrive)
+        changes_lock = asyncio.Lock()
+
+        @self.feature(WORKSPACE_DID_CHANGE_WATCHED_FILES)
+        async def _(params: DidChangeWatchedFilesParams):
+            root = self.workspace.root_path
+            snapshot = self._workspace_snapshots.get(Path(root)) if root else None
+            if snapshot is None:
+                return
+            # Whether each path of the workspace was deleted (by its last change)
+            changes: dict[Path, bool] = {}
+            for change in params.changes:
+                path = wrk.uri_to_path(change.uri)
+                if wrk.is_excluded(snapshot.root, path):
+                    continue
+                if change.type == FileChangeType.Deleted:
+                    changes[path] = True
+                elif change.uri not in self.workspace.text_documents:
+                    changes[path] = False
+                else:
+                    _ = changes.pop(path, None)
+            if not changes:
+                return
+
+            def apply():
+                for path in [path for path, deleted in changes.items() if deleted]:
+                    snapshot.remove(path)
+                snapshot.reload(
+                    path for path, deleted in changes.items() if not deleted
+                )
+
+            async with changes_lock:
+                await asyncio.get_running_loop().run_in_executor(None, apply)
+
+    def _stream_inline_completion(
+        self,
+        f: Callable[[InlineCompletionParams], AsyncIterator[str]],
+        stop: StopOptions,
+    ) -> Callable[
+        [InlineCompletionParams], Awaitable[Result[list[InlineCompletionItem], str]]
+    ]:
+        from . import completion, streaming
+
+        @wraps(f)
+        async def wrapped(
+            params: InlineCompletionParams,
+        ) -> Result[list[InlineCompletionItem], str]:
+            before, after = completion.local_context(self, params)
+            text = await streaming.stream_until(
+                f(params), stop.conditions(before, after)
+            )
+            if not text.strip():
+                return Err("Could not generate completions.")
+            return Ok([InlineCompletionItem(insert_text=text)])
+
+        return wrapped
 
     def inline_completion(
         self,
         options: InlineCompletionOptions,
         progress: ProgressOptions | None = None,
+        debounce: float | None = None,
+        cache: CacheOptions | None = None,
+        stop: StopOptions | None = None,
+        backend: str = "default",
+        persist: PersistOptions | None = None,
     ):
-        """Creates a completion handler from a user-defined function"""
+        """Creates a completion handler from a user-defined function.
+        Only the latest request for each document is sent to `f`: requests wait `debounce`
+        seconds (`default_debounce` if `None`), and a newer request cancels older ones.
+        Results are cached by the text around the cursor (see `CacheOptions`), and are
+        reused when the user types the beginning of a cached completion.
+        Plain functions (and functions marked with `threads.blocking`) run on a worker thread.
+        `backend` names the model server that `f` uses (see `scheduled`).
+        With `persist`, results are also stored on disk and survive restarts.
+        If `f` is an async generator, it should yield the completion as it is generated,
+        and it is stopped as soon as one of the `stop` conditions fires."""
+        from . import completion
+        from .streaming import StopOptions
 
         def decorator(
             f: Callable[
                 [InlineCompletionParams],
-                Awaitable[Result[list[InlineCompletionItem], str]],
+                Awaitable[Result[list[InlineCompletionItem], str]]
+                | Result[list[InlineCompletionItem], str]
+                | AsyncIterator[str],
             ],
         ):
             progress_ = progress or self.default_progress_options
             if progress_.task_name is None:
                 progress_ = progress_.with_attrs(task_name=f.__name__)
+            if inspect.isasyncgenfunction(f):
+                f = self._stream_inline_completion(f, stop or StopOptions())
+            f_async = self.scheduled(Priority.completion, backend)(f)
+            debouncer = scheduling.Debouncer(
+                self.default_debounce if debounce is None else debounce
+            )
+            cache_options = cache or CacheOptions()
+            cache_ = (
+                CompletionCache(
+                    _inline_completion_item_text,
+                    _with_inline_completion_item_text,
+                    cache_options,
+                )
+                if cache_options.enabled
+                else None
+            )
+            name = f.__name__
+            if cache_ is not None:
+                self.completion_caches[name] = cache_
 
-            async def wrapped(params: CompletionParams):
-                f_with_progress = self.with_progress(progress_)(f)
+            async def handle(params: InlineCompletionParams):
+                # Looked up on each call, as the cache may be shared with other servers
+                cache_ = self.completion_caches.get(name)
+                before, after = "", ""
+                if cache_ is not None or persist is not None:
+                    before, after = completion.local_context(self, params)
+                cached = cache_.get(before, after) if cache_ is not None else None
+                if cache_ is not None:
+                    metrics.incr(f"{name}.cache.{'miss' if cached is None else 'hit'}")
+                persist_key = None
+                if cached is None and persist is not None:
+                    persist_key = self.persistent_cache.key(
+                        name, before, after, persist.model_params
+                    )
+                    cached = self._load_persisted_items(
+                        persist_key, InlineCompletionItem
+                    )
+                    metrics.incr(
+                        f"{name}.persist.{'miss' if cached is None else 'hit'}"
+                    )
+                    if cached is not None and cache_ is not None:
+                        cache_.put(before, after, cached)
+                if cached is not None:
+                    debouncer.cancel(params.text_document.uri)
+                    return InlineCompletionList(items=cached)
+
+                f_with_progress = self.with_progress(progress_)(f_async)
                 items: list[InlineCompletionItem] = []
-                match await f_with_progress(params):
+                match await debouncer.run(
+                    params.text_document.uri, lambda: f_with_progress(params)
+                ):
+                    case None:
+                        pass
                     case Ok(v):
                         items = v
+                        if cache_ is not None:
+                            cache_.put(before, after, items)
+                        if persist_key is not None:
+                            self._persist_items(persist_key, items)
                     case Err(e):
+                        metrics.incr(f"{name}.errors")
                         logging.log(e)
 
                 return InlineCompletionList(
                     items=items,
                 )
 
+            async def wrapped(params: InlineCompletionParams):
+                with metrics.span(f"{name}.handler"):
+                    return await handle(params)
+
             return self.feature(TEXT_DOCUMENT_INLINE_COMPLETION, options)(wrapped)
 
         return decorator
@@ -174,29 +758,54 @@ class GrimoireServer(LanguageServer):
         self,
         options: CompletionOptions,
         progress: ProgressOptions | None = None,
+        debounce: float | None = None,
+        cache: CacheOptions | None = None,
+        backend: str = "default",
+        persist: PersistOptions | None = None,
     ):
-        """Creates a completion handler from a user-defined function"""
+        """Creates a completion handler from a user-defined function.
+        Only the latest request for each document is sent to `f`: requests wait `debounce`
+        seconds (`default_debounce` if `None`), and a newer request cancels older ones.
+        Results are cached by the text around the cursor (see `CacheOptions`), and are
+        reused when the user types the beginning of a cached completion.
+        Plain functions (and functions marked with `threads.blocking`) run on a worker thread.
+        `backend` names the model server that `f` uses (see `scheduled`).
+        With `persist`, results are also stored on disk and survive restarts."""
+        from . import completion
 
         def decorator(
             f: Callable[
-                [CompletionParams], Awaitable[Result[list[CompletionItem], str]]
+                [CompletionParams],
+                Awaitable[Result[list[CompletionItem], str]]
+                | Result[list[CompletionItem], str],
             ],
         ):
             progress_ = progress or self.default_progress_options
             if progress_.task_name is None:
                 progress_ = progress_.with_attrs(task_name=f.__name__)
+            f_async = self.scheduled(Priority.completion, backend)(f)
+            debouncer = scheduling.Debouncer(
+                self.default_debounce if debounce is None else debounce
+            )
+            cache_options = cache or CacheOptions()
+            cache_ = (
+                CompletionCache(
+                    _completion_item_text, _with_completion_item_text, cache_options
+                )
+                if cache_options.enabled
+                else None
+            )
+            name = f.__name__
+            if cache_ is not None:
+                self.completion_caches[name] = cache_
 
-            async def wrapped(params: CompletionParams):
-                f_with_progress = self.with_progress(progress_)(f)
-                items: list[CompletionItem] = []
-                match await f_with_progress(params):
-                    case Ok(v):
-                        items = v
-                    case Err(e):
-                        logging.log(e)
-
+            def completion_list(
+                params: CompletionParams,
+                items: list[CompletionItem],
+                is_incomplete: bool = False,
+            ) -> CompletionList:
                 return CompletionList(
-                    is_incomplete=False,
+                    is_incomplete=is_incomplete,
                     items=items,
                     item_defaults=CompletionItemDefaults(
                         edit_range=EditRangeWithInsertReplace(
@@ -206,12 +815,63 @@ class GrimoireServer(LanguageServer):
                     ),
                 )
 
+            async def handle(params: CompletionParams):
+                # Looked up on each call, as the cache may be shared with other servers
+                cache_ = self.completion_caches.get(name)
+                before, after = "", ""
+                if cache_ is not None or persist is not None:
+                    before, after = completion.local_context(self, params)
+                cached = cache_.get(before, after) if cache_ is not None else None
+                if cache_ is not None:
+                    metrics.incr(f"{name}.cache.{'miss' if cached is None else 'hit'}")
+                persist_key = None
+                if cached is None and persist is not None:
+                    persist_key = self.persistent_cache.key(
+                        name, before, after, persist.model_params
+                    )
+                    cached = self._load_persisted_items(persist_key, CompletionItem)
+                    metrics.incr(
+                        f"{name}.persist.{'miss' if cached is None else 'hit'}"
+                    )
+                    if cached is not None and cache_ is not None:
+                        cache_.put(before, after, cached)
+                if cached is not None:
+                    debouncer.cancel(params.text_document.uri)
+                    return completion_list(params, cached)
+
+                f_with_progress = self.with_progress(progress_)(f_async)
+                items: list[CompletionItem] = []
+                superseded = False
+                match await debouncer.run(
+                    params.text_document.uri, lambda: f_with_progress(params)
+                ):
+                    case None:
+                        superseded = True
+                        metrics.incr(f"{name}.superseded")
+                    case Ok(v):
+                        items = v
+                        if cache_ is not None:
+                            cache_.put(before, after, items)
+                        if persist_key is not None:
+                            self._persist_items(persist_key, items)
+                    case Err(e):
+                        metrics.incr(f"{name}.errors")
+                        logging.log(e)
+
+                # Ask the client to request again if this request was superseded
+                return completion_list(params, items, is_incomplete=superseded)
+
+            async def wrapped(params: CompletionParams):
+                with metrics.span(f"{name}.handler"):
+                    return await handle(params)
+
             return self.feature(TEXT_DOCUMENT_COMPLETION, options)(wrapped)
 
         return decorator
 
-    @classmethod
-    def from_config(cls) -> GrimoireServer:
+    @staticmethod
+    def config_path() -> Path:
+        """The path of the user's `init.py`."""
         # First try to load the config from the environment variable
         path = os.environ.get("GRIMOIRE_LS_HOME")
         if path is None:
@@ -224,17 +884,230 @@ class GrimoireServer(LanguageServer):
                 )
                 / "grimoire-ls"
             )
+        return Path(path).expanduser().resolve() / "init.py"
 
-        path = Path(path).expanduser().resolve() / "init.py"
+    @classmethod
+    def load_config(
+        cls, path: Path | None = None, watch: bool = False
+    ) -> GrimoireServer:
+        """Runs the user's config and returns the server that it defines.
+        With `watch`, the config is reloaded whenever it changes (see `watch_config`)."""
+        path = path or cls.config_path()
         spec = importlib.util.spec_from_file_location("config", path)
         if spec is None:
-            raise Exception(f"Could not load config from {path}")
+            raise ConfigError(f"Could not load config from {path}")
         if spec.loader is None:
-            raise Exception(f"Spec loader is None for {spec}")
+            raise ConfigError(f"Spec loader is None for {spec}")
         config = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(config)
-        server = config.server
+        try:
+            spec.loader.exec_module(config)
+            server = config.server
+        except Exception as e:
+            # The config is the user's code, so it may raise anything
+            raise ConfigError(f"Error in config {path}: {e!r}") from e
         if not isinstance(server, cls):
-            raise Exception(f"Expected `server` to be type {cls}, got {type(server)}")
+            raise ConfigError(f"Expected `server` to be type {cls}, got {type(server)}")
         server._register_code_actions()
+        server._register_workspace_watcher()
+        server._register_reload_command()
+        server._register_metrics_command()
+        if watch:
+            server._watch_config_when_initialized()
+        startup.save_capabilities(server, path)
         return server
+
+    @classmethod
+    async def _load_config_in_thread(
+        cls, path: Path, watch: bool = False
+    ) -> GrimoireServer:
+        def load() -> GrimoireServer:
+            # Servers (and the config) may expect an event loop in their thread. The
+            # threads of the executor are reused, so the loop is closed afterwards.
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                return cls.load_config(path, watch)
+            finally:
+                asyncio.set_event_loop(None)
+                loop.close()
+
+        return await asyncio.get_running_loop().run_in_executor(None, load)
+
+    @classmethod
+    def from_config(cls, defer: bool = False, watch: bool = False) -> GrimoireServer:
+        """Loads the server from the user's config (see `load_config` for `watch`).
+
+        With `defer`, the server returned answers `initialize` right away with the
+        capabilities that the config registered the last time it was loaded, and the
+        config itself is loaded in the background once the client has been initialized.
+        Requests that arrive before it is loaded wait for it. If the config has changed
+        since (or was never loaded), it is loaded up front as usual."""
+        path = cls.config_path()
+        capabilities = startup.load_capabilities(path) if defer else None
+        if capabilities is None:
+            return cls.load_config(path, watch)
+
+        features, commands = capabilities
+        bootstrap = GrimoireServer()
+        fm = bootstrap.protocol.fm
+        # The parameters of the notifications that the config could not handle yet
+        received: dict[str, Any] = {}
+        load_task: asyncio.Task[None] | None = None
+
+        async def load():
+            try:
+                server = await cls._load_config_in_thread(path, watch)
+                bootstrap._hand_over(server)
+            except ConfigError as e:
+                logging.log(f"Could not load the config: {e}", logging.Level.error)
+                # Waiting requests find no handlers instead of their placeholders
+                fm.features.clear()
+                fm.commands.clear()
+                return
+            # The config's own `initialize` and `initialized` handlers could not run
+            # before it was loaded
+            for name in (INITIALIZE, INITIALIZED):
+                handler = fm.features.get(name)
+                if handler is not None and name in received:
+                    result = handler(received[name])
+                    if inspect.isawaitable(result):
+                        _ = await result
+
+        def loaded() -> Awaitable[None]:
+            # Starts loading the config, if that has not happened yet
+            nonlocal load_task
+            if load_task is None:
+                load_task = asyncio.ensure_future(load())
+            # Requests that are cancelled while they wait do not cancel the loading
+            return asyncio.shield(load_task)
+
+        def placeholder(registry: dict[str, Any], name: str) -> Callable[..., Any]:
+            # Waits for the config, then calls the handler that it registered
+            async def wrapped(*args: Any):
+                await loaded()
+                handler = registry.get(name)
+                if handler is None:
+                    logging.log(f"{name} is no longer provided by the config")
+                    return None
+                result = handler(*args)
+                return await result if inspect.isawaitable(result) else result
+
+            return wrapped
+
+        for name, options in features.items():
+            if name not in (INITIALIZE, INITIALIZED):
+                _ = bootstrap.feature(name, options)(placeholder(fm.features, name))
+        for command in commands:
+            _ = bootstrap.command(command)(placeholder(fm.commands, command))
+
+        @bootstrap.feature(INITIALIZE)
+        def initialize(params: InitializeParams):
+            # Answered from the saved capabilities, without waiting for the config
+            received[INITIALIZE] = params
+
+        @bootstrap.feature(INITIALIZED)
+        def initialized(params: InitializedParams):
+            received[INITIALIZED] = params
+            _ = loaded()
+
+        return bootstrap
+
+    def _hand_over(self, server: GrimoireServer):
+        """Makes `server` handle the requests that reach this server's connection."""
+        fm = self.protocol.fm
+        server_fm = server.protocol.fm
+        for registry, server_registry in (
+            (fm.features, server_fm.features),
+            (fm.feature_options, server_fm.feature_options),
+            (fm.commands, server_fm.commands),
+        ):
+            registry.clear()
+            registry.update(server_registry)
+        server.protocol = self.protocol
+        self.protocol._server = server  # pyright: ignore[reportPrivateUsage]
+
+    async def reload_config(self) -> GrimoireServer:
+        """Runs the config again and lets the server that it defines take over from this
+        one, along with the workspace snapshot, caches and request scheduler of this
+        server. Requests that are already running finish with the old handlers.
+        Modules that the config imports are not reloaded."""
+        path = self.config_path()
+        server = await self._load_config_in_thread(path)
+        server._share_state(self)
+        self._hand_over(server)
+        # The old handlers that are still running keep their threads until they finish
+        self.blocking_executor.shutdown(cancel_pending=False)
+        logging.log(f"Reloaded the config from {path}")
+        return server
+
+    def _share_state(self, other: GrimoireServer):
+        """Makes this server use the workspace snapshots, caches and request scheduler of
+        `other`, with the limits and cache options of this server's config."""
+        self._workspace_snapshots = other._workspace_snapshots
+        self._workspace_snapshots_lock = other._workspace_snapshots_lock
+        if (
+            self._persistent_cache is None
+            and self._persistent_cache_path == other._persistent_cache_path
+        ):
+            self._persistent_cache = other._persistent_cache
+        other.scheduler.reconfigure(self.scheduler)
+        self.scheduler = other.scheduler
+        for name, completion_cache in self.completion_caches.items():
+            other_cache = other.completion_caches.setdefault(name, completion_cache)
+            if other_cache is not completion_cache:
+                other_cache.reconfigure(completion_cache.options)
+                self.completion_caches[name] = other_cache
+
+    def _register_reload_command(self):
+        @self.command(reload_config_command)
+        async def _(*_args: Any):
+            try:
+                _ = await self.reload_config()
+            except ConfigError as e:
+                logging.log(f"Could not reload the config: {e}", logging.Level.error)
+                self.show_message(
+                    f"Could not reload the config: {e}", MessageType.Error
+                )
+
+    def _register_metrics_command(self):
+        @self.command(metrics_command)
+        def _(*args: Any) -> dict[str, Any] | str:
+            # With the argument "prometheus", returns the metrics in the Prometheus format
+            if args and args[0] == "prometheus":
+                return metrics.registry.prometheus()
+            return metrics.registry.snapshot()
+
+    async def watch_config(self, interval: float = 1.0) -> None:
+        """Reloads the config whenever its file changes."""
+        path = self.config_path()
+        mtime = path.stat().st_mtime_ns
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                new_mtime = path.stat().st_mtime_ns
+            except OSError:
+                continue
+            if new_mtime == mtime:
+                continue
+            mtime = new_mtime
+            # Reload from whichever server is handling requests by now
+            current = cast(GrimoireServer, self.protocol._server)  # pyright: ignore[reportPrivateUsage]
+            try:
+                _ = await current.reload_config()
+            except ConfigError as e:
+                logging.log(f"Could not reload the config: {e}", logging.Level.error)
+
+    def _watch_config_when_initialized(self):
+        # The watcher needs the event loop, which only runs once the server has started.
+        # It is chained to the config's own `initialized` handler, if there is one.
+        fm = self.protocol.fm
+        handler = fm.features.get(INITIALIZED)
+
+        async def initialized(params: InitializedParams):
+            self._config_watcher = asyncio.ensure_future(self.watch_config())
+            if handler is not None:
+                result = handler(params)
+                if inspect.isawaitable(result):
+                    _ = await result
+
+        fm.features[INITIALIZED] = initialized
@@ -0,0 +1,156 @@
+"""Helpers to keep the startup of the server fast: a report of where the startup time
+goes, and a cache of the capabilities registered by the user's config, which lets the
+server answer `initialize` before the config has been loaded."""
+
+from __future__ import annotations
+
+import builtins
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from .logging import Level, log
+
+if TYPE_CHECKING:
+    from .server import GrimoireServer
+
+# Bump this when the format of the capability cache changes
+_capabilities_version = 1
+
+
+class StartupReport:
+    """Records how long each phase of the startup takes, and which of the modules
+    imported during each phase were the slowest to import (including their own imports)."""
+
+    phases: list[tuple[str, float]]
+    imports: dict[str, float]
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+        self.imports = {}
+        self._depth = threading.local()
+
+    @classmethod
+    def from_env(cls) -> StartupReport | None:
+        """A report if the `GRIMOIRE_LS_STARTUP_REPORT` environment variable is set."""
+        return cls() if os.environ.get("GRIMOIRE_LS_STARTUP_REPORT") else None
+
+    def _timed_import(self, original: Any):
+        def timed_import(name: str, *args: Any, **kwargs: Any) -> Any:
+            depth = getattr(self._depth, "value", 0)
+            # Only time the outermost import of a module that has not been loaded yet
+            if depth > 0 or name in sys.modules:
+                self._depth.value = depth + 1
+                try:
+                    return original(name, *args, **kwargs)
+                finally:
+                    self._depth.value = depth
+            self._depth.value = 1
+            start = time.perf_counter()
+            try:
+                return original(name, *args, **kwargs)
+            finally:
+                self._depth.value = 0
+                self.imports[name] = self.imports.get(name, 0.0) + (
+                    time.perf_counter() - start
+                )
+
+        return timed_import
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Times the code in this block as one phase of the startup."""
+        original = builtins.__import__
+        builtins.__import__ = self._timed_import(original)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            builtins.__import__ = original
+            self.phases.append((name, time.perf_counter() - start))
+
+    def log(self, n_imports: int = 15):
+        lines = [f"Startup took {time.perf_counter() - self.start:.3f}s"]
+        lines.extend(f"  {name}: {duration:.3f}s" for name, duration in self.phases)
+        lines.append("Slowest imports:")
+        slowest = sorted(self.imports.items(), key=lambda x: x[1], reverse=True)
+        lines.extend(
+            f"  {name}: {duration:.3f}s" for name, duration in slowest[:n_imports]
+        )
+        log("\n".join(lines))
+
+
+def _capabilities_path(config_path: Path) -> Path:
+    cache_home = os.environ.get(
+        "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+    )
+    digest = hashlib.sha256(str(config_path).encode()).hexdigest()[:16]
+    return Path(cache_home) / "grimoire-ls" / f"capabilities-{digest}.json"
+
+
+def save_capabilities(server: GrimoireServer, config_path: Path):
+    """Remembers the features and commands that the config registered on `server`."""
+    from lsprotocol import converters
+
+    converter = converters.get_converter()
+    fm = server.protocol.fm
+    features: dict[str, Any] = {}
+    for name in fm.features:
+        options = fm.feature_options.get(name)
+        features[name] = (
+            None
+            if options is None
+            else {
+                "type": type(options).__name__,
+                "options": converter.unstructure(options),
+            }
+        )
+    data = {
+        "version": _capabilities_version,
+        "config_mtime": config_path.stat().st_mtime_ns,
+        "features": features,
+        "commands": list(fm.commands),
+    }
+    path = _capabilities_path(config_path)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _ = path.write_text(json.dumps(data))
+    except OSError as e:
+        log(f"Could not save capabilities to {path}: {e}", Level.warning)
+
+
+def load_capabilities(config_path: Path) -> tuple[dict[str, Any], list[str]] | None:
+    """Returns the features (with their options) and commands that the config registered
+    the last time it was loaded, unless the config has changed since."""
+    path = _capabilities_path(config_path)
+    try:
+        data = json.loads(path.read_text())
+        if (
+            data["version"] != _capabilities_version
+            or data["config_mtime"] != config_path.stat().st_mtime_ns
+        ):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+
+    from lsprotocol import converters, types
+
+    converter = converters.get_converter()
+    features: dict[str, Any] = {}
+    for name, options in data["features"].items():
+        if options is None:
+            features[name] = None
+            continue
+        options_type = getattr(types, options["type"], None)
+        if options_type is None:
+            return None
+        features[name] = converter.structure(options["options"], options_type)
+    return features, data["commands"]
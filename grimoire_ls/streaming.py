@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+from collections.abc import AsyncIterator, Callable
+from contextlib import aclosing
+from dataclasses import dataclass
+
+# Given the text generated so far, returns the length it should be cut to if generation
+# should stop (or `None` to keep going)
+StopCondition = Callable[[str], int | None]
+
+_closing_brackets = {")": "(", "]": "[", "}": "{"}
+_opening_brackets = set(_closing_brackets.values())
+# How far back to look for brackets that are still open at the cursor
+_bracket_lookback = 2000
+
+
+@dataclass(frozen=True)
+class StopOptions:
+    """When to stop a streamed completion early."""
+
+    # Stop when the completion starts repeating the text after the cursor
+    suffix_overlap: bool = True
+    # How many characters of the text after the cursor must be repeated
+    min_overlap: int = 8
+    # Stop before a bracket that closes more than was open at the cursor
+    brackets: bool = True
+    # Stop before a line that is indented less than the line of the cursor
+    dedent: bool = True
+    # Stop after this many characters
+    max_chars: int | None = None
+
+    def conditions(self, before: str, after: str) -> list[StopCondition]:
+        conditions: list[StopCondition] = []
+        if self.suffix_overlap:
+            conditions.append(suffix_overlap(after, self.min_overlap))
+        if self.brackets:
+            conditions.append(unbalanced_brackets(before))
+        if self.dedent:
+            conditions.append(dedent(before))
+        if self.max_chars is not None:
+            max_chars = self.max_chars
+            conditions.append(lambda text: max_chars if len(text) > max_chars else None)
+        return conditions
+
+
+def suffix_overlap(after: str, min_overlap: int = 8) -> StopCondition:
+    """Stops where the completion starts to repeat the first line of `after`."""
+    stripped = after.lstrip()
+    needle = stripped.split("\n", 1)[0].strip()
+    if len(needle) < min_overlap:
+        # Short lines (e.g. a lone bracket) are too common to be a reliable signal
+        needle = stripped[:min_overlap]
+    if len(needle) < min_overlap:
+        return lambda _: None
+
+    def condition(text: str) -> int | None:
+        i = text.find(needle)
+        if i < 0:
+            return None
+        # Also drop the whitespace that leads up to the repeated text
+        return len(text[:i].rstrip())
+
+    return condition
+
+
+def unbalanced_brackets(before: str) -> StopCondition:
+    """Stops before a bracket that closes more brackets than were open at the cursor."""
+    open_at_cursor: list[str] = []
+    for c in before[-_bracket_lookback:]:
+        if c in _opening_brackets:
+            open_at_cursor.append(c)
+        elif c in _closing_brackets and open_at_cursor:
+            _ = open_at_cursor.pop()
+
+    def condition(text: str) -> int | None:
+        stack = list(open_at_cursor)
+        for i, c in enumerate(text):
+            if c in _opening_brackets:
+                stack.append(c)
+            elif c in _closing_brackets:
+                if not stack or stack[-1] != _closing_brackets[c]:
+                    return i
+                _ = stack.pop()
+        return None
+
+    return condition
+
+
+def dedent(before: str) -> StopCondition:
+    """Stops before a line that is indented less than the line of the cursor."""
+    cursor_line = before.rsplit("\n", 1)[-1]
+    indent = len(cursor_line) - len(cursor_line.lstrip())
+
+    def condition(text: str) -> int | None:
+        offset = text.find("\n")
+        while offset >= 0:
+            start = offset + 1
+            end = text.find("\n", start)
+            # Only judge complete lines, as the indentation of the last one may still grow
+            if end < 0:
+                return None
+            line = text[start:end]
+            if line.strip() and len(line) - len(line.lstrip()) < indent:
+                return len(text[:offset].rstrip())
+            offset = end
+        return None
+
+    return condition
+
+
+async def stream_until(
+    stream: AsyncIterator[str], conditions: list[StopCondition]
+) -> str:
+    """Collects the text from `stream` until one of the `conditions` fires.
+    The stream is closed as soon as that happens, which aborts the generation."""
+    text = ""
+    async with aclosing(stream):  # pyright: ignore[reportArgumentType]
+        async for chunk in stream:
+            text += chunk
+            for condition in conditions:
+                cut = condition(text)
+                if cut is not None:
+                    return text[:cut]
+    # The last line is complete now, so check it as well
+    for condition in conditions:
+        cut = condition(text + "\n")
+        if cut is not None and cut < len(text):
+            text = text[:cut]
+    return text
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import asyncio
+import inspect
+import threading
+from collections.abc import Awaitable, Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import wraps
+from typing import Any
+
+from .logging import log
+
+_blocking_attr = "__grimoire_blocking__"
+# Called on the event loop of a blocking `async` function before it is closed
+_loop_cleanups: list[Callable[[], None]] = []
+
+
+def blocking[T](f: Callable[..., T]) -> Callable[..., T]:
+    """Marks `f` as blocking, so that it is run on a worker thread instead of the event loop.
+    Plain (non-`async`) functions are always treated as blocking; use this for `async`
+    functions that call synchronous clients (e.g. `OpenAI(...).completions.create`)."""
+    setattr(f, _blocking_attr, True)
+    return f
+
+
+def is_blocking(f: Callable[..., Any]) -> bool:
+    if getattr(f, _blocking_attr, False):
+        return True
+    return not (inspect.iscoroutinefunction(f) or inspect.isasyncgenfunction(f))
+
+
+def on_loop_close(f: Callable[[], None]):
+    """Registers `f` to be called on the event loop that runs a blocking `async` function
+    (see `BlockingExecutor`), right before the loop is closed. Use it to close resources
+    that are bound to the loop, e.g. connections."""
+    if f not in _loop_cleanups:
+        _loop_cleanups.append(f)
+
+
+class StillRunning(asyncio.CancelledError):
+    """Raised when a call is cancelled after it has started on a worker thread, where it
+    goes on until `future` is done."""
+
+    future: Future[Any]
+
+    def __init__(self, future: Future[Any]):
+        super().__init__("The call goes on running on its worker thread")
+        self.future = future
+
+
+class BlockingExecutor:
+    """A bounded pool of worker threads for functions that would block the event loop."""
+
+    max_workers: int
+    # Calls that are waiting for a free worker
+    queued: int
+    # Calls that are currently running on a worker
+    running: int
+
+    def __init__(self, max_workers: int = 4):
+        self.max_workers = max_workers
+        self.queued = 0
+        self.running = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="grimoire")
+
+    @property
+    def queue_depth(self) -> int:
+        """How many calls are waiting for or running on a worker."""
+        return self.queued + self.running
+
+    def _call(self, f: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            result = f(*args, **kwargs)
+            if inspect.isawaitable(result):
+                # An `async` function that was marked as blocking gets its own event loop
+                async def await_result():
+                    try:
+                        return await result
+                    finally:
+                        for cleanup in _loop_cleanups:
+                            cleanup()
+
+                result = asyncio.run(await_result())
+            return result
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    async def run(self, f: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Runs `f` on a worker thread. Cancelling the call only has an effect while it
+        is still queued: a call that has started runs to completion in the background,
+        and `StillRunning` is raised instead of `asyncio.CancelledError`."""
+        with self._lock:
+            self.queued += 1
+            queued = self.queued
+        if queued > self.max_workers:
+            log(f"{queued} blocking calls are waiting for a worker thread")
+        future = self._pool.submit(self._call, f, *args, **kwargs)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if not future.cancel():
+                raise StillRunning(future) from None
+            with self._lock:
+                self.queued -= 1
+            raise
+
+    def make_async[T](
+        self, f: Callable[..., Awaitable[T] | T]
+    ) -> Callable[..., Awaitable[T]]:
+        """Returns an `async` version of `f` that runs on this executor if `f` is blocking."""
+        if not is_blocking(f):
+            return f  # pyright: ignore[reportReturnType]
+
+        @wraps(f)
+        async def wrapped(*args: Any, **kwargs: Any) -> T:
+            return await self.run(f, *args, **kwargs)
+
+        # `wraps` copies the marker from `f`, but the wrapper itself does not block
+        setattr(wrapped, _blocking_attr, False)
+        return wrapped
+
+    def shutdown(self, cancel_pending: bool = True):
+        self._pool.shutdown(wait=False, cancel_futures=cancel_pending)
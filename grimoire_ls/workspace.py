@@ -2,21 +2,28 @@ from __future__ import annotations
 
 import itertools as it
 import math
-from collections.abc import Iterable, Iterator
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Iterable, Iterator, Sequence
 from dataclasses import dataclass
 from functools import lru_cache
 from pathlib import Path
 from typing import TYPE_CHECKING
 from urllib.parse import unquote_plus, urlparse
 
-import git
 from lsprotocol.types import Range
 
 if TYPE_CHECKING:
+    # GitPython is slow to import, so it is only imported once a workspace is scanned
+    import git
+
     from .server import GrimoireServer
 
 from . import language as lang
-from .logging import log
+from .logging import Level, log
 
 
 @dataclass
@@ -57,9 +64,9 @@ class Indentation:
             for line, stripped_line in zip(lines, stripped_lines)
         ]
         levels = sorted(set(line_levels))
-        log(line_levels)
-        log(levels)
-        log(f"Base level: {self.base_level}")
+        log(line_levels, Level.debug)
+        log(levels, Level.debug)
+        log(f"Base level: {self.base_level}", Level.debug)
         return [
             f"{self.char * self.size * (levels.index(line_level) + self.base_level)}{line}"
             for line, line_level in zip(stripped_lines, line_levels)
@@ -77,66 +84,347 @@ class Content:
         return Indentation.from_lines(self.content.splitlines())
 
 
+default_ignored_extensions = [
+    ".lock",
+    ".git",
+    ".log",
+    ".env",
+    ".envrc",
+]
+
+
+def has_ignored_extension(
+    path: Path, ignored_extensions: list[str] | None = None
+) -> bool:
+    ignored_extensions = ignored_extensions or default_ignored_extensions
+    return any(path.name.endswith(e) for e in ignored_extensions)
+
+
+def is_excluded(
+    root: Path, path: Path, ignored_extensions: list[str] | None = None
+) -> bool:
+    """Whether `path` is never part of the workspace at `root`, which is known without
+    asking git: it is outside of it, inside `.git`, or has an ignored extension."""
+    return (
+        not path.is_relative_to(root)
+        or ".git" in path.relative_to(root).parts
+        or has_ignored_extension(path, ignored_extensions)
+    )
+
+
 def filter_paths(
     repo: git.Repo,
     paths: Iterable[Path],
     ignored_extensions: list[str] | None = None,
 ) -> list[Path]:
-    ignored_extensions = ignored_extensions or [
-        ".lock",
-        ".git",
-        ".log",
-        ".env",
-        ".envrc",
-    ]
     paths, paths2 = it.tee(paths)
     ignored = repo.ignored(*map(str, paths2))
     return [
         p
         for p in paths
-        if str(p) not in ignored
-        and not any(p.name.endswith(e) for e in ignored_extensions)
+        if str(p) not in ignored and not has_ignored_extension(p, ignored_extensions)
     ]
 
 
-def visible_files(repo: git.Repo, path: Path) -> Iterator[Path]:
-    """Yields files in a directory, respecting .gitignore and excluding hidden files."""
-    subdirs: list[Path] = []
-    for p in filter_paths(repo, path.iterdir()):
-        if p.is_file():
-            yield p
-        else:
-            subdirs.append(p)
-    for d in subdirs:
-        for p in visible_files(repo, d):
+# Every file in a repository that is not ignored, by the root of its working tree
+_visible_files_cache: dict[Path, list[Path]] = {}
+
+
+def _git_visible_files(repo: git.Repo, root: Path) -> Iterator[Path]:
+    """Lists the tracked and untracked (but not ignored) files with a single git call,
+    and caches the result once it has been read completely."""
+    process = repo.git.ls_files(
+        "-z", "--cached", "--others", "--exclude-standard", as_process=True
+    )
+    files: list[Path] = []
+    remainder = b""
+    try:
+        for chunk in iter(lambda: process.stdout.read(1 << 16), b""):
+            *names, remainder = (remainder + chunk).split(b"\0")
+            for name in names:
+                p = root / os.fsdecode(name)
+                files.append(p)
+                yield p
+        _ = process.wait()
+    finally:
+        if process.proc is not None and process.proc.poll() is None:
+            process.proc.kill()
+    # Tracked files may be listed once per merge stage during conflicts
+    _visible_files_cache[root] = list(dict.fromkeys(files))
+
+
+def invalidate_visible_files(root: Path | None = None):
+    """Forgets the cached file listing for `root` (or for every repository)."""
+    if root is None:
+        _visible_files_cache.clear()
+    else:
+        _ = _visible_files_cache.pop(root, None)
+
+
+def visible_files(
+    repo: git.Repo,
+    path: Path,
+    ignored_extensions: list[str] | None = None,
+) -> Iterator[Path]:
+    """Yields files in a directory, respecting .gitignore and excluding hidden files.
+    The repository is listed in one pass and cached, so this is cheap to call repeatedly
+    and it is fine to stop iterating early."""
+    root = Path(repo.working_tree_dir or path)
+    cached = _visible_files_cache.get(root)
+    seen: set[Path] = set()
+    for p in cached if cached is not None else _git_visible_files(repo, root):
+        if (
+            p not in seen
+            and p.is_relative_to(path)
+            and not has_ignored_extension(p, ignored_extensions)
+            # Deleted files stay in the index until the deletion is staged
+            and p.is_file()
+        ):
+            seen.add(p)
             yield p
 
 
-def workspace_file_contents(server: GrimoireServer) -> dict[Path, list[str]]:
+def workspace_file_contents(server: GrimoireServer) -> dict[Path, Sequence[str]]:
     """Returns a dictionary mapping from each path in the workspace to its content.
     Excludes empty files & hidden files, and respects .gitignore."""
     root = server.workspace.root_path
-    files: dict[Path, list[str]] = {}
+    files: dict[Path, Sequence[str]] = {}
     if root:
+        import git
+
         for p in visible_files(git.Repo(root), Path(root)):
-            uri = p.as_uri()
-            content = server.workspace.get_text_document(uri).lines
+            try:
+                content = server.workspace.get_text_document(p.as_uri()).lines
+            except (OSError, UnicodeDecodeError) as e:
+                # e.g. binary files, which are not useful as context
+                log(f"Could not read {p}: {e}", Level.warning)
+                continue
             if content:
                 files[p] = content
     return files
 
 
+identifier_pattern = re.compile(r"[A-Za-z_][A-Za-z0-9_]{2,}")
+
+
+def identifiers(text: str) -> set[str]:
+    """Returns the identifier-like words (at least three characters long) in `text`."""
+    return set(identifier_pattern.findall(text))
+
+
+class IdentifierIndex:
+    """An inverted index from identifiers to the files that contain them."""
+
+    postings: dict[str, set[Path]]
+    by_path: dict[Path, frozenset[str]]
+    by_dir: dict[Path, set[Path]]
+
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.by_path = {}
+        self.by_dir = defaultdict(set)
+
+    def add(self, path: Path, lines: Sequence[str]):
+        self.remove(path)
+        idents = frozenset(identifier_pattern.findall("".join(lines)))
+        self.by_path[path] = idents
+        self.by_dir[path.parent].add(path)
+        for ident in idents:
+            self.postings[ident].add(path)
+
+    def remove(self, path: Path):
+        idents = self.by_path.pop(path, None)
+        if idents is None:
+            return
+        self.by_dir[path.parent].discard(path)
+        for ident in idents:
+            paths = self.postings[ident]
+            paths.discard(path)
+            if not paths:
+                del self.postings[ident]
+
+    def idf(self, ident: str) -> float:
+        """The inverse document frequency of `ident` (0 if no file contains it)."""
+        paths = self.postings.get(ident)
+        if not paths:
+            return 0.0
+        return math.log(1 + len(self.by_path) / len(paths))
+
+
+class WorkspaceSnapshot:
+    """An in-memory copy of the visible files in a workspace.
+
+    The snapshot is built once from disk, and then kept up to date from the documents
+    that the client has open and from file system events, so reading it is cheap."""
+
+    root: Path
+    files: dict[Path, Sequence[str]]
+    index: IdentifierIndex
+    # When each file was last edited in the client (as reported by `time.monotonic`)
+    edited_at: dict[Path, float]
+    # Held while the snapshot changes, as handlers on worker threads sync it; readers
+    # should hold it too
+    lock: threading.RLock
+    # Documents that are being edited are indexed again at most this often (in seconds)
+    index_interval: float = 2.0
+
+    def __init__(self, root: Path, files: dict[Path, Sequence[str]]):
+        import git
+
+        self.root = root
+        self.files = files
+        self.index = IdentifierIndex()
+        for path, lines in files.items():
+            self.index.add(path, lines)
+        self.edited_at = {}
+        self.lock = threading.RLock()
+        self._repo: git.Repo = git.Repo(root)
+        self._open_versions: dict[str, int | None] = {}
+        self._hidden: set[Path] = set()
+        # When each edited document was last indexed, and those that changed since
+        self._indexed_at: dict[Path, float] = {}
+        self._unindexed: set[Path] = set()
+
+    @classmethod
+    def build(cls, server: GrimoireServer) -> WorkspaceSnapshot | None:
+        """Reads the visible files of the server's workspace (if it has a root)."""
+        root = server.workspace.root_path
+        if not root:
+            return None
+        return cls(Path(root), workspace_file_contents(server))
+
+    def is_visible(self, path: Path) -> bool:
+        """Whether `path` is inside the workspace and is not ignored."""
+        if path in self.files:
+            return True
+        if path in self._hidden or is_excluded(self.root, path):
+            return False
+        if not filter_paths(self._repo, [path]):
+            self._hidden.add(path)
+            return False
+        return True
+
+    def update(self, path: Path, lines: Sequence[str]):
+        """Replaces the content of `path`, dropping it if the content is empty."""
+        with self.lock:
+            if lines:
+                self.files[path] = lines
+                self.index.add(path, lines)
+            else:
+                _ = self.files.pop(path, None)
+                self.index.remove(path)
+
+    def remove(self, path: Path):
+        """Removes `path` (or every file below it, if it is a directory)."""
+        with self.lock:
+            for p in [path, *(p for p in self.files if p.is_relative_to(path))]:
+                _ = self.files.pop(p, None)
+                _ = self.edited_at.pop(p, None)
+                _ = self._indexed_at.pop(p, None)
+                self._unindexed.discard(p)
+                self.index.remove(p)
+
+    def reload(self, paths: Iterable[Path]):
+        """Re-reads `paths` from disk (or every visible file below those that are
+        directories), and drops the ones that no longer exist or are ignored.
+        Git is asked about all the new files at once, and the lock is not held meanwhile."""
+        paths = [p for p in paths if not is_excluded(self.root, p)]
+        if any(p.name == ".gitignore" for p in paths):
+            # Files that were ignored may no longer be
+            with self.lock:
+                self._hidden.clear()
+            invalidate_visible_files(self.root)
+        files = [p for p in paths if p.is_file()]
+        directories = [p for p in paths if p.is_dir()]
+        new = [p for p in files if p not in self.files and p not in self._hidden]
+        visible = set(filter_paths(self._repo, new)) if new else set()
+        with self.lock:
+            self._hidden.update(p for p in new if p not in visible)
+        if visible or directories:
+            # The cached listing of the repository is missing the new files, and is
+            # listed again when it is next needed
+            invalidate_visible_files(self.root)
+
+        for path in files:
+            if path in self.files or path in visible:
+                self._read(path)
+        for directory in directories:
+            for path in visible_files(self._repo, directory):
+                self._read(path)
+        for path in paths:
+            if not path.exists():
+                self.remove(path)
+
+    def _read(self, path: Path):
+        try:
+            self.update(path, path.read_text().splitlines(keepends=True))
+        except (OSError, UnicodeDecodeError) as e:
+            log(f"Could not read {path}: {e}", Level.warning)
+            self.remove(path)
+
+    def sync(self, server: GrimoireServer):
+        """Brings the snapshot up to date with the documents open in the client.
+        Only documents whose version changed since the last sync are copied."""
+        with self.lock:
+            # Copy the documents, as handlers on worker threads may sync while the client edits
+            open_documents = dict(server.workspace.text_documents)
+            for uri in [
+                uri for uri in self._open_versions if uri not in open_documents
+            ]:
+                # The buffer may have been closed without saving, so trust the disk again
+                del self._open_versions[uri]
+                self.reload([uri_to_path(uri)])
+
+            for uri, document in open_documents.items():
+                if (
+                    uri in self._open_versions
+                    and self._open_versions[uri] == document.version
+                ):
+                    continue
+                path = uri_to_path(uri)
+                if not self.is_visible(path):
+                    continue
+                if uri in self._open_versions:
+                    self.edited_at[path] = time.monotonic()
+                self._open_versions[uri] = document.version
+                self._update_edited(path, document.lines)
+            self._index_edited()
+
+    def _update_edited(self, path: Path, lines: Sequence[str]):
+        # Tokenizing the whole document on every keystroke would be wasted, as the
+        # identifiers of a file change little between two versions
+        now = time.monotonic()
+        if (
+            not lines
+            or now - self._indexed_at.get(path, -math.inf) >= self.index_interval
+        ):
+            self.update(path, lines)
+            self._indexed_at[path] = now
+            self._unindexed.discard(path)
+        else:
+            self.files[path] = lines
+            self._unindexed.add(path)
+
+    def _index_edited(self):
+        now = time.monotonic()
+        for path in list(self._unindexed):
+            if now - self._indexed_at[path] >= self.index_interval:
+                self.index.add(path, self.files[path])
+                self._indexed_at[path] = now
+                self._unindexed.discard(path)
+
+
 def uri_to_path(uri: str) -> Path:
     """Returns the path corresponding to `uri`."""
     return Path(unquote_plus(urlparse(uri).path))
 
 
 def lines_from_range(
-    lines: list[str],
+    lines: Sequence[str],
     range_: Range,
 ) -> list[str]:
-    lines = lines[range_.start.line : range_.end.line + 1]
-    if lines:
-        lines[0] = lines[0][range_.start.character :]
-        lines[-1] = lines[-1][: range_.end.character + 1]
-    return lines
+    selected = list(lines[range_.start.line : range_.end.line + 1])
+    if selected:
+        selected[0] = selected[0][range_.start.character :]
+        selected[-1] = selected[-1][: range_.end.character + 1]
+    return selected
@@ -0,0 +1,188 @@
+import asyncio
+import socket
+from collections.abc import Awaitable, Callable
+from contextlib import aclosing
+from typing import Any
+
+import pytest
+from result import Err, Ok
+
+from benchmarks.fake_model import FakeModel, ModelOptions, generate
+from grimoire_ls import backend as backend_module
+from grimoire_ls.backend import BackendError, BackendOptions, OpenAIBackend
+
+expected = "".join(generate(8))
+
+
+def with_model(
+    test: Callable[[OpenAIBackend, FakeModel], Awaitable[None]],
+    latency: float = 0.0,
+    **options: Any,
+):
+    async def main():
+        model = FakeModel(ModelOptions(latency=latency, tokens_per_second=1e6))
+        await model.start()
+        backend = OpenAIBackend(
+            BackendOptions(base_url=model.base_url, **options), max_tokens=8
+        )
+        try:
+            await test(backend, model)
+        finally:
+            backend_module.close_pools()
+            await model.close()
+
+    asyncio.run(main())
+
+
+def idle(backend: OpenAIBackend) -> int:
+    return len(backend._pool._idle)  # pyright: ignore[reportPrivateUsage]
+
+
+def test_complete_and_chat():
+    async def test(backend: OpenAIBackend, model: FakeModel):
+        assert await backend.complete("x = ") == Ok(expected)
+        assert await backend.chat([{"role": "user", "content": "hi"}]) == Ok(expected)
+        # Both requests went over the same connection
+        assert idle(backend) == 1
+        assert len(model._connections) == 1  # pyright: ignore[reportPrivateUsage]
+
+    with_model(test)
+
+
+def test_stream():
+    async def test(backend: OpenAIBackend, model: FakeModel):
+        tokens = [token async for token in backend.stream_complete("x = ")]
+        assert tokens == generate(8)
+        messages = [{"role": "user", "content": "hi"}]
+        assert "".join([t async for t in backend.stream_chat(messages)]) == expected
+        # The rest of the body after `[DONE]` was read, so the connection is reused
+        assert idle(backend) == 1
+
+    with_model(test)
+
+
+def test_closing_a_stream_early_drops_the_connection():
+    async def test(backend: OpenAIBackend, model: FakeModel):
+        async with aclosing(backend.stream_complete("x = ", max_tokens=100)) as tokens:
+            async for _ in tokens:
+                break
+        # The connection was in the middle of a response, so it cannot be reused
+        assert idle(backend) == 0
+        assert await backend.complete("x = ") == Ok(expected)
+        assert model.requests == 2
+
+    with_model(test)
+
+
+def test_connection_closed_by_the_server_is_replaced():
+    async def test(backend: OpenAIBackend, model: FakeModel):
+        assert await backend.complete("x = ") == Ok(expected)
+        for writer in list(model._connections):  # pyright: ignore[reportPrivateUsage]
+            writer.close()
+        await asyncio.sleep(0.01)
+        assert await backend.complete("x = ") == Ok(expected)
+
+    with_model(test)
+
+
+def test_client_error():
+    async def test(backend: OpenAIBackend, _model: FakeModel):
+        with pytest.raises(BackendError, match="404"):
+            _ = await backend.request("/embeddings")
+        # The response was read to the end, so the connection is kept
+        assert idle(backend) == 1
+
+    with_model(test)
+
+
+def test_timeout():
+    async def test(backend: OpenAIBackend, _model: FakeModel):
+        with pytest.raises(BackendError, match="timed out"):
+            _ = await backend.request("/completions", prompt="x")
+        result = await backend.complete("x = ", timeout=0.05)
+        assert isinstance(result, Err) and "timed out" in result.err_value
+        assert idle(backend) == 0
+
+    with_model(test, latency=1.0, timeout=0.05)
+
+
+async def _stub_server(response: bytes) -> asyncio.Server:
+    """Answers every request with `response`, then closes the connection."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while (await reader.readline()).strip():
+            pass
+        writer.write(response)
+        await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+@pytest.mark.parametrize(
+    ("response", "error"),
+    [
+        (
+            b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 7\r\n\r\nloading",
+            "503 from /completions: loading",
+        ),
+        (b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\n{x}", "Invalid JSON"),
+        (b"garbage\r\n\r\n", "Invalid response"),
+        (b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n{}", "Could not read"),
+    ],
+)
+def test_server_errors(response: bytes, error: str):
+    async def main():
+        server = await _stub_server(response)
+        port = server.sockets[0].getsockname()[1]
+        backend = OpenAIBackend(BackendOptions(base_url=f"http://127.0.0.1:{port}/v1"))
+        try:
+            with pytest.raises(BackendError, match=error):
+                _ = await backend.request("/completions", prompt="x")
+        finally:
+            backend_module.close_pools()
+            server.close()
+
+    asyncio.run(main())
+
+
+def test_connection_refused():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    backend = OpenAIBackend(BackendOptions(base_url=f"http://127.0.0.1:{port}/v1"))
+
+    async def main():
+        with pytest.raises(BackendError, match="Could not reach"):
+            _ = await backend.request("/completions", prompt="x")
+        result = await backend.complete("x")
+        assert isinstance(result, Err)
+
+    asyncio.run(main())
+
+
+def test_backend_is_used_from_several_event_loops():
+    async def main():
+        model = FakeModel(ModelOptions(latency=0.0, tokens_per_second=1e6))
+        await model.start()
+        backend = OpenAIBackend(BackendOptions(base_url=model.base_url), max_tokens=8)
+        try:
+            assert await backend.complete("x = ") == Ok(expected)
+
+            async def on_another_loop():
+                try:
+                    return await backend.complete("x = ")
+                finally:
+                    backend_module.close_pools()
+
+            # e.g. a blocking handler that runs on a worker thread with its own loop
+            result = await asyncio.to_thread(asyncio.run, on_another_loop())
+            assert result == Ok(expected)
+            # The connection of this loop is still in its pool, and is reused
+            assert idle(backend) == 1
+            assert await backend.complete("x = ") == Ok(expected)
+        finally:
+            backend.close()
+            await model.close()
+
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+import subprocess
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+from lsprotocol.types import TextDocumentItem
+from pygls.workspace import Workspace
+
+from grimoire_ls.batch import BatchOptions, find_targets, function_ranges, matches_glob
+
+
+@pytest.mark.parametrize(
+    ("path", "glob", "expected"),
+    [
+        ("a.py", "**/*.py", True),
+        ("src/a.py", "**/*.py", True),
+        ("src/a.py", "*.rs", False),
+        # By default, the source files of known languages
+        ("src/a.py", None, True),
+        ("notes.txt", None, False),
+        ("README.md", None, False),
+        ("image.png", None, False),
+        ("Makefile", None, False),
+    ],
+)
+def test_matches_glob(path: str, glob: str | None, expected: bool):
+    assert matches_glob(path, glob) == expected
+
+
+def test_function_ranges():
+    lines = [
+        "import os\n",
+        "\n",
+        "def f(x):\n",
+        "    return x\n",
+        "\n",
+        "async def g():\n",
+        "    pass\n",
+        "x = 1\n",
+    ]
+    ranges = function_ranges(lines)
+    assert [(r.start.line, r.end.line, r.end.character) for r in ranges] == [
+        (2, 3, 12),
+        (5, 6, 8),
+    ]
+
+
+def test_find_targets_skips_unreadable_files(tmp_path: Path):
+    _ = subprocess.run(["git", "init", "-q", str(tmp_path)], check=True)
+    (tmp_path / "a.py").write_text("def f():\n    pass\n")
+    (tmp_path / "b.txt").write_text("notes\n")
+    (tmp_path / "broken.py").write_bytes(b"\xff\xfe\x00binary")
+    (tmp_path / "image.png").write_bytes(b"\x89PNG\r\n\x1a\n\xff")
+    server: Any = SimpleNamespace(workspace=Workspace(tmp_path.as_uri()))
+
+    targets = find_targets(server, BatchOptions())
+    assert [Path(t.uri).name for t in targets] == ["a.py"]
+    assert targets[0].version is None
+
+    targets = find_targets(server, BatchOptions(glob="**/*.py", functions=True))
+    assert [(Path(t.uri).name, t.range.start.line) for t in targets] == [("a.py", 0)]
+
+
+def test_targets_of_open_documents_are_versioned(tmp_path: Path):
+    _ = subprocess.run(["git", "init", "-q", str(tmp_path)], check=True)
+    (tmp_path / "a.py").write_text("def f():\n    pass\n")
+    server: Any = SimpleNamespace(workspace=Workspace(tmp_path.as_uri()))
+    uri = (tmp_path / "a.py").as_uri()
+    server.workspace.put_text_document(
+        TextDocumentItem(uri=uri, language_id="python", version=7, text="def g():\n")
+    )
+    [target] = find_targets(server, BatchOptions())
+    assert (target.lines, target.version) == (["def g():\n"], 7)
@@ -0,0 +1,125 @@
+from pathlib import Path
+
+import pytest
+
+from grimoire_ls.cache import CacheOptions, CompletionCache, PersistentCache
+
+
+def text_cache(**options) -> CompletionCache[str]:
+    return CompletionCache(
+        lambda item: item, lambda _, text: text, CacheOptions(**options)
+    )
+
+
+def test_exact_hit():
+    cache = text_cache()
+    cache.put("x = ", "\n", ["compute()"])
+    assert cache.get("x = ", "\n") == ["compute()"]
+    assert cache.stats.hits == 1
+
+
+def test_miss_on_different_suffix():
+    cache = text_cache()
+    cache.put("x = ", "\n", ["compute()"])
+    assert cache.get("x = ", "\ny = 1\n") is None
+    assert cache.stats.misses == 1
+
+
+@pytest.mark.parametrize(
+    ("typed", "expected"),
+    [
+        ("c", ["ompute()"]),
+        ("comp", ["ute()"]),
+        # The completion was typed in full, so there is nothing left to suggest
+        ("compute()", None),
+        # The user typed something else
+        ("z", None),
+    ],
+)
+def test_type_ahead(typed: str, expected: list[str] | None):
+    cache = text_cache()
+    cache.put("x = ", "\n", ["compute()", "complete"])
+    result = cache.get("x = " + typed, "\n")
+    if expected is None:
+        assert result is None
+    else:
+        assert result is not None and result[0] == expected[0]
+
+
+def test_type_ahead_keeps_only_matching_items():
+    cache = text_cache()
+    cache.put("x = ", "\n", ["compute()", "complete", "other"])
+    assert cache.get("x = comp", "\n") == ["ute()", "lete"]
+    assert cache.stats.type_ahead_hits == 1
+
+
+def test_type_ahead_limit():
+    cache = text_cache(max_type_ahead=2)
+    cache.put("x = ", "\n", ["compute()"])
+    assert cache.get("x = com", "\n") is None
+    assert cache.get("x = co", "\n") == ["mpute()"]
+
+
+def test_type_ahead_requires_same_prefix():
+    cache = text_cache()
+    cache.put("x = ", "\n", ["compute()"])
+    # Same length as the cached text before the cursor, but different content
+    assert cache.get("y = c", "\n") is None
+
+
+def test_lru_eviction():
+    cache = text_cache(max_size=2)
+    cache.put("a", "", ["1"])
+    cache.put("b", "", ["2"])
+    assert cache.get("a", "") == ["1"]
+    cache.put("c", "", ["3"])
+    assert cache.get("b", "") is None
+    assert cache.get("a", "") == ["1"]
+    assert cache.stats.evictions == 1
+
+
+def test_ttl(monkeypatch: pytest.MonkeyPatch):
+    now = [1000.0]
+    monkeypatch.setattr("grimoire_ls.cache.time.monotonic", lambda: now[0])
+    cache = text_cache(ttl=10.0)
+    cache.put("x = ", "\n", ["compute()"])
+    now[0] += 11
+    assert cache.get("x = ", "\n") is None
+    assert cache.get("x = c", "\n") is None
+
+
+def test_reconfigure_evicts_to_new_size():
+    cache = text_cache(max_size=3)
+    for key in "abc":
+        cache.put(key, "", [key])
+    cache.reconfigure(CacheOptions(max_size=1))
+    assert cache.get("a", "") is None
+    assert cache.get("c", "") == ["c"]
+
+
+def test_persistent_cache_survives_reopening(tmp_path: Path):
+    cache = PersistentCache(tmp_path / "cache.db")
+    cache.put("a", "1")
+    cache.close()
+    cache = PersistentCache(tmp_path / "cache.db")
+    assert cache.get("a") == "1"
+    assert cache.get("b") is None
+    cache.close()
+
+
+def test_persistent_cache_hits_are_written_in_batches(tmp_path: Path):
+    cache = PersistentCache(tmp_path / "cache.db", max_entries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    last_used = cache._db.execute("SELECT key, last_used FROM results").fetchall()
+    assert cache.get("a") == "1"
+    # The hit is only kept in memory...
+    assert cache._db.execute("SELECT key, last_used FROM results").fetchall() == (
+        last_used
+    )
+    # ...until an eviction needs it, so the least recently used entry is still evicted
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.stats.evictions == 1
+    cache.close()
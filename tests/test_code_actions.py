@@ -0,0 +1,102 @@
+import asyncio
+from collections.abc import Sequence
+from typing import Any
+
+import pytest
+from lsprotocol.types import Position, TextEdit, WorkspaceEdit
+from result import Err
+
+from grimoire_ls import code_actions
+from grimoire_ls.backend import BackendError
+from grimoire_ls.code_actions import StreamedText
+from grimoire_ls.workspace import Indentation
+
+
+class Editor:
+    """Applies the edits of a `StreamedText` to its own copy of a document."""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.edits: list[Sequence[TextEdit]] = []
+
+    def offset(self, position: Position) -> int:
+        lines = self.text.split("\n")
+        return (
+            sum(len(line) + 1 for line in lines[: position.line]) + position.character
+        )
+
+    def apply_edit(self, edit: WorkspaceEdit):
+        edits = (edit.changes or {})["file:///a.py"]
+        self.edits.append(edits)
+        spans = [
+            (self.offset(e.range.start), self.offset(e.range.end), e) for e in edits
+        ]
+        for start, end, e in sorted(spans, key=lambda span: span[0], reverse=True):
+            self.text = self.text[:start] + e.new_text + self.text[end:]
+
+
+@pytest.fixture(autouse=True)
+def no_interval(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(code_actions, "_stream_interval", 0.0)
+
+
+def streamed(editor: Editor) -> StreamedText:
+    ls: Any = editor
+    original = "    old = 1\n    old = 2"
+    return StreamedText(
+        ls, "file:///a.py", Position(1, 0), original, Indentation(4, " ", 1)
+    )
+
+
+def test_streaming_appends_the_new_lines():
+    editor = Editor("def f():\n    old = 1\n    old = 2\nprint(f())\n")
+    text = streamed(editor)
+    generated = ""
+    for chunk in ["x = 1\n", "y = ", "2\n", "z = 3\n", "return x"]:
+        generated += chunk
+        text.update(generated)
+    assert editor.text == "def f():\n    x = 1\n    y = 2\n    z = 3\nprint(f())\n"
+    # The original text is replaced once, and the other updates only insert lines
+    assert len(editor.edits) == 3
+    for edits in editor.edits[1:]:
+        assert [e.range.start == e.range.end for e in edits] == [True]
+
+    text.show(code_actions.format_result(generated, text.indent))
+    assert editor.text == (
+        "def f():\n    x = 1\n    y = 2\n    z = 3\n    return x\nprint(f())\n"
+    )
+    assert [e.new_text for e in editor.edits[-1]] == ["\n    return x"]
+
+
+def test_streaming_replaces_lines_that_are_indented_again():
+    editor = Editor("def f():\n    old = 1\n    old = 2\nprint(f())\n")
+    text = streamed(editor)
+    text.update("  x = 1\n")
+    # A new indentation level changes the indentation of the first line
+    text.update("  x = 1\ny = 2\n")
+    assert editor.text == "def f():\n        x = 1\n    y = 2\nprint(f())\n"
+
+
+def test_revert_restores_the_original():
+    document = "def f():\n    old = 1\n    old = 2\nprint(f())\n"
+    editor = Editor(document)
+    text = streamed(editor)
+    text.update("x = 1\ny = 2\n")
+    text.revert()
+    assert editor.text == document
+
+
+def test_collected_stream_fails_when_the_model_fails():
+    async def generate(error: Exception):
+        yield "x = 1\n"
+        raise error
+
+    async def collect(error: Exception):
+        transform = code_actions.collect_stream(lambda *_: generate(error))
+        return await transform("", None)
+
+    result = asyncio.run(collect(BackendError("503 from /completions")))
+    assert result == Err("503 from /completions")
+    # Other errors are bugs in the transform
+    with pytest.raises(KeyError):
+        _ = asyncio.run(collect(KeyError("x")))
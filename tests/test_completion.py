@@ -0,0 +1,208 @@
+import subprocess
+import time
+from collections.abc import Sequence
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+from lsprotocol.types import (
+    InlineCompletionContext,
+    InlineCompletionParams,
+    InlineCompletionTriggerKind,
+    Position,
+    TextDocumentIdentifier,
+    TextDocumentItem,
+)
+from pygls.workspace import Workspace
+
+from grimoire_ls import completion
+from grimoire_ls import language as lang
+from grimoire_ls.completion import (
+    WindowOptions,
+    _window,
+    assemble_workspace_context,
+    estimate_tokens,
+    local_context,
+    local_context_lines,
+    rank_files,
+)
+from grimoire_ls.document import DocumentView
+from grimoire_ls.workspace import WorkspaceSnapshot
+
+python = lang.from_extension(".py")
+header = "import os\nimport sys\n\n"
+functions = "".join(f"def f{i}():\n    return {i}\n\n" for i in range(100))
+
+
+def window(text: str, options: WindowOptions) -> tuple[str, str]:
+    view = DocumentView(text)
+    return _window(view, len(text), python, options, estimate_tokens)
+
+
+def test_file_without_definitions_is_limited():
+    text = "".join(f"x{i} = {i}\n" for i in range(30))
+    before, _ = window(text, WindowOptions(prefix_lines=5, snap=0))
+    assert before == "".join(f"x{i} = {i}\n" for i in range(25, 30))
+
+
+def test_header_is_kept_above_the_window():
+    before, _ = window(header + functions, WindowOptions(prefix_lines=6))
+    assert before.startswith("import os\nimport sys\n\n# ...\n\ndef f98():")
+
+
+@pytest.mark.parametrize(
+    "options",
+    [WindowOptions(prefix_chars=120), WindowOptions(prefix_tokens=30)],
+)
+def test_header_counts_against_the_limits(options: WindowOptions):
+    before, _ = window(header + functions, options)
+    assert before.startswith("import os\n")
+    assert "def f99():" in before
+    if options.prefix_chars is not None:
+        assert len(before) <= options.prefix_chars
+    if options.prefix_tokens is not None:
+        assert estimate_tokens(before) <= options.prefix_tokens
+
+
+@pytest.mark.parametrize("prefix_chars", [20, 30])
+def test_header_that_does_not_fit_is_left_out(prefix_chars: int):
+    # At 30 characters, the header fits but leaves no room for the window
+    before, _ = window(header + functions, WindowOptions(prefix_chars=prefix_chars))
+    assert "import" not in before
+    assert before.endswith("    return 99\n\n")
+    assert len(before) <= prefix_chars
+
+
+def test_window_that_reaches_the_header_starts_at_the_top():
+    text = header + functions[:200]
+    before, _ = window(text, WindowOptions(prefix_lines=len(text.splitlines()) - 1))
+    assert before == text
+    # Unless the rest of the header does not fit
+    before, _ = window(text, WindowOptions(prefix_chars=len(text) - 5))
+    assert not before.startswith("import os\n")
+
+
+def server_with(text: str) -> Any:
+    workspace = Workspace("file:///project")
+    workspace.put_text_document(
+        TextDocumentItem(
+            uri="file:///project/a.py", language_id="python", version=1, text=text
+        )
+    )
+    return SimpleNamespace(workspace=workspace)
+
+
+def cursor_at(line: int, character: int) -> InlineCompletionParams:
+    return InlineCompletionParams(
+        text_document=TextDocumentIdentifier(uri="file:///project/a.py"),
+        position=Position(line, character),
+        context=InlineCompletionContext(
+            trigger_kind=InlineCompletionTriggerKind.Automatic
+        ),
+    )
+
+
+def test_local_context_is_bounded():
+    lines = [f"x{i} = {i}\n" for i in range(1000)]
+    server = server_with("".join(lines))
+    before, after = local_context(server, cursor_at(500, 2))
+    assert before.count("\n") < local_context_lines
+    assert after.count("\n") <= local_context_lines
+    assert before.endswith("x499 = 499\nx5")
+    assert after.startswith("00 = 500\n")
+
+
+def test_local_context_grows_while_typing():
+    lines = [f"x{i} = {i}\n" for i in range(1000)]
+    server = server_with("".join(lines))
+    before, after = local_context(server, cursor_at(500, 0))
+    # After typing `x500 = 500\n` into a new line, the cached completion still matches
+    server = server_with("".join([*lines[:500], "x500 = 500\n", *lines[500:]]))
+    typed_before, typed_after = local_context(server, cursor_at(501, 0))
+    assert typed_before == before + "x500 = 500\n"
+    assert typed_after == after
+
+
+filler = "".join(f"def filler{i}(shared_name):\n    return {i}\n\n" for i in range(20))
+workspace_files = {
+    "src/main.py": "import os\n\nvalue = shared_name\n",
+    "src/helpers.py": filler + "def parse_config(path):\n    return path\n\n" + filler,
+    "src/other.py": "def unrelated(shared_name):\n    pass\n",
+    "lib/deep/loader.py": "from src.helpers import parse_config\n\nshared_name = 1\n",
+    "docs/far.py": "shared_name = 2\n",
+}
+
+
+@pytest.fixture
+def snapshot(tmp_path: Path) -> WorkspaceSnapshot:
+    _ = subprocess.run(["git", "init", "-q", str(tmp_path)], check=True)
+    files: dict[Path, Sequence[str]] = {
+        tmp_path / name: text.splitlines(keepends=True)
+        for name, text in workspace_files.items()
+    }
+    return WorkspaceSnapshot(tmp_path, files)
+
+
+def names(snapshot: WorkspaceSnapshot, paths: list[Path]) -> list[str]:
+    return [p.relative_to(snapshot.root).as_posix() for p in paths]
+
+
+def test_files_are_ranked_by_shared_identifiers_and_directory(
+    snapshot: WorkspaceSnapshot,
+):
+    main = snapshot.root / "src/main.py"
+    ranked = rank_files(snapshot, main, {"parse_config"})
+    assert names(snapshot, ranked) == [
+        "src/helpers.py",
+        "lib/deep/loader.py",
+        "src/other.py",
+    ]
+    # Identifiers in most files are ignored, leaving the files in the same directory
+    ranked = rank_files(snapshot, main, {"shared_name"})
+    assert sorted(names(snapshot, ranked)) == ["src/helpers.py", "src/other.py"]
+
+
+def test_recently_edited_files_are_ranked_higher(snapshot: WorkspaceSnapshot):
+    main = snapshot.root / "src/main.py"
+    far = snapshot.root / "docs/far.py"
+    snapshot.edited_at[far] = time.monotonic()
+    ranked = rank_files(snapshot, main, set())
+    assert names(snapshot, ranked)[0] == "docs/far.py"
+    assert len(ranked) == 3
+    # The boost decays with time
+    snapshot.edited_at[far] = time.monotonic() - 100 * completion.recency_decay
+    ranked = rank_files(snapshot, main, set())
+    assert names(snapshot, ranked)[-1] == "docs/far.py"
+
+
+@pytest.mark.parametrize("max_tokens", [0, 5, 20, 50, 200, 10_000])
+def test_workspace_context_fits_the_budget(
+    snapshot: WorkspaceSnapshot, max_tokens: int
+):
+    main = snapshot.root / "src/main.py"
+    sections = assemble_workspace_context(
+        snapshot, main, "x = parse_config(path)", max_tokens
+    )
+    assert sum(estimate_tokens(section) for section in sections) <= max_tokens
+    assert all(section.startswith("\n# ") for section in sections)
+
+
+def test_workspace_context_puts_the_most_relevant_file_last(
+    snapshot: WorkspaceSnapshot,
+):
+    main = snapshot.root / "src/main.py"
+    sections = assemble_workspace_context(snapshot, main, "parse_config", 10_000)
+    headers = [section.splitlines()[1] for section in sections]
+    assert headers == ["# src/other.py", "# lib/deep/loader.py", "# src/helpers.py"]
+    assert sections[-1].endswith(workspace_files["src/helpers.py"])
+
+
+def test_workspace_context_excerpts_large_files(snapshot: WorkspaceSnapshot):
+    main = snapshot.root / "src/main.py"
+    sections = assemble_workspace_context(snapshot, main, "parse_config", 30)
+    excerpt = sections[-1]
+    assert excerpt.startswith("\n# src/helpers.py\n# ...\n")
+    assert "def parse_config(path):\n" in excerpt
+    # Only the blocks that mention the identifiers around the cursor
+    assert "filler" not in excerpt
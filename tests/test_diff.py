@@ -0,0 +1,101 @@
+import random
+from functools import cache
+from itertools import pairwise
+
+import pytest
+from lsprotocol.types import Position, Range
+
+from grimoire_ls.diff import diff, edits_at, split_lines, text_edits, text_hunks
+
+
+def lcs_length(a: str, b: str) -> int:
+    @cache
+    def lcs(i: int, j: int) -> int:
+        if i == len(a) or j == len(b):
+            return 0
+        if a[i] == b[j]:
+            return 1 + lcs(i + 1, j + 1)
+        return max(lcs(i + 1, j), lcs(i, j + 1))
+
+    return lcs(0, 0)
+
+
+def apply_hunks(a: str, b: str, hunks: list[tuple[int, int, int, int]]) -> str:
+    for a0, a1, b0, b1 in reversed(hunks):
+        a = a[:a0] + b[b0:b1] + a[a1:]
+    return a
+
+
+def random_pairs(n: int):
+    rng = random.Random(0)
+    for _ in range(n):
+        a = "".join(rng.choices("abc", k=rng.randrange(12)))
+        b = "".join(rng.choices("abc", k=rng.randrange(12)))
+        yield a, b
+
+
+@pytest.mark.parametrize(("a", "b"), list(random_pairs(300)))
+def test_diff_is_minimal(a: str, b: str):
+    hunks = diff(a, b)
+    assert apply_hunks(a, b, hunks) == b
+    changed = sum((a1 - a0) + (b1 - b0) for a0, a1, b0, b1 in hunks)
+    assert changed == len(a) + len(b) - 2 * lcs_length(a, b)
+    # Hunks are sorted, and adjacent hunks are merged
+    for (_, prev_a1, _, prev_b1), (a0, _, b0, _) in pairwise(hunks):
+        assert (prev_a1, prev_b1) < (a0, b0) and (prev_a1, prev_b1) != (a0, b0)
+
+
+def test_diff_replaces_very_different_ranges_as_a_whole():
+    rng = random.Random(0)
+    a = ["same\n"] + [f"{rng.random()}\n" for _ in range(200)] + ["end\n"]
+    b = ["same\n"] + [f"{rng.random()}\n" for _ in range(200)] + ["end\n"]
+    assert diff(a, b, max_d=100) == [(1, 201, 1, 201)]
+    assert len(diff(a, b, max_d=None)) == 1
+    c = list(a)
+    c[50] = "changed\n"
+    assert diff(a, c, max_d=100) == [(50, 51, 50, 51)]
+
+
+@pytest.mark.parametrize(
+    ("old", "new"),
+    [
+        ("a\nb\nc\n", "a\nB\nc\n"),
+        ("a\nb\nc", "a\nc\nd\ne"),
+        ("x = 1\r\ny = 2\r\n", "x = 1\r\ny = 3\r\nz = 4\r\n"),
+        ("", "new\n"),
+        ("old\n", ""),
+    ],
+)
+def test_text_hunks(old: str, new: str):
+    for characters in (True, False):
+        assert apply_hunks(old, new, text_hunks(old, new, characters)) == new
+
+
+def apply_edits(text: str, edits) -> str:
+    lines = split_lines(text)
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+
+    def offset(position: Position) -> int:
+        return offsets[min(position.line, len(lines))] + position.character
+
+    for edit in sorted(edits, key=lambda e: offset(e.range.start), reverse=True):
+        start, end = offset(edit.range.start), offset(edit.range.end)
+        text = text[:start] + edit.new_text + text[end:]
+    return text
+
+
+def test_text_edits_replace_the_range():
+    document = "def f():\n    return 1\n\nprint(f())\n"
+    lines = split_lines(document)
+    range_ = Range(Position(0, 4), Position(1, 12))
+    edits = text_edits(lines, range_, "g():\n    return 2")
+    assert apply_edits(document, edits) == "def g():\n    return 2\n\nprint(f())\n"
+
+
+def test_edits_at_offsets_the_first_line():
+    edits = edits_at(Position(3, 8), "ab\ncd", "aX\ncd")
+    assert [(e.range.start, e.range.end, e.new_text) for e in edits] == [
+        (Position(3, 9), Position(3, 10), "X")
+    ]
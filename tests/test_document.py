@@ -0,0 +1,90 @@
+import random
+from itertools import accumulate
+
+import pytest
+from lsprotocol.types import Position, Range, TextDocumentContentChangeWholeDocument
+from pygls.workspace import TextDocument
+
+from grimoire_ls import document
+from grimoire_ls.document import DocumentView
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch: pytest.MonkeyPatch):
+    # Lines span several blocks, and blocks several lines
+    monkeypatch.setattr(document, "block_size", 8)
+
+
+def random_texts(n: int):
+    rng = random.Random(0)
+    yield from ["", "\n", "\n\n", "a", "a\n", "a\r\nb", "a\r\n\r\n"]
+    for _ in range(n):
+        yield "".join(rng.choices(["a", "bc", " ", "\n", "\r\n"], k=rng.randrange(40)))
+
+
+@pytest.mark.parametrize("text", list(random_texts(200)))
+def test_lines_match_splitlines(text: str):
+    view = DocumentView(text)
+    lines = text.splitlines(keepends=True)
+    starts = [0, *accumulate(len(line) for line in lines)]
+
+    assert len(view) == len(lines)
+    assert list(view) == lines
+    assert [view[i] for i in range(len(lines))] == lines
+    assert [view[i] for i in range(-len(lines), 0)] == lines
+    for i in range(len(lines) + 2):
+        assert view.line_start(i) == starts[min(i, len(lines))]
+    for i, line in enumerate(lines):
+        assert view.line_end(i) == starts[i + 1]
+        # Every character of the line, and its end (before the line break)
+        content = line.rstrip("\r\n")
+        for character in range(len(content) + 1):
+            position = Position(i, character)
+            assert view.offset_at(position) == starts[i] + character
+            assert view.position_at(starts[i] + character) == position
+        assert view.offset_at(Position(i, len(line) + 5)) == starts[i] + len(content)
+    for start in range(len(lines) + 1):
+        for stop in range(start, len(lines) + 2):
+            assert view[start:stop] == lines[start:stop]
+    assert view[::2] == lines[::2]
+    assert view[-2:] == lines[-2:]
+
+
+def test_index_out_of_range():
+    view = DocumentView("a\nb\n")
+    with pytest.raises(IndexError):
+        _ = view[2]
+    with pytest.raises(IndexError):
+        _ = view[-3]
+
+
+def test_position_at_is_clamped():
+    text = "first line\nsecond line\n"
+    view = DocumentView(text)
+    assert view.position_at(-1) == Position(0, 0)
+    assert view.position_at(len(text) + 10) == Position(2, 0)
+
+
+def test_text_in_range():
+    text = "def f(x):\n    return x\n"
+    view = DocumentView(text)
+    range_ = Range(Position(0, 4), Position(1, 10))
+    assert view.text_in_range(range_) == "f(x):\n    return"
+    assert view.text(4, 9) == "f(x):"
+
+
+def test_lines_in_range_includes_the_end_character():
+    view = DocumentView("def f(x):\n    return x\n    pass\n")
+    range_ = Range(Position(0, 4), Position(1, 9))
+    assert view.lines_in_range(range_) == ["f(x):\n", "    return"]
+    assert view.lines_in_range(Range(Position(5, 0), Position(6, 0))) == []
+
+
+def test_view_of_a_document_is_rebuilt_when_it_changes():
+    doc = TextDocument("file:///a.py", "a\nb\n")
+    view = DocumentView.of(doc)
+    assert DocumentView.of(doc) is view
+    doc.apply_change(TextDocumentContentChangeWholeDocument(text="a\nb\nc\n"))
+    changed = DocumentView.of(doc)
+    assert changed is not view
+    assert list(changed) == ["a\n", "b\n", "c\n"]
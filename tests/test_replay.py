@@ -0,0 +1,71 @@
+import asyncio
+import time
+from pathlib import Path
+from typing import Any
+
+from result import Ok
+
+from benchmarks.fake_model import FakeModel, ModelOptions, generate
+from grimoire_ls import backend as backend_module
+from grimoire_ls.backend import BackendOptions, OpenAIBackend
+from grimoire_ls.replay import Recorder, Replayer, load_trace
+
+expected = "".join(generate(8))
+
+
+async def timed_events(
+    backend: OpenAIBackend, prompt: str
+) -> list[tuple[float, dict[str, Any]]]:
+    start = time.perf_counter()
+    return [
+        (time.perf_counter() - start, event)
+        async for event in backend.stream("/completions", prompt=prompt)
+    ]
+
+
+def test_replay_a_recorded_session(tmp_path: Path):
+    trace = tmp_path / "session.jsonl.gz"
+
+    async def record() -> list[dict[str, Any]]:
+        model = FakeModel(ModelOptions(latency=0.1, tokens_per_second=80.0))
+        await model.start()
+        recorder = Recorder(BackendOptions(base_url=model.base_url), trace)
+        await recorder.start()
+        client = OpenAIBackend(BackendOptions(base_url=recorder.base_url), max_tokens=8)
+        try:
+            events = [event for _, event in await timed_events(client, "x = ")]
+            assert await client.complete("y = ") == Ok(expected)
+        finally:
+            backend_module.close_pools()
+            await recorder.close()
+            await model.close()
+        return events
+
+    async def replay(time_scale: float):
+        replayer = Replayer(load_trace(trace), time_scale)
+        await replayer.start()
+        client = OpenAIBackend(BackendOptions(base_url=replayer.base_url), max_tokens=8)
+        try:
+            events = await timed_events(client, "x = ")
+            assert await client.complete("y = ") == Ok(expected)
+            assert (replayer.matched, replayer.unmatched) == (2, 0)
+            # A prompt that was not recorded gets a response of the same endpoint
+            assert await client.complete("z = ") == Ok(expected)
+            assert replayer.unmatched == 1
+        finally:
+            backend_module.close_pools()
+            await replayer.close()
+        return events
+
+    recorded = asyncio.run(record())
+    records = load_trace(trace)
+    assert [record["path"] for record in records] == ["/completions"] * 2
+    delays = [delay for delay, _ in records[0]["events"]]
+    assert delays == sorted(delays) and delays[0] >= 0.1
+
+    replayed = asyncio.run(replay(0.5))
+    assert [event for _, event in replayed] == recorded
+    # Each event arrives at half of its recorded delay
+    for (arrived, _), delay in zip(replayed, delays):
+        assert delay * 0.5 <= arrived + 0.01
+        assert arrived <= delay * 0.5 + 0.05
@@ -0,0 +1,176 @@
+import asyncio
+import threading
+
+import pytest
+
+from grimoire_ls import threads
+from grimoire_ls.scheduling import Overloaded, Priority, RequestScheduler
+from grimoire_ls.threads import BlockingExecutor, StillRunning
+
+
+async def _hold(scheduler: RequestScheduler, release: asyncio.Event, **kwargs):
+    await scheduler.run(release.wait, **kwargs)
+
+
+async def _record(order: list[str], name: str):
+    order.append(name)
+
+
+def test_limit_per_backend():
+    async def main():
+        scheduler = RequestScheduler(default_limit=1)
+        release = asyncio.Event()
+        running = asyncio.create_task(_hold(scheduler, release))
+        await asyncio.sleep(0)
+        # Another backend has its own slots
+        await scheduler.run(lambda: _record([], "other"), backend="other")
+        waiting = asyncio.create_task(scheduler.run(lambda: _record([], "waiting")))
+        await asyncio.sleep(0)
+        assert scheduler.waiting() == 1
+        release.set()
+        await asyncio.gather(running, waiting)
+        assert scheduler.waiting() == 0
+
+    asyncio.run(main())
+
+
+def test_waiting_requests_are_served_by_priority():
+    async def main():
+        scheduler = RequestScheduler(default_limit=1, max_waiting={})
+        release = asyncio.Event()
+        order: list[str] = []
+        running = asyncio.create_task(_hold(scheduler, release))
+        await asyncio.sleep(0)
+        tasks = [
+            asyncio.create_task(
+                scheduler.run(lambda name=name: _record(order, name), priority)
+            )
+            for name, priority in [
+                ("background", Priority.background),
+                ("action 1", Priority.code_action),
+                ("completion", Priority.completion),
+                ("action 2", Priority.code_action),
+            ]
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(running, *tasks)
+        assert order == ["completion", "action 1", "action 2", "background"]
+
+    asyncio.run(main())
+
+
+def test_max_waiting_sheds_requests():
+    async def main():
+        scheduler = RequestScheduler(
+            default_limit=1, max_waiting={Priority.background: 1}
+        )
+        release = asyncio.Event()
+        running = asyncio.create_task(_hold(scheduler, release))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(
+            scheduler.run(lambda: _record([], "waiting"), Priority.background)
+        )
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await scheduler.run(lambda: _record([], "shed"), Priority.background)
+        assert scheduler.wait_stats[Priority.background].shed == 1
+        # Other priorities have no limit
+        completion = asyncio.create_task(scheduler.run(lambda: _record([], "c")))
+        await asyncio.sleep(0)
+        assert scheduler.waiting() == 2
+        release.set()
+        await asyncio.gather(running, waiting, completion)
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_frees_its_place():
+    async def main():
+        scheduler = RequestScheduler(
+            default_limit=1, max_waiting={Priority.background: 1}
+        )
+        release = asyncio.Event()
+        order: list[str] = []
+        running = asyncio.create_task(_hold(scheduler, release))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(
+            scheduler.run(lambda: _record(order, "cancelled"), Priority.background)
+        )
+        await asyncio.sleep(0)
+        _ = cancelled.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.waiting(Priority.background) == 0
+        waiting = asyncio.create_task(
+            scheduler.run(lambda: _record(order, "waiting"), Priority.background)
+        )
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(running, waiting)
+        assert order == ["waiting"]
+        # Every slot was given back
+        await asyncio.wait_for(scheduler.run(lambda: _record(order, "last")), 1)
+
+    asyncio.run(main())
+
+
+def test_reconfigure_frees_waiting_requests():
+    async def main():
+        scheduler = RequestScheduler(default_limit=1)
+        release = asyncio.Event()
+        order: list[str] = []
+        running = asyncio.create_task(_hold(scheduler, release))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(scheduler.run(lambda: _record(order, "waiting")))
+        await asyncio.sleep(0)
+        scheduler.reconfigure(RequestScheduler(default_limit=2))
+        await asyncio.wait_for(waiting, 1)
+        assert order == ["waiting"]
+        release.set()
+        await running
+
+    asyncio.run(main())
+
+
+def test_cancelled_blocking_call_keeps_its_slot_until_it_is_done():
+    async def main():
+        scheduler = RequestScheduler(default_limit=1)
+        executor = BlockingExecutor(1)
+        started, release = threading.Event(), threading.Event()
+
+        def generate():
+            started.set()
+            _ = release.wait(5)
+
+        running = asyncio.create_task(scheduler.run(lambda: executor.run(generate)))
+        _ = await asyncio.to_thread(started.wait, 5)
+        _ = running.cancel()
+        with pytest.raises(StillRunning):
+            await running
+        # The worker thread is still generating, so the slot is not free yet
+        waiting = asyncio.create_task(scheduler.run(lambda: _record([], "waiting")))
+        await asyncio.sleep(0.01)
+        assert scheduler.waiting() == 1
+        release.set()
+        await asyncio.wait_for(waiting, 1)
+        executor.shutdown()
+
+    asyncio.run(main())
+
+
+def test_loop_of_a_blocking_async_call_is_cleaned_up(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(threads, "_loop_cleanups", [])
+    loops: list[asyncio.AbstractEventLoop] = []
+    threads.on_loop_close(lambda: loops.append(asyncio.get_running_loop()))
+
+    @threads.blocking
+    async def call() -> asyncio.AbstractEventLoop:
+        return asyncio.get_running_loop()
+
+    async def main():
+        executor = BlockingExecutor(1)
+        loop = await executor.run(call)
+        executor.shutdown()
+        return loop
+
+    assert asyncio.run(main()) is loops[0]
@@ -0,0 +1,86 @@
+import asyncio
+from collections.abc import AsyncIterator
+
+import pytest
+
+from grimoire_ls.streaming import (
+    StopOptions,
+    dedent,
+    stream_until,
+    suffix_overlap,
+    unbalanced_brackets,
+)
+
+
+def test_suffix_overlap_cuts_before_the_repeated_line():
+    condition = suffix_overlap("\n    return result\n")
+    assert condition("x + 1") is None
+    text = "x + 1\n    return result"
+    assert condition(text) == len("x + 1")
+
+
+def test_suffix_overlap_ignores_short_suffixes():
+    condition = suffix_overlap(")\n")
+    assert condition("foo())") is None
+
+
+@pytest.mark.parametrize(
+    ("before", "text", "expected"),
+    [
+        # Closes the bracket that was open at the cursor, and then one more
+        ("f(", "x))", 2),
+        ("f(", "x)", None),
+        # Brackets opened in the completion are balanced on their own
+        ("", "[a, (b)]", None),
+        ("", "a]", 1),
+        # A bracket of the wrong kind
+        ("f(", "x]", 1),
+    ],
+)
+def test_unbalanced_brackets(before: str, text: str, expected: int | None):
+    assert unbalanced_brackets(before)(text) == expected
+
+
+def test_dedent_cuts_before_a_shallower_line():
+    condition = dedent("def f():\n    x = ")
+    assert condition("1\n    y = 2\n") is None
+    assert condition("1\n    y = 2\nz = 3\n") == len("1\n    y = 2")
+
+
+def test_dedent_waits_for_complete_lines():
+    condition = dedent("def f():\n    x = ")
+    # The last line may still be indented further
+    assert condition("1\n") is None
+    assert condition("1\n ") is None
+
+
+def test_max_chars():
+    conditions = StopOptions(
+        suffix_overlap=False, brackets=False, dedent=False, max_chars=3
+    ).conditions("", "")
+    assert [condition("abcd") for condition in conditions] == [3]
+
+
+async def _chunks(chunks: list[str], consumed: list[str]) -> AsyncIterator[str]:
+    try:
+        for chunk in chunks:
+            consumed.append(chunk)
+            yield chunk
+    finally:
+        consumed.append("<closed>")
+
+
+def test_stream_until_stops_and_closes_the_stream():
+    consumed: list[str] = []
+    chunks = ["x = ", "f(a", "))", "\nnever"]
+    conditions = StopOptions().conditions("", "\n")
+    text = asyncio.run(stream_until(_chunks(chunks, consumed), conditions))
+    assert text == "x = f(a)"
+    assert consumed == ["x = ", "f(a", "))", "<closed>"]
+
+
+def test_stream_until_checks_the_last_line():
+    consumed: list[str] = []
+    conditions = StopOptions().conditions("def f():\n    x = ", "")
+    text = asyncio.run(stream_until(_chunks(["1\n", "y = 2"], consumed), conditions))
+    assert text == "1"
@@ -0,0 +1,116 @@
+import subprocess
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+from pygls.workspace import Workspace
+
+from grimoire_ls import workspace as wrk
+from grimoire_ls.workspace import IdentifierIndex, WorkspaceSnapshot
+
+
+@pytest.fixture
+def snapshot(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    _ = subprocess.run(["git", "init", "-q", str(tmp_path)], check=True)
+    (tmp_path / ".git" / "info" / "exclude").write_text("build/\n")
+    (tmp_path / "a.py").write_text("def alpha():\n    pass\n")
+    wrk.invalidate_visible_files()
+    server: Any = SimpleNamespace(workspace=Workspace(tmp_path.as_uri()))
+    snapshot = WorkspaceSnapshot.build(server)
+    assert snapshot is not None
+    calls: list[list[Path]] = []
+    filter_paths = wrk.filter_paths
+
+    def counted(repo: Any, paths: Any, *args: Any):
+        calls.append(list(paths))
+        return filter_paths(repo, calls[-1], *args)
+
+    monkeypatch.setattr(wrk, "filter_paths", counted)
+    return snapshot, calls
+
+
+def test_reload_asks_git_once_for_the_new_files(snapshot: Any):
+    snapshot, calls = snapshot
+    root = snapshot.root
+    (root / "b.py").write_text("def beta():\n    pass\n")
+    (root / "build").mkdir()
+    (root / "build" / "out.py").write_text("def generated():\n    pass\n")
+    (root / "a.py").write_text("def alpha2():\n    pass\n")
+    snapshot.reload([root / "a.py", root / "b.py", root / "build" / "out.py"])
+    assert len(calls) == 1
+    assert sorted(p.name for p in calls[0]) == ["b.py", "out.py"]
+    assert sorted(p.name for p in snapshot.files) == ["a.py", "b.py"]
+    assert snapshot.index.by_path[root / "a.py"] == {"alpha2", "def", "pass"}
+
+    # Ignored files are remembered
+    snapshot.reload([root / "build" / "out.py"])
+    assert len(calls) == 1
+
+
+def test_reload_skips_git_internals_and_ignored_extensions(snapshot: Any):
+    snapshot, calls = snapshot
+    root = snapshot.root
+    (root / "grimoire-ls.log").write_text("log\n")
+    snapshot.reload([root / ".git" / "index", root / "grimoire-ls.log"])
+    assert calls == []
+    assert list(snapshot.files) == [root / "a.py"]
+
+
+def test_reload_drops_deleted_files(snapshot: Any):
+    snapshot, _ = snapshot
+    root = snapshot.root
+    (root / "a.py").unlink()
+    snapshot.reload([root / "a.py"])
+    assert snapshot.files == {}
+    assert "alpha" not in snapshot.index.postings
+
+
+def test_edited_documents_are_indexed_at_most_every_interval(
+    snapshot: Any, monkeypatch: pytest.MonkeyPatch
+):
+    snapshot, _ = snapshot
+    root = snapshot.root
+    now = [100.0]
+    monkeypatch.setattr(wrk.time, "monotonic", lambda: now[0])
+    server: Any = SimpleNamespace(workspace=Workspace(root.as_uri()))
+    uri = (root / "a.py").as_uri()
+
+    def edit(version: int, text: str):
+        server.workspace.put_text_document(
+            SimpleNamespace(uri=uri, language_id="python", version=version, text=text)
+        )
+        snapshot.sync(server)
+
+    edit(1, "def one():\n")
+    assert "one" in snapshot.index.by_path[root / "a.py"]
+    now[0] += 0.5
+    edit(2, "def two():\n")
+    # The content is up to date, but the index waits
+    assert list(snapshot.files[root / "a.py"]) == ["def two():\n"]
+    assert "one" in snapshot.index.by_path[root / "a.py"]
+    now[0] += snapshot.index_interval
+    snapshot.sync(server)
+    assert "two" in snapshot.index.by_path[root / "a.py"]
+
+
+def test_identifier_index():
+    index = IdentifierIndex()
+    index.add(Path("/p/a.py"), ["def alpha(shared):\n", "    return shared\n"])
+    index.add(Path("/p/b.py"), ["def beta(shared):\n"])
+    assert index.postings["shared"] == {Path("/p/a.py"), Path("/p/b.py")}
+    assert index.by_dir[Path("/p")] == {Path("/p/a.py"), Path("/p/b.py")}
+    # Rarer identifiers are more informative
+    assert index.idf("alpha") > index.idf("shared") > 0
+    assert index.idf("missing") == 0
+
+    # Adding a file again replaces its identifiers
+    index.add(Path("/p/a.py"), ["def gamma():\n"])
+    assert "alpha" not in index.postings
+    assert index.postings["shared"] == {Path("/p/b.py")}
+
+    index.remove(Path("/p/b.py"))
+    index.remove(Path("/p/b.py"))
+    assert index.by_path.keys() == {Path("/p/a.py")}
+    assert index.by_dir[Path("/p")] == {Path("/p/a.py")}
+    assert set(index.postings) == {"def", "gamma"}